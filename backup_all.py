@@ -0,0 +1,69 @@
+#!/usr/local/bin/ python3
+
+import json, sys, time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from simple_settings import settings
+from common import get_logger, wait_for_trash
+import backup_codespace
+import backup_diskstation
+import backup_droplet1
+import backup_sandbox
+
+logger = get_logger('backup_all.log')
+
+# every host job runs in this one process; transfer and disk limits are shared
+# through common.get_transfer_limits() and common.disk_io()
+JOBS = {
+    "droplet1": backup_droplet1.run,
+    "diskstation": backup_diskstation.run,
+    "sandbox": backup_sandbox.run,
+    "codespace": backup_codespace.run,
+}
+
+def run_job(name):
+    start = time.monotonic()
+    try:
+        result = JOBS[name]()
+    except:
+        result = {
+            "host": None,
+            "directory": None,
+            "errors": ["Unexpected error: {}".format(sys.exc_info()[0])],
+        }
+    result["job"] = name
+    result["duration"] = round(time.monotonic() - start, 3)
+    return result
+
+def write_result(result):
+    with open(settings.BACKUP_RESULT_FILE, "w") as f:
+        json.dump(result, f, indent=2)
+
+def run():
+    start_date = datetime.now()
+
+    with ThreadPoolExecutor(max_workers=settings.MAX_CONCURRENT_JOBS) as executor:
+        results = list(executor.map(run_job, settings.BACKUP_JOBS))
+
+    end_date = datetime.now()
+    failed = [result["job"] for result in results if len(result["errors"]) > 0]
+    write_result({
+        "started": start_date.isoformat(),
+        "finished": end_date.isoformat(),
+        "duration": round((end_date - start_date).total_seconds(), 3),
+        "jobs": results,
+    })
+
+    if len(failed) == 0:
+        logger.info("all backups completed in {}".format(end_date - start_date))
+    else:
+        logger.error("backups completed in {} with errors in {}".format(
+            end_date - start_date,
+            ", ".join(failed),
+        ))
+
+    return results
+
+if __name__ == "__main__":
+    run()
+    wait_for_trash()
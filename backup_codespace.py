@@ -1,35 +1,91 @@
+import asyncio, sqlite3
 from simple_settings import settings
-import subprocess
+from common import RunReport, store_directory
 
-def run():
+# one `gh codespace cp` per codespace copies all of its files, and the
+# codespaces are copied concurrently, at most CODESPACE_MAX_CONCURRENT at a time
+
+async def copy_files(name, sources, target):
+  process = await asyncio.create_subprocess_exec(
+    settings.GH_EXECUTABLE,
+    'codespace',
+    'cp',
+    '-e',
+    '-c',
+    name,
+    *sources,
+    target,
+  )
+  return await process.wait()
+
+# a codespace that was asleep often fails the first call while it wakes up,
+# so failures are retried with backoff
+async def copy_files_with_retries(name, sources, target):
+  for attempt in range(settings.CODESPACE_RETRIES + 1):
+    returncode = await copy_files(name, sources, target)
+    if returncode == 0 or attempt == settings.CODESPACE_RETRIES:
+      return returncode
+    print(f"codespace cp completed with code {returncode} for {name}, retrying")
+    await asyncio.sleep(2 ** attempt)
+
+async def backup_codespace(cs, limit, report, errors):
+  if len(cs['FILENAMES']) == 0:
+    return
 
-  for cs in (
-    settings.CODESPACE_COPTHIS,
-    settings.CODESPACE_COPTHIS_WEBSITE,
-    settings.CODESPACE_MERCHBAR_WEB,
-  ):
+  async with limit:
+    with report.phase(cs['NAME']):
+      print(f"backing up files for {cs['NAME']}")
 
-    print(f"backing up files for {cs['NAME']}")
+      target = settings.CODESPACE_BACKUP_DIRECTORY
+      sources = [f'remote:{cs["PATH"]}/{filename}' for filename in cs['FILENAMES']]
+      returncode = await copy_files_with_retries(cs['NAME'], sources, target)
+      print(f"codespace cp completed with code {returncode} for {len(sources)} files")
 
-    for filename in cs['FILENAMES']:
-      source = f'remote:{cs["PATH"]}/{filename}'
-      target = '/Users/bryanhadromerchbar/Documents/Backups/Codespaces'
+      if returncode != 0 and len(sources) == 1:
+        errors.append(f"{cs['NAME']} {cs['FILENAMES'][0]} cp completed with code {returncode}")
+      elif returncode != 0:
+        # copy the files one by one to find out which of them failed
+        for filename, source in zip(cs['FILENAMES'], sources):
+          returncode = await copy_files(cs['NAME'], [source], target)
+          print(f"codespace cp completed with code {returncode} for file {filename}")
+          if returncode != 0:
+            errors.append(f"{cs['NAME']} {filename} cp completed with code {returncode}")
 
-      completed_process = subprocess.run([
-          'gh',
-          'codespace',
-          'cp',
-          '-e',
-          '-c',
-          cs['NAME'],
-          source,
-          target,
-      ])
+      print(f"file backup complete for {cs['NAME']}")
 
-      print(f"codespace cp completed with code {completed_process.returncode} for file {filename}")
+async def backup_codespaces(report, errors):
+  limit = asyncio.Semaphore(settings.CODESPACE_MAX_CONCURRENT)
+  await asyncio.gather(*(
+    backup_codespace(cs, limit, report, errors)
+    for cs in (
+      settings.CODESPACE_COPTHIS,
+      settings.CODESPACE_COPTHIS_WEBSITE,
+      settings.CODESPACE_MERCHBAR_WEB,
+    )
+  ))
 
-    print(f"file backup complete for {cs['NAME']}")
+def run():
+  errors = []
+  report = RunReport("codespace", "codespaces")
+
+  asyncio.run(backup_codespaces(report, errors))
+
+  # the copies are overwritten every run, so their history lives in the chunk store
+  with report.phase("store"):
+    try:
+      store_directory(settings.CODESPACE_BACKUP_DIRECTORY, "Backup_Codespace", settings.RETENTION)
+    except (OSError, sqlite3.Error) as error:
+      errors.append(f"chunk store: {error}")
 
   print("finis")
+  report.write(None, errors)
+
+  return {
+    "host": "codespaces",
+    "directory": None,
+    "errors": errors,
+    "phases": report.phases,
+  }
 
-run()
\ No newline at end of file
+if __name__ == "__main__":
+  run()
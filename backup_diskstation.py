@@ -3,26 +3,43 @@
 import os, re, shutil, sys
 from datetime import datetime
 from simple_settings import settings
-import paramiko
-from scp import (
-    SCPClient,
-    SCPException
+from scp import SCPException
+from common import (
+    get_logger,
+    get_ssh_pool,
+    disk_io,
+    Fetch,
+    run_transfers,
+    open_snapshot_archive,
+    remove_empty_directories,
+    load_manifest,
+    write_manifest,
+    Journal,
+    find_resumable_snapshot,
+    verify_snapshot,
+    catalog_snapshot,
+    find_previous_snapshot,
+    link_unchanged_files,
+    mirror_to_destinations,
+    SnapshotTee,
+    prune_snapshots,
+    store_snapshots,
+    move_to_trash,
+    wait_for_trash,
+    RunReport,
 )
-from common import get_logger
 
-logger = get_logger('backup_diskstation.log')
+logger = get_logger('backup_diskstation.log', job='diskstation')
 
 OS_BACKUPS_PATH = settings.BACKUPS_DIRECTORY.split("/")[1:]
 OS_BACKUPS_PATH[0] = "/{}".format(OS_BACKUPS_PATH[0])
-OS_DROPBOX_BACKUPS_PATH = settings.DROPBOX_BACKUPS_DIRECTORY.split("/")[1:]
-OS_DROPBOX_BACKUPS_PATH[0] = "/{}".format(OS_DROPBOX_BACKUPS_PATH[0])
 
 # Define progress callback that prints the current percentage completed for the file
 def progress(filename, size, sent):
     sys.stdout.write("%s\'s progress: %.2f%%   \r" % (filename, float(sent)/float(size)*100) )
 
 
-def archive_current_backup():
+def archive_current_backup(exclude=None):
     # print("archiving current backup")
     # create archive folders
     dir = os.path.join(*OS_BACKUPS_PATH, "archive-diskstation")
@@ -32,7 +49,7 @@ def archive_current_backup():
     # move old backup folders into archive
     dirs = next( os.walk(settings.BACKUPS_DIRECTORY))[1]
     for d in dirs:
-        if re.match('Backup_Diskstation', d, flags=re.IGNORECASE):
+        if re.match('Backup_Diskstation', d, flags=re.IGNORECASE) and d != exclude:
             shutil.move(
                 "{}/{}".format(settings.BACKUPS_DIRECTORY, d),
                 "{}/archive-diskstation/{}".format(settings.BACKUPS_DIRECTORY, d),
@@ -40,25 +57,6 @@ def archive_current_backup():
     # print("done")
 
 
-def archive_current_dropbox_backup():
-    # print("archiving current dropbox backup")
-
-    # create archive folders
-    dir = os.path.join(*OS_DROPBOX_BACKUPS_PATH, "archive-diskstation")
-    if not os.path.exists(dir):
-        os.mkdir(dir)
-
-    # move old backup folders into Dropbox archive
-    dirs = next( os.walk(settings.DROPBOX_BACKUPS_DIRECTORY))[1]
-    for d in dirs:
-        if re.match('Backup_Diskstation', d, flags=re.IGNORECASE):
-            shutil.move(
-                "{}/{}".format(settings.DROPBOX_BACKUPS_DIRECTORY, d),
-                "{}/archive-diskstation/{}".format(settings.DROPBOX_BACKUPS_DIRECTORY, d),
-            )
-
-    # print("done")
-
 def create_new_directory():
     # print("creating new backup directory...")
     name = "Backup_Diskstation_{}".format(
@@ -73,99 +71,227 @@ def create_new_directory():
 
     return name
 
-def create_new_backup(destination):
-    # print("creating a new backup...")
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.load_system_host_keys()
+def get_fetches(user, destination):
+    fetches = [
+        # user home directory files (.ssh, .bashrc)
+        Fetch(
+            "~/.bashrc",
+            "{}/{}/{}/dotbashrc".format(settings.BACKUPS_DIRECTORY, destination, user),
+        ),
+        Fetch(
+            "~/.bash_profile",
+            "{}/{}/{}/dotbash_profile".format(settings.BACKUPS_DIRECTORY, destination, user),
+        ),
+        Fetch(
+            "~/.ssh",
+            "{}/{}/{}/dotssh".format(settings.BACKUPS_DIRECTORY, destination, user),
+            recursive=True,
+        ),
+    ]
 
-    for user in settings.DISKSTATION_USERS:
+    if user == settings.DISKSTATION_WEBMASTER:
+        fetches += [
+            # Wordpress Hyperbackup
+            Fetch(
+                "{}/Wordpress Site.hbk".format(settings.DISKSTATION_WORDPRESS_BACKUP_DIRECTORY),
+                "{}/{}/Wordpress Site.hbk".format(settings.BACKUPS_DIRECTORY, destination),
+                recursive=True,
+            ),
+            # local Django settings file
+            Fetch(
+                "{}/bryanhadro_django_project/website/website/config/local.py".format(settings.DISKSTATION_WEB_DIRECTORY),
+                "{}/{}/bryanhadro_django_project_local.py".format(settings.BACKUPS_DIRECTORY, destination),
+            ),
+        ]
 
-        dir = os.path.join(*OS_BACKUPS_PATH, destination, user)
-        if not os.path.exists(dir):
-            os.mkdir(dir)
+    return fetches
 
-        ssh.connect(
-            settings.DISKSTATION_HOST,
-            port=settings.DISKSTATION_PORT,
-            username=user,
-            key_filename=settings.SSH_KEY,
-            look_for_keys=True,
-            timeout=5000,
-        )
+def create_new_backup(destination, previous=None):
+    # print("creating a new backup...")
+    pool = get_ssh_pool()
+    records = []
+    archive = None
+    if settings.SNAPSHOT_FORMAT == "archive":
+        archive = open_snapshot_archive("{}/{}".format(settings.BACKUPS_DIRECTORY, destination))
+    # an archive can't be reopened, so only directory snapshots are resumable
+    journal = Journal("{}/{}".format(settings.BACKUPS_DIRECTORY, destination)) if archive is None else None
+    # an archive is only mirrored once it's closed
+    tee = None
+    if archive is None and settings.TEE_ON_ARRIVAL:
+        tee = SnapshotTee("{}/{}".format(settings.BACKUPS_DIRECTORY, destination), 'Backup_Diskstation')
 
-        # with SCPClient(ssh.get_transport(), progress=progress) as scp:
-        with SCPClient(ssh.get_transport()) as scp:
-            # user home directory files (.ssh, .bashrc)
-            scp.get(
-                "~/.bashrc",
-                "{}/{}/{}/dotbashrc".format(settings.BACKUPS_DIRECTORY, destination, user),
-            )
-            scp.get(
-                "~/.bash_profile",
-                "{}/{}/{}/dotbash_profile".format(settings.BACKUPS_DIRECTORY, destination, user),
-            )
-            scp.get(
-                "~/.ssh",
-                "{}/{}/{}/dotssh".format(settings.BACKUPS_DIRECTORY, destination, user),
-                recursive=True,
-            )
+    try:
+        for user in settings.DISKSTATION_USERS:
 
-            if user == settings.DISKSTATION_WEBMASTER:
-                # Wordpress Hyperbackup
-                scp.get(
-                    "{}/Wordpress Site.hbk".format(settings.DISKSTATION_WORDPRESS_BACKUP_DIRECTORY),
-                    "{}/{}".format(settings.BACKUPS_DIRECTORY, destination),
-                    recursive=True,
-                )
+            dir = os.path.join(*OS_BACKUPS_PATH, destination, user)
+            if not os.path.exists(dir):
+                os.mkdir(dir)
 
-                # local Django settings file
-                scp.get(
-                    "{}/bryanhadro_django_project/website/website/config/local.py".format(settings.DISKSTATION_WEB_DIRECTORY),
-                    "{}/{}/bryanhadro_django_project_local.py".format(settings.BACKUPS_DIRECTORY, destination),
+            with pool.connection(settings.DISKSTATION_HOST, settings.DISKSTATION_PORT, user) as ssh:
+                # run_transfers(ssh.get_transport(), get_fetches(user, destination), progress=progress)
+                records += run_transfers(
+                    ssh.get_transport(),
+                    get_fetches(user, destination),
+                    root="{}/{}".format(settings.BACKUPS_DIRECTORY, destination),
+                    previous=previous,
+                    workers=settings.TRANSFER_WORKERS,
+                    delta_min_size=settings.DELTA_TRANSFER_MIN_SIZE,
+                    batch_max_size=settings.BATCH_FETCH_MAX_SIZE,
+                    batch_compress=settings.BATCH_FETCH_COMPRESS,
+                    archive=archive,
+                    retries=settings.TRANSFER_RETRIES,
+                    journal=journal,
+                    resume_min_size=settings.RESUME_MIN_SIZE,
+                    tee=tee,
+                    host=settings.DISKSTATION_HOST,
                 )
+    except BaseException:
+        if tee is not None:
+            tee.abort()
+        raise
+    finally:
+        if journal is not None:
+            journal.close()
+        if tee is not None:
+            for target, error in tee.close().items():
+                logger.warning(f"files not mirrored to {target} on arrival: {error}")
+
+    if archive is not None:
+        archive.close()
+        remove_empty_directories("{}/{}".format(settings.BACKUPS_DIRECTORY, destination))
+    write_manifest("{}/{}".format(settings.BACKUPS_DIRECTORY, destination), records)
+    catalog_snapshot("{}/{}".format(settings.BACKUPS_DIRECTORY, destination), records)
+    if journal is not None:
+        journal.complete()
     # print("done")
+    return records
+
+# check every file in the new snapshot against a checksum taken on the remote
+def verify_backup(destination):
+    if not settings.VERIFY_BACKUPS:
+        return []
+
+    pool = get_ssh_pool()
+    root = "{}/{}".format(settings.BACKUPS_DIRECTORY, destination)
+    records = list(load_manifest(root).values())
+    mismatches = []
+    for user in settings.DISKSTATION_USERS:
+        user_records = [record for record in records if record["user"] == user]
+        with pool.connection(settings.DISKSTATION_HOST, settings.DISKSTATION_PORT, user) as ssh:
+            with disk_io():
+                mismatches += verify_snapshot(
+                    ssh.get_transport(),
+                    root,
+                    user_records,
+                    workers=settings.TRANSFER_WORKERS,
+                )
+
+    for path, problem in mismatches:
+        logger.error("verify {}: {} {}".format(destination, path, problem))
+    logger.debug("verified {} files in {}, {} mismatches".format(len(records), destination, len(mismatches)))
+    return ["{} {}".format(path, problem) for path, problem in mismatches]
 
 def copy_backup_to_dropbox(destination):
     # print("copying backup to dropbox...")
-    shutil.copytree(
-        src="{}/{}".format(settings.BACKUPS_DIRECTORY, destination),
-        dst="{}/{}".format(settings.DROPBOX_BACKUPS_DIRECTORY, destination),
-    )
+    # files teed on arrival are already there, so this mostly compares
+    # sizes and mtimes
+    with disk_io():
+        mirrored, errors = mirror_to_destinations(
+            "{}/{}".format(settings.BACKUPS_DIRECTORY, destination),
+            'Backup_Diskstation',
+        )
+    for directory, copied, removed in mirrored:
+        logger.debug("mirrored {} to {}, {} files copied, {} removed".format(destination, directory, copied, removed))
     # print("done")
+    return errors
+
+def link_previous_backup(previous, destination):
+    if previous is None:
+        return
+
+    with disk_io():
+        linked = link_unchanged_files(
+            previous,
+            "{}/{}".format(settings.BACKUPS_DIRECTORY, destination),
+        )
+    logger.debug("hard-linked {} unchanged files from {}".format(linked, previous))
+
+def prune_previous_backups(destination):
+    removed = prune_snapshots(
+        settings.BACKUPS_DIRECTORY,
+        'Backup_Diskstation',
+        settings.RETENTION,
+        keep=destination,
+    )
+    logger.debug("pruned previous backups {}".format(removed))
+
+def store_previous_backups(destination):
+    with disk_io():
+        stored = store_snapshots(settings.BACKUPS_DIRECTORY, 'Backup_Diskstation', keep=destination)
+    logger.debug(f"moved previous backups {stored} into the chunk store")
 
 def delete_local_archive():
     # print("removing local archive...")
-    shutil.rmtree("{}/archive-diskstation".format(settings.BACKUPS_DIRECTORY))
-    # print("done")
-
-def delete_dropbox_archive():
-    # print("removing dropbox archive...")
-    shutil.rmtree("{}/archive-diskstation".format(settings.DROPBOX_BACKUPS_DIRECTORY))
+    move_to_trash("{}/archive-diskstation".format(settings.BACKUPS_DIRECTORY))
     # print("done")
 
 def run():
     errors = []
+    dir_name = None
+    report = RunReport("diskstation", settings.DISKSTATION_HOST)
     # start_date = datetime.now().strftime("%m/%d/%Y %H:%M:%S")
     # print("initializing {} backup to local ({})".format(
     #     settings.DISKSTATION_HOST,
     #     start_date,
     # ))
     try:
-        archive_current_backup()
-        archive_current_dropbox_backup()
-        dir_name = create_new_directory()
-        create_new_backup(dir_name)
-        copy_backup_to_dropbox(dir_name)
-
-        # end_date = datetime.now().strftime("%m/%d/%Y %H:%M:%S")
-        # print("completed {} backup to local directory {} ({})".format(
-        #     settings.DISKSTATION_HOST,
-        #     dir_name,
-        #     end_date,
-        # ))
-        delete_local_archive()
-        delete_dropbox_archive()
+        if settings.INCREMENTAL_SNAPSHOTS:
+            # keep the previous snapshot in place as the hard-link base
+            resumed = find_resumable_snapshot(settings.BACKUPS_DIRECTORY, 'Backup_Diskstation', settings.RESUME_WINDOW)
+            previous = find_previous_snapshot(settings.BACKUPS_DIRECTORY, 'Backup_Diskstation', exclude=resumed)
+            dir_name = resumed or create_new_directory()
+            if resumed is not None:
+                logger.debug("resuming interrupted backup {}".format(resumed))
+            with report.phase("transfer"):
+                report.add_files(create_new_backup(dir_name, previous))
+            with report.phase("link"):
+                link_previous_backup(previous, dir_name)
+            with report.phase("verify"):
+                errors += verify_backup(dir_name)
+            with report.phase("dropbox"):
+                errors += copy_backup_to_dropbox(dir_name)
+            with report.phase("prune"):
+                prune_previous_backups(dir_name)
+            with report.phase("store"):
+                store_previous_backups(dir_name)
+        else:
+            # an interrupted run's snapshot stays in place to be resumed
+            resumed = find_resumable_snapshot(settings.BACKUPS_DIRECTORY, 'Backup_Diskstation', settings.RESUME_WINDOW)
+            with report.phase("archive"):
+                archive_current_backup(exclude=resumed)
+            # unchanged files are linked from the archived snapshot before it is deleted
+            previous = find_previous_snapshot(
+                "{}/archive-diskstation".format(settings.BACKUPS_DIRECTORY),
+                'Backup_Diskstation',
+            )
+            dir_name = resumed or create_new_directory()
+            if resumed is not None:
+                logger.debug("resuming interrupted backup {}".format(resumed))
+            with report.phase("transfer"):
+                report.add_files(create_new_backup(dir_name, previous))
+            with report.phase("verify"):
+                errors += verify_backup(dir_name)
+            with report.phase("dropbox"):
+                errors += copy_backup_to_dropbox(dir_name)
+
+            # end_date = datetime.now().strftime("%m/%d/%Y %H:%M:%S")
+            # print("completed {} backup to local directory {} ({})".format(
+            #     settings.DISKSTATION_HOST,
+            #     dir_name,
+            #     end_date,
+            # ))
+            with report.phase("delete_archive"):
+                delete_local_archive()
     except FileNotFoundError as error:
         errors.append("FileNotFoundError: {}".format(error))
     except TypeError as error:
@@ -196,5 +322,15 @@ def run():
         logger.error(error_message)
 
     # print("finis")
+    report.write(dir_name, errors)
+
+    return {
+        "host": settings.DISKSTATION_HOST,
+        "directory": dir_name,
+        "errors": errors,
+        "phases": report.phases,
+    }
 
-run()
\ No newline at end of file
+if __name__ == "__main__":
+    run()
+    wait_for_trash()
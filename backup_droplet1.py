@@ -4,27 +4,48 @@ from pathlib import Path
 import os, re, shutil, sys
 from datetime import datetime
 from simple_settings import settings
-import paramiko
-from scp import (
-    SCPClient,
-    SCPException
+from scp import SCPException
+from common import (
+    get_logger,
+    file_event,
+    get_ssh_pool,
+    disk_io,
+    Fetch,
+    Dump,
+    DumpFailed,
+    run_transfers,
+    run_dumps,
+    open_snapshot_archive,
+    remove_empty_directories,
+    load_manifest,
+    write_manifest,
+    Journal,
+    find_resumable_snapshot,
+    verify_snapshot,
+    catalog_snapshot,
+    find_previous_snapshot,
+    link_unchanged_files,
+    mirror_to_destinations,
+    SnapshotTee,
+    prune_snapshots,
+    store_snapshots,
+    move_to_trash,
+    wait_for_trash,
+    RunReport,
 )
-from common import get_logger
 
-logger = get_logger('backup_droplet1.log')
+logger = get_logger('backup_droplet1.log', job='droplet1')
 
 
 OS_BACKUPS_PATH = settings.BACKUPS_DIRECTORY.split("/")[1:]
 OS_BACKUPS_PATH[0] = "/{}".format(OS_BACKUPS_PATH[0])
-OS_DROPBOX_BACKUPS_PATH = settings.DROPBOX_BACKUPS_DIRECTORY.split("/")[1:]
-OS_DROPBOX_BACKUPS_PATH[0] = "/{}".format(OS_DROPBOX_BACKUPS_PATH[0])
 
 # Define progress callback that prints the current percentage completed for the file
 def progress(filename, size, sent):
     sys.stdout.write("%s\'s progress: %.2f%%   \r" % (filename, float(sent)/float(size)*100) )
 
 
-def archive_current_backup():
+def archive_current_backup(exclude=None):
     # print("archiving current backup")
     # create archive folders
     dir = os.path.join(*OS_BACKUPS_PATH, "archive-droplet1")
@@ -33,36 +54,18 @@ def archive_current_backup():
 
     # move old backup folders into archive
     for path in Path(settings.BACKUPS_DIRECTORY).glob('Backup_Droplet1*'):
-        logger.debug(f'beginning archive of path {path}, exists values is {path.exists()}')
+        if path.name == exclude:
+            continue
+        file_event(logger, 'beginning archive of path %s, exists values is %s', path, path.exists())
         directory_name = path.name
         shutil.move(
             f"{settings.BACKUPS_DIRECTORY}/{directory_name}",
             f"{settings.BACKUPS_DIRECTORY}/archive-droplet1/{directory_name}",
         )
-        logger.debug(f'archive of path {path} complete, exists values is {path.exists()}')
+        file_event(logger, 'archive of path %s complete, exists values is %s', path, path.exists())
     logger.debug('archived current backup')
 
 
-def archive_current_dropbox_backup():
-    logger.debug("archiving current dropbox backup")
-
-    # create archive folders
-    dir = os.path.join(*OS_DROPBOX_BACKUPS_PATH, "archive-droplet1")
-    if not os.path.exists(dir):
-        os.mkdir(dir)
-
-    # move old backup folders into Dropbox archive
-    for path in Path(settings.DROPBOX_BACKUPS_DIRECTORY).glob('Backup_Droplet1*'):
-        logger.debug(f'beginning archive of dropbox path {path}, exists values is {path.exists()}')
-        directory_name = path.name
-        shutil.move(
-            f'{settings.DROPBOX_BACKUPS_DIRECTORY}/{directory_name}',
-            f'{settings.DROPBOX_BACKUPS_DIRECTORY}/archive-droplet1/{directory_name}',
-        )
-        logger.debug(f'archive of dropbox path {path} complete, exists values is {path.exists()}')
-
-    logger.debug("archived current dropbox backup")
-
 def create_new_directory():
     logger.debug("creating new backup directory...")
     name = "Backup_Droplet1_{}".format(
@@ -77,153 +80,307 @@ def create_new_directory():
 
     return name
 
-def create_new_backup(destination):
-    # print("creating a new backup...")
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.load_system_host_keys()
+def get_fetches(user, destination):
+    fetches = [
+        # user home directory files (.ssh, .bashrc)
+        Fetch(
+            "~/.bashrc",
+            "{}/{}/{}/dotbashrc".format(settings.BACKUPS_DIRECTORY, destination, user),
+        ),
+        # Fetch(
+        #     "~/.bash_profile",
+        #     "{}/{}/{}/dotbash_profile".format(settings.BACKUPS_DIRECTORY, destination, user),
+        # ),
+        Fetch(
+            "~/.ssh",
+            "{}/{}/{}/dotssh".format(settings.BACKUPS_DIRECTORY, destination, user),
+            recursive=True,
+        ),
+    ]
 
-    for user in settings.DROPLET1_USERS:
+    if user == settings.DROPLET1_WEBMASTER:
+        fetches += [
+            # local and prod Django settings files
+            Fetch(
+                "{}/bryanhadro/website/settings/local.py".format(settings.DROPLET1_WEB_DIRECTORY),
+                "{}/{}/bryanhadro_local.py".format(settings.BACKUPS_DIRECTORY, destination),
+            ),
+            Fetch(
+                "{}/bryanhadro/website/settings/prod.py".format(settings.DROPLET1_WEB_DIRECTORY),
+                "{}/{}/bryanhadro_prod.py".format(settings.BACKUPS_DIRECTORY, destination),
+            ),
+            Fetch(
+                "{}/bryanhadro/website/db.sqlite3".format(settings.DROPLET1_WEB_DIRECTORY),
+                "{}/{}/bryanhadro_db.sqlite3".format(settings.BACKUPS_DIRECTORY, destination),
+                sqlite=settings.SQLITE_PAGE_BACKUP,
+            ),
+            # bevendo
+            Fetch(
+                "{}/bevendo_project/frontend/.env.local".format(settings.DROPLET1_WEB_DIRECTORY),
+                "{}/{}/.env.local".format(settings.BACKUPS_DIRECTORY, destination),
+            ),
+            Fetch(
+                "{}/bevendo_project/backend/bevendo/config/local.py".format(settings.DROPLET1_WEB_DIRECTORY),
+                "{}/{}/bevendo_local.py".format(settings.BACKUPS_DIRECTORY, destination),
+            ),
+            Fetch(
+                "{}/bevendo_project/backend/bevendo/config/prod.py".format(settings.DROPLET1_WEB_DIRECTORY),
+                "{}/{}/bevendo_prod.py".format(settings.BACKUPS_DIRECTORY, destination),
+            ),
+            Fetch(
+                "{}/avvento_project/avvento/avvento/settings/local.py".format(settings.DROPLET1_WEB_DIRECTORY),
+                "{}/{}/avvento_local.py".format(settings.BACKUPS_DIRECTORY, destination),
+            ),
+            Fetch(
+                "{}/avvento_project/avvento/avvento/settings/production.py".format(settings.DROPLET1_WEB_DIRECTORY),
+                "{}/{}/avvento_production.py".format(settings.BACKUPS_DIRECTORY, destination),
+            ),
+            Fetch(
+                "{}/avvento_project/avvento/avvento/db.sqlite3".format(settings.DROPLET1_WEB_DIRECTORY),
+                "{}/{}/avvento_db.sqlite3".format(settings.BACKUPS_DIRECTORY, destination),
+                sqlite=settings.SQLITE_PAGE_BACKUP,
+            ),
 
-        dir = os.path.join(*OS_BACKUPS_PATH, destination, user)
-        if not os.path.exists(dir):
-            os.mkdir(dir)
+            # Apache config files
+            Fetch(
+                f'/etc/apache2/ports.conf',
+                f'{settings.BACKUPS_DIRECTORY}/{destination}/ports.conf',
+            ),
+            Fetch(
+                f'/etc/apache2/sites-available/000-default.conf',
+                f'{settings.BACKUPS_DIRECTORY}/{destination}/000-default.conf',
+            ),
+            Fetch(
+                f'/etc/apache2/sites-available/001-default.conf',
+                f'{settings.BACKUPS_DIRECTORY}/{destination}/001-default.conf',
+            ),
+            Fetch(
+                f'/etc/apache2/sites-available/002-default.conf',
+                f'{settings.BACKUPS_DIRECTORY}/{destination}/002-default.conf',
+            ),
+            Fetch(
+                f'/etc/apache2/sites-available/bevendo-backend.conf',
+                f'{settings.BACKUPS_DIRECTORY}/{destination}/bevendo-backend.conf',
+            ),
+            Fetch(
+                f'/etc/apache2/sites-available/bevendo-frontend.conf',
+                f'{settings.BACKUPS_DIRECTORY}/{destination}/bevendo-frontend.conf',
+            ),
+            Fetch(
+                f'/etc/apache2/sites-available/three-strikes-website.conf',
+                f'{settings.BACKUPS_DIRECTORY}/{destination}/three-strikes-website.conf',
+            ),
+            Fetch(
+                f'/etc/apache2/sites-available/whisky-creek-ramblers.conf',
+                f'{settings.BACKUPS_DIRECTORY}/{destination}/whisky-creek-ramblers.conf',
+            ),
+        ]
 
-        ssh.connect(
-            settings.DROPLET1_HOST,
-            port=settings.DROPLET1_PORT,
-            username=user,
-            key_filename=settings.SSH_KEY,
-            look_for_keys=True,
-            timeout=5000,
-        )
+        # bevendo mysql dump, left by a remote cron job unless DROPLET1_DUMPS takes it
+        if "bevendo-dump.sql.gz" not in dict(settings.DROPLET1_DUMPS):
+            fetches.append(Fetch(
+                "{}/backups/bevendo-dump.sql.gz".format(settings.DROPLET1_WEB_DIRECTORY),
+                "{}/{}/bevendo-dump.sql.gz".format(settings.BACKUPS_DIRECTORY, destination),
+            ))
 
-        # with SCPClient(ssh.get_transport(), progress=progress) as scp:
-        with SCPClient(ssh.get_transport()) as scp:
-            # user home directory files (.ssh, .bashrc)
-            scp.get(
-                "~/.bashrc",
-                "{}/{}/{}/dotbashrc".format(settings.BACKUPS_DIRECTORY, destination, user),
-            )
-            # scp.get(
-            #     "~/.bash_profile",
-            #     "{}/{}/{}/dotbash_profile".format(settings.BACKUPS_DIRECTORY, destination, user),
-            # )
-            scp.get(
-                "~/.ssh",
-                "{}/{}/{}/dotssh".format(settings.BACKUPS_DIRECTORY, destination, user),
-                recursive=True,
-            )
+    return fetches
 
-            if user == settings.DROPLET1_WEBMASTER:
-                # local and prod Django settings files
-                scp.get(
-                    "{}/bryanhadro/website/settings/local.py".format(settings.DROPLET1_WEB_DIRECTORY),
-                    "{}/{}/bryanhadro_local.py".format(settings.BACKUPS_DIRECTORY, destination),
-                )
-                scp.get(
-                    "{}/bryanhadro/website/settings/prod.py".format(settings.DROPLET1_WEB_DIRECTORY),
-                    "{}/{}/bryanhadro_prod.py".format(settings.BACKUPS_DIRECTORY, destination),
-                )
-                scp.get(
-                    "{}/bryanhadro/website/db.sqlite3".format(settings.DROPLET1_WEB_DIRECTORY),
-                    "{}/{}/bryanhadro_db.sqlite3".format(settings.BACKUPS_DIRECTORY, destination),
-                )
-                # bevendo
-                scp.get(
-                    "{}/bevendo_project/frontend/.env.local".format(settings.DROPLET1_WEB_DIRECTORY),
-                    "{}/{}/.env.local".format(settings.BACKUPS_DIRECTORY, destination),
-                )
-                scp.get(
-                    "{}/bevendo_project/backend/bevendo/config/local.py".format(settings.DROPLET1_WEB_DIRECTORY),
-                    "{}/{}/bevendo_local.py".format(settings.BACKUPS_DIRECTORY, destination),
-                )
-                scp.get(
-                    "{}/bevendo_project/backend/bevendo/config/prod.py".format(settings.DROPLET1_WEB_DIRECTORY),
-                    "{}/{}/bevendo_prod.py".format(settings.BACKUPS_DIRECTORY, destination),
-                )
-                # bevendo mysql dump
-                scp.get(
-                    "{}/backups/bevendo-dump.sql.gz".format(settings.DROPLET1_WEB_DIRECTORY),
-                    "{}/{}/bevendo-dump.sql.gz".format(settings.BACKUPS_DIRECTORY, destination),
-                )
-                scp.get(
-                    "{}/avvento_project/avvento/avvento/settings/local.py".format(settings.DROPLET1_WEB_DIRECTORY),
-                    "{}/{}/avvento_local.py".format(settings.BACKUPS_DIRECTORY, destination),
-                )
-                scp.get(
-                    "{}/avvento_project/avvento/avvento/settings/production.py".format(settings.DROPLET1_WEB_DIRECTORY),
-                    "{}/{}/avvento_production.py".format(settings.BACKUPS_DIRECTORY, destination),
-                )
-                scp.get(
-                    "{}/avvento_project/avvento/avvento/db.sqlite3".format(settings.DROPLET1_WEB_DIRECTORY),
-                    "{}/{}/avvento_db.sqlite3".format(settings.BACKUPS_DIRECTORY, destination),
-                )
+# database dumps streamed from the remote during the run (see DROPLET1_DUMPS)
+def get_dumps(user, destination):
+    if user != settings.DROPLET1_WEBMASTER:
+        return []
 
-                # Apache config files
-                scp.get(
-                    f'/etc/apache2/ports.conf',
-                    f'{settings.BACKUPS_DIRECTORY}/{destination}/ports.conf',
-                )
-                scp.get(
-                    f'/etc/apache2/sites-available/000-default.conf',
-                    f'{settings.BACKUPS_DIRECTORY}/{destination}/000-default.conf',
-                )
-                scp.get(
-                    f'/etc/apache2/sites-available/001-default.conf',
-                    f'{settings.BACKUPS_DIRECTORY}/{destination}/001-default.conf',
-                )
-                scp.get(
-                    f'/etc/apache2/sites-available/002-default.conf',
-                    f'{settings.BACKUPS_DIRECTORY}/{destination}/002-default.conf',
-                )
-                scp.get(
-                    f'/etc/apache2/sites-available/bevendo-backend.conf',
-                    f'{settings.BACKUPS_DIRECTORY}/{destination}/bevendo-backend.conf',
-                )
-                scp.get(
-                    f'/etc/apache2/sites-available/bevendo-frontend.conf',
-                    f'{settings.BACKUPS_DIRECTORY}/{destination}/bevendo-frontend.conf',
-                )
-                scp.get(
-                    f'/etc/apache2/sites-available/three-strikes-website.conf',
-                    f'{settings.BACKUPS_DIRECTORY}/{destination}/three-strikes-website.conf',
+    return [
+        Dump(command, "{}/{}/{}".format(settings.BACKUPS_DIRECTORY, destination, name))
+        for name, command in settings.DROPLET1_DUMPS
+    ]
+
+def create_new_backup(destination, previous=None):
+    # print("creating a new backup...")
+    pool = get_ssh_pool()
+    records = []
+    archive = None
+    if settings.SNAPSHOT_FORMAT == "archive":
+        archive = open_snapshot_archive("{}/{}".format(settings.BACKUPS_DIRECTORY, destination))
+    # an archive can't be reopened, so only directory snapshots are resumable
+    journal = Journal("{}/{}".format(settings.BACKUPS_DIRECTORY, destination)) if archive is None else None
+    # an archive is only mirrored once it's closed
+    tee = None
+    if archive is None and settings.TEE_ON_ARRIVAL:
+        tee = SnapshotTee("{}/{}".format(settings.BACKUPS_DIRECTORY, destination), 'Backup_Droplet1')
+
+    try:
+        for user in settings.DROPLET1_USERS:
+
+            dir = os.path.join(*OS_BACKUPS_PATH, destination, user)
+            if not os.path.exists(dir):
+                os.mkdir(dir)
+
+            with pool.connection(settings.DROPLET1_HOST, settings.DROPLET1_PORT, user) as ssh:
+                # run_transfers(ssh.get_transport(), get_fetches(user, destination), progress=progress)
+                records += run_transfers(
+                    ssh.get_transport(),
+                    get_fetches(user, destination),
+                    root="{}/{}".format(settings.BACKUPS_DIRECTORY, destination),
+                    previous=previous,
+                    workers=settings.TRANSFER_WORKERS,
+                    delta_min_size=settings.DELTA_TRANSFER_MIN_SIZE,
+                    batch_max_size=settings.BATCH_FETCH_MAX_SIZE,
+                    batch_compress=settings.BATCH_FETCH_COMPRESS,
+                    archive=archive,
+                    retries=settings.TRANSFER_RETRIES,
+                    journal=journal,
+                    resume_min_size=settings.RESUME_MIN_SIZE,
+                    tee=tee,
+                    host=settings.DROPLET1_HOST,
                 )
-                scp.get(
-                    f'/etc/apache2/sites-available/whisky-creek-ramblers.conf',
-                    f'{settings.BACKUPS_DIRECTORY}/{destination}/whisky-creek-ramblers.conf',
+                records += run_dumps(
+                    ssh.get_transport(),
+                    get_dumps(user, destination),
+                    root="{}/{}".format(settings.BACKUPS_DIRECTORY, destination),
+                    archive=archive,
+                    journal=journal,
+                    tee=tee,
+                    host=settings.DROPLET1_HOST,
                 )
+    except BaseException:
+        if tee is not None:
+            tee.abort()
+        raise
+    finally:
+        if journal is not None:
+            journal.close()
+        if tee is not None:
+            for target, error in tee.close().items():
+                logger.warning(f"files not mirrored to {target} on arrival: {error}")
+
+    if archive is not None:
+        archive.close()
+        remove_empty_directories("{}/{}".format(settings.BACKUPS_DIRECTORY, destination))
+    write_manifest("{}/{}".format(settings.BACKUPS_DIRECTORY, destination), records)
+    catalog_snapshot("{}/{}".format(settings.BACKUPS_DIRECTORY, destination), records)
+    if journal is not None:
+        journal.complete()
     # print("done")
+    return records
+
+# check every file in the new snapshot against a checksum taken on the remote
+def verify_backup(destination):
+    if not settings.VERIFY_BACKUPS:
+        return []
+
+    pool = get_ssh_pool()
+    root = "{}/{}".format(settings.BACKUPS_DIRECTORY, destination)
+    records = list(load_manifest(root).values())
+    mismatches = []
+    for user in settings.DROPLET1_USERS:
+        user_records = [record for record in records if record["user"] == user]
+        with pool.connection(settings.DROPLET1_HOST, settings.DROPLET1_PORT, user) as ssh:
+            with disk_io():
+                mismatches += verify_snapshot(
+                    ssh.get_transport(),
+                    root,
+                    user_records,
+                    workers=settings.TRANSFER_WORKERS,
+                )
+
+    for path, problem in mismatches:
+        logger.error("verify {}: {} {}".format(destination, path, problem))
+    logger.debug("verified {} files in {}, {} mismatches".format(len(records), destination, len(mismatches)))
+    return ["{} {}".format(path, problem) for path, problem in mismatches]
 
 def copy_backup_to_dropbox(destination):
     # print("copying backup to dropbox...")
-    shutil.copytree(
-        src="{}/{}".format(settings.BACKUPS_DIRECTORY, destination),
-        dst="{}/{}".format(settings.DROPBOX_BACKUPS_DIRECTORY, destination),
-    )
+    # files teed on arrival are already there, so this mostly compares
+    # sizes and mtimes
+    with disk_io():
+        mirrored, errors = mirror_to_destinations(
+            "{}/{}".format(settings.BACKUPS_DIRECTORY, destination),
+            'Backup_Droplet1',
+        )
+    for directory, copied, removed in mirrored:
+        logger.debug("mirrored {} to {}, {} files copied, {} removed".format(destination, directory, copied, removed))
     # print("done")
+    return errors
+
+def link_previous_backup(previous, destination):
+    if previous is None:
+        logger.debug("no previous backup to link against")
+        return
+
+    logger.debug(f"linking unchanged files against previous backup {previous}")
+    with disk_io():
+        linked = link_unchanged_files(
+            previous,
+            f"{settings.BACKUPS_DIRECTORY}/{destination}",
+        )
+    logger.debug(f"hard-linked {linked} unchanged files from {previous}")
+
+def prune_previous_backups(destination):
+    removed = prune_snapshots(
+        settings.BACKUPS_DIRECTORY,
+        'Backup_Droplet1',
+        settings.RETENTION,
+        keep=destination,
+    )
+    logger.debug(f"pruned previous backups {removed}")
+
+def store_previous_backups(destination):
+    with disk_io():
+        stored = store_snapshots(settings.BACKUPS_DIRECTORY, 'Backup_Droplet1', keep=destination)
+    logger.debug(f"moved previous backups {stored} into the chunk store")
 
 def delete_local_archive():
     # print("removing local archive...")
-    shutil.rmtree("{}/archive-droplet1".format(settings.BACKUPS_DIRECTORY))
-    # print("done")
-
-def delete_dropbox_archive():
-    # print("removing dropbox archive...")
-    shutil.rmtree("{}/archive-droplet1".format(settings.DROPBOX_BACKUPS_DIRECTORY))
+    move_to_trash("{}/archive-droplet1".format(settings.BACKUPS_DIRECTORY))
     # print("done")
 
 def run():
     errors = []
+    dir_name = None
+    report = RunReport("droplet1", settings.DROPLET1_HOST)
 
     try:
-        archive_current_backup()
-        archive_current_dropbox_backup()
-        dir_name = create_new_directory()
-        create_new_backup(dir_name)
-        copy_backup_to_dropbox(dir_name)
-        delete_local_archive()
-        delete_dropbox_archive()
+        if settings.INCREMENTAL_SNAPSHOTS:
+            # keep the previous snapshot in place as the hard-link base
+            resumed = find_resumable_snapshot(settings.BACKUPS_DIRECTORY, 'Backup_Droplet1', settings.RESUME_WINDOW)
+            previous = find_previous_snapshot(settings.BACKUPS_DIRECTORY, 'Backup_Droplet1', exclude=resumed)
+            dir_name = resumed or create_new_directory()
+            if resumed is not None:
+                logger.debug("resuming interrupted backup {}".format(resumed))
+            with report.phase("transfer"):
+                report.add_files(create_new_backup(dir_name, previous))
+            with report.phase("link"):
+                link_previous_backup(previous, dir_name)
+            with report.phase("verify"):
+                errors += verify_backup(dir_name)
+            with report.phase("dropbox"):
+                errors += copy_backup_to_dropbox(dir_name)
+            with report.phase("prune"):
+                prune_previous_backups(dir_name)
+            with report.phase("store"):
+                store_previous_backups(dir_name)
+        else:
+            # an interrupted run's snapshot stays in place to be resumed
+            resumed = find_resumable_snapshot(settings.BACKUPS_DIRECTORY, 'Backup_Droplet1', settings.RESUME_WINDOW)
+            with report.phase("archive"):
+                archive_current_backup(exclude=resumed)
+            # unchanged files are linked from the archived snapshot before it is deleted
+            previous = find_previous_snapshot(
+                "{}/archive-droplet1".format(settings.BACKUPS_DIRECTORY),
+                'Backup_Droplet1',
+            )
+            dir_name = resumed or create_new_directory()
+            if resumed is not None:
+                logger.debug("resuming interrupted backup {}".format(resumed))
+            with report.phase("transfer"):
+                report.add_files(create_new_backup(dir_name, previous))
+            with report.phase("verify"):
+                errors += verify_backup(dir_name)
+            with report.phase("dropbox"):
+                errors += copy_backup_to_dropbox(dir_name)
+            with report.phase("delete_archive"):
+                delete_local_archive()
     except FileNotFoundError as error:
         errors.append("FileNotFoundError: {}".format(error))
     except TypeError as error:
@@ -234,6 +391,8 @@ def run():
         errors.append("NameError: {}".format(error))
     except SCPException as error:
         errors.append("SCPException: {}".format(error))
+    except DumpFailed as error:
+        errors.append("DumpFailed: {}".format(error))
     except:
         errors.append("Unexpected error: {}".format(sys.exc_info()[0]))
 
@@ -254,5 +413,15 @@ def run():
         logger.error(error_message)
 
     # print("finis")
+    report.write(dir_name, errors)
+
+    return {
+        "host": settings.DROPLET1_HOST,
+        "directory": dir_name,
+        "errors": errors,
+        "phases": report.phases,
+    }
 
-run()
\ No newline at end of file
+if __name__ == "__main__":
+    run()
+    wait_for_trash()
@@ -1,21 +1,34 @@
 #!/usr/local/bin/ python3
 
-import os, re, shutil, sys
+import os, re, shlex, shutil, sys, tempfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
 from datetime import datetime
 from simple_settings import settings
 import subprocess
-from common import get_logger
+from common import (
+    get_logger,
+    get_bandwidth_limiter,
+    disk_io,
+    archive_snapshot_tree,
+    tree_records,
+    write_manifest,
+    catalog_snapshot,
+    find_previous_snapshot,
+    find_resumable_snapshot,
+    Journal,
+    prune_snapshots,
+    store_snapshots,
+    move_to_trash,
+    wait_for_trash,
+    RunReport,
+)
 
-logger = get_logger('backup_sandbox.log')
+logger = get_logger('backup_sandbox.log', job='sandbox')
 
 OS_BACKUPS_PATH = settings.BACKUPS_DIRECTORY.split("/")[1:]
 OS_BACKUPS_PATH[0] = "/{}".format(OS_BACKUPS_PATH[0])
 
-RSYNC_ARGS = (
-    "rsync",
-    "-av",
-    "-e", "ssh",
-)
 RSYNC_EXCLUDE_ARGS = (
     "--exclude", "*.pyc",
     "--exclude", "__pycache__",
@@ -33,7 +46,7 @@ ERRORS = []
 def progress(filename, size, sent):
     sys.stdout.write("%s\'s progress: %.2f%%   \r" % (filename, float(sent)/float(size)*100) )
 
-def archive_current_backup():
+def archive_current_backup(exclude=None):
     print("archiving current backup")
     # create archive folders
     dir = os.path.join(*OS_BACKUPS_PATH, "archive-sandbox")
@@ -43,7 +56,7 @@ def archive_current_backup():
     # move old backup folders into archive
     dirs = next( os.walk(settings.BACKUPS_DIRECTORY))[1]
     for d in dirs:
-        if re.match('Backup_Sandbox', d, flags=re.IGNORECASE):
+        if re.match('Backup_Sandbox', d, flags=re.IGNORECASE) and d != exclude:
             shutil.move(
                 "{}/{}".format(settings.BACKUPS_DIRECTORY, d),
                 "{}/archive-sandbox/{}".format(settings.BACKUPS_DIRECTORY, d),
@@ -63,24 +76,85 @@ def create_new_directory():
     print("done")
     return name
 
-def create_new_backup(destination):
-
-    print("creating a new backup...")
-
-    for user in settings.SANDBOX_USERS:
+# hard-link unchanged files against the same directory in the previous snapshot
+def link_dest_args(previous, destination, target):
+    if previous is None:
+        return ()
+    relative = os.path.relpath(target, "{}/{}".format(settings.BACKUPS_DIRECTORY, destination))
+    return ("--link-dest", os.path.normpath(os.path.join(previous, relative)))
+
+# the control socket's path has to fit in a unix socket address, which is
+# 104 bytes on macOS; ssh expands %C to a 40 character hash
+SOCKET_PATH_MAX = 104
+
+# one multiplexed SSH master connection per user; every rsync for that user
+# runs its remote shell over it instead of opening a connection of its own
+@contextmanager
+def ssh_master(user, control_directory):
+    ssh = shlex.split(settings.SANDBOX_SSH_COMMAND)
+    control_path = os.path.join(control_directory, "%C")
+    if len(control_path) - len("%C") + 40 >= SOCKET_PATH_MAX:
+        raise ValueError("ssh ControlPath in {} is too long for a unix socket".format(control_directory))
+    target = "{}@{}".format(user, settings.SANDBOX_HOST)
+    completed_process = subprocess.run([
+        *ssh,
+        "-o", "ControlMaster=yes",
+        "-o", "ControlPath={}".format(control_path),
+        "-o", "ControlPersist=yes",
+        "-f", "-N",
+        target,
+    ])
+    if completed_process.returncode != 0:
+        # rsync still works without the master, one connection per call
+        logger.debug("ssh master for {} exited with code {}".format(target, completed_process.returncode))
 
-        dir = os.path.join(*OS_BACKUPS_PATH, destination, user)
-        if not os.path.exists(dir):
-            os.mkdir(dir)
+    try:
+        yield "{} -o ControlMaster=no -o ControlPath={}".format(settings.SANDBOX_SSH_COMMAND, control_path)
+    finally:
+        subprocess.run(
+            [*ssh, "-o", "ControlPath={}".format(control_path), "-O", "exit", target],
+            stderr=subprocess.DEVNULL,
+        )
 
-        '''
-            backup home directory
-        '''
-        remote_directory = '~/'
-        print('copying directory {}'.format(remote_directory))
-        completed_process = subprocess.run([
-            *RSYNC_ARGS,
-            *RSYNC_EXCLUDE_ARGS,
+def write_filter_file(directory, name, rules):
+    path = os.path.join(directory, name)
+    with open(path, "w") as f:
+        f.write("\n".join(rules) + "\n")
+    return path
+
+# --partial keeps a partly transferred file for the next attempt to build on
+# rsync runs outside the process's bandwidth limiter, so while the limit is in
+# force each of the parallel rsyncs gets an equal share of it
+def bwlimit_args():
+    rate = get_bandwidth_limiter().current_rate()
+    if rate is None:
+        return []
+    return ["--bwlimit={}".format(max(1, rate // 1024 // settings.SANDBOX_RSYNC_WORKERS))]
+
+def run_rsync(label, ssh_command, args):
+    print('copying {}'.format(label))
+    completed_process = subprocess.run([
+        "rsync", "-av", "--partial", "-e", ssh_command, *bwlimit_args(), *RSYNC_EXCLUDE_ARGS, *args,
+    ])
+    message = "{} rysync completed with code {}".format(label, completed_process.returncode)
+    if completed_process.returncode != 0:
+        ERRORS.append( message )
+    print(message)
+    return completed_process.returncode
+
+# the rsync calls for one user as (label, args), run at the same time. The home
+# copy excludes ~/scripts and ~/travel-scripts, which the other calls fetch, so
+# no two calls write the same files. /var/www/{travel,travel-dms,poseidon} and
+# /etc/apache2 land in subdirectories of the home copy's target, and would
+# only collide with home directories of the same names
+def get_rsyncs(user, destination, previous, filter_directory):
+    target = "{}/{}/{}".format(settings.BACKUPS_DIRECTORY, destination, user)
+    remote = "{}@{}:".format(user, settings.SANDBOX_HOST)
+
+    return [
+        # backup home directory
+        ('~/', [
+            *link_dest_args(previous, destination, target),
             "--exclude", ".cache",
             "--exclude", ".nvm",
             "--exclude", ".gradle",
@@ -95,132 +169,157 @@ def create_new_backup(destination):
             "--exclude", "smoketest",           # .git repo
             "--exclude", "travel-scripts",      # .git repo
             "--exclude", "web-tests-accessory", # .git repo
+            "--exclude", "/scripts",            # its own rsync below
             "--exclude", "DevOps",
             "--exclude", "firefly2",
             "--exclude", "puppet",
-            "{}@{}:{}".format(user, settings.SANDBOX_HOST, remote_directory),
-            "{}/{}/{}".format(settings.BACKUPS_DIRECTORY, destination, user),
-        ])
-        message = "{} rysync completed with code {}".format(remote_directory, completed_process.returncode)
-        if completed_process.returncode != 0:
-            ERRORS.append( message )
-        print(message)
-
-        '''
-            backup personal scripts directory
-        '''
-        completed_process = subprocess.run([
-            *RSYNC_ARGS,
-            *RSYNC_EXCLUDE_ARGS,
-            "{}@{}:~/scripts".format(user, settings.SANDBOX_HOST),
-            "{}/{}/{}/scripts".format(settings.BACKUPS_DIRECTORY, destination, user),
-        ])
-        message = "~/scripts rysync completed with code {}".format(completed_process.returncode)
-        if completed_process.returncode != 0:
-            ERRORS.append( message )
-        print(message)
-
-        '''
-            backup travel-scripts local config files
-
-            formerly: scp hadrob@$HOST:~/travel-scripts/travel/viator/settings/local.py ~/Downloads/$DIRECTORY_NAME/travel-scripts/travel/viator/settings
-        '''
-        completed_process = subprocess.run([
-            *RSYNC_ARGS,
-            *RSYNC_EXCLUDE_ARGS,
-            "--include", "*local*.py",
-            "--include", "*/",
-            "--exclude", "*",
-            "{}@{}:~/travel-scripts".format(user, settings.SANDBOX_HOST),
-            "{}/{}/{}".format(settings.BACKUPS_DIRECTORY, destination, user),
-        ])
-
-        message = "~/travel-scripts rysync completed with code {}".format(completed_process.returncode)
-        if completed_process.returncode != 0:
-            ERRORS.append( message )
-        print(message)
-
-
-        '''
-            backup travel local config files
-        '''
-        completed_process = subprocess.run([
-            *RSYNC_ARGS,
-            *RSYNC_EXCLUDE_ARGS,
-            "--include", "*local*.py",
-            "--include", "*/",
-            "--exclude", "*",
-            "{}@{}:/var/www/travel".format(user, settings.SANDBOX_HOST),
-            "{}/{}/{}".format(settings.BACKUPS_DIRECTORY, destination, user),
-        ])
-
-        message = "/var/www/travel rysync completed with code {}".format(completed_process.returncode)
-        if completed_process.returncode != 0:
-            ERRORS.append( message )
-        print(message)
-
-        '''
-            backup travel-dms local config files
-        '''
-        completed_process = subprocess.run([
-            *RSYNC_ARGS,
-            *RSYNC_EXCLUDE_ARGS,
-            "--include", "*local*.py",
-            "--include", "*/",
-            "--exclude", "*",
-            "{}@{}:/var/www/travel-dms".format(user, settings.SANDBOX_HOST),
-            "{}/{}/{}".format(settings.BACKUPS_DIRECTORY, destination, user),
-        ])
-
-        message = "/var/www/travel-dms rysync completed with code {}".format(completed_process.returncode)
-        if completed_process.returncode != 0:
-            ERRORS.append( message )
-        print(message)
-
-        '''
-            backup poseidon local config files
-        '''
-        completed_process = subprocess.run([
-            *RSYNC_ARGS,
-            *RSYNC_EXCLUDE_ARGS,
-            "--include", "*local*.py",
-            "--include", "*/",
-            "--exclude", "*",
-            "{}@{}:/var/www/poseidon".format(user, settings.SANDBOX_HOST),
-            "{}/{}/{}".format(settings.BACKUPS_DIRECTORY, destination, user),
-        ])
-
-        message = "/var/www/poseidon rysync completed with code {}".format(completed_process.returncode)
-        if completed_process.returncode != 0:
-            ERRORS.append( message )
-        print(message)
-
+            "{}~/".format(remote),
+            target,
+        ]),
+        # backup personal scripts directory
+        ('~/scripts', [
+            *link_dest_args(previous, destination, "{}/scripts".format(target)),
+            "{}~/scripts".format(remote),
+            "{}/scripts".format(target),
+        ]),
+        # local config files of travel-scripts, travel, travel-dms and poseidon,
+        # in one pass over all four source directories
+        #
+        # formerly: scp hadrob@$HOST:~/travel-scripts/travel/viator/settings/local.py ~/Downloads/$DIRECTORY_NAME/travel-scripts/travel/viator/settings
+        ('local config files', [
+            *link_dest_args(previous, destination, target),
+            "--filter", "merge {}".format(write_filter_file(filter_directory, "local-config", (
+                "+ *local*.py",
+                "+ */",
+                "- *",
+            ))),
+            "{}~/travel-scripts".format(remote),
+            "{}/var/www/travel".format(remote),
+            "{}/var/www/travel-dms".format(remote),
+            "{}/var/www/poseidon".format(remote),
+            target,
+        ]),
         # Apache config files
-        completed_process = subprocess.run([
-            *RSYNC_ARGS,
-            *RSYNC_EXCLUDE_ARGS,
-            "--include", "poseidon-django.wsgi",
-            "--include", "poseidon-django-admin.wsgi",
-            "--include", "travel-inject.wsgi",
-            "--include", "travel-dms.wsgi",
-            "--include", "poseidon-django.conf",
-            "--include", "poseidon-django-admin.conf",
-            "--include", "travel-inject.conf",
-            "--include", "travel-dms.conf",
-            "--include", "*/",
-            "--exclude", "*",
-            "{}@{}:/etc/apache2".format(user, settings.SANDBOX_HOST),
-            "{}/{}/{}".format(settings.BACKUPS_DIRECTORY, destination, user),
-        ])
+        ('/etc/apache2', [
+            *link_dest_args(previous, destination, target),
+            "--filter", "merge {}".format(write_filter_file(filter_directory, "apache2", (
+                "+ poseidon-django.wsgi",
+                "+ poseidon-django-admin.wsgi",
+                "+ travel-inject.wsgi",
+                "+ travel-dms.wsgi",
+                "+ poseidon-django.conf",
+                "+ poseidon-django-admin.conf",
+                "+ travel-inject.conf",
+                "+ travel-dms.conf",
+                "+ */",
+                "- *",
+            ))),
+            "{}/etc/apache2".format(remote),
+            target,
+        ]),
+    ]
+
+def create_new_backup(destination, previous=None):
+
+    print("creating a new backup...")
+
+    # rsync calls that finished in an interrupted run of this snapshot are
+    # skipped; an archive is packed from the tree, so it is never resumed
+    journal = None
+    if settings.SNAPSHOT_FORMAT != "archive":
+        journal = Journal("{}/{}".format(settings.BACKUPS_DIRECTORY, destination))
+
+    # under /tmp rather than $TMPDIR, which on macOS is too deep for the
+    # control sockets
+    with tempfile.TemporaryDirectory(prefix="backup-sandbox-", dir="/tmp") as work_directory:
+        with ExitStack() as masters, ThreadPoolExecutor(max_workers=settings.SANDBOX_RSYNC_WORKERS) as executor:
+            futures = []
+            for user in settings.SANDBOX_USERS:
+
+                dir = os.path.join(*OS_BACKUPS_PATH, destination, user)
+                if not os.path.exists(dir):
+                    os.mkdir(dir)
+
+                ssh_command = masters.enter_context(ssh_master(user, work_directory))
+                filter_directory = os.path.join(work_directory, user)
+                os.mkdir(filter_directory)
+                for label, args in get_rsyncs(user, destination, previous, filter_directory):
+                    key = "{}:{}".format(user, label)
+                    if journal is not None and journal.get(key) is not None:
+                        print("skipping {}, copied by the interrupted run".format(label))
+                        continue
+                    futures.append((key, executor.submit(run_rsync, label, ssh_command, args)))
+
+            for key, future in futures:
+                returncode = future.result()
+                if journal is not None and returncode == 0:
+                    journal.add(key, {"returncode": returncode})
+
+    # every call has finished, so the snapshot is complete even if some of
+    # them failed (e.g. code 24 for files that vanished); their errors are in
+    # ERRORS, and only an interrupted run leaves the journal to resume from
+    if journal is not None:
+        journal.complete()
+
+    print("done")
+
+# where each part of a user's snapshot directory was rsynced from; a source
+# directory without a trailing slash lands inside the target as a subdirectory
+def get_sources(user):
+    return (
+        (user, "~", user),
+        ("{}/scripts/scripts".format(user), "~/scripts", user),
+        ("{}/travel-scripts".format(user), "~/travel-scripts", user),
+        ("{}/travel".format(user), "/var/www/travel", user),
+        ("{}/travel-dms".format(user), "/var/www/travel-dms", user),
+        ("{}/poseidon".format(user), "/var/www/poseidon", user),
+        ("{}/apache2".format(user), "/etc/apache2", user),
+    )
+
+def write_backup_manifest(destination, previous=None):
+    print("writing manifest...")
+    root = "{}/{}".format(settings.BACKUPS_DIRECTORY, destination)
+    sources = [source for user in settings.SANDBOX_USERS for source in get_sources(user)]
+    records = tree_records(root, sources, settings.SANDBOX_HOST, previous)
+    write_manifest(root, records)
+    catalog_snapshot(root, records)
+    print("done")
+    return records
+
+# rsync needs a directory tree to write into, so the sandbox snapshot is packed
+# into an archive once all rsync calls are done
+def archive_new_backup(destination):
+    if settings.SNAPSHOT_FORMAT != "archive":
+        return
 
+    print("archiving new backup...")
+    archive_snapshot_tree("{}/{}".format(settings.BACKUPS_DIRECTORY, destination))
+    print("done")
+
+def store_previous_backups(destination):
+    print("moving previous backups into the chunk store...")
+    with disk_io():
+        store_snapshots(settings.BACKUPS_DIRECTORY, 'Backup_Sandbox', keep=destination)
     print("done")
 
 def delete_local_archive():
     print("removing local archive...")
-    shutil.rmtree("{}/archive-sandbox".format(settings.BACKUPS_DIRECTORY))
+    move_to_trash("{}/archive-sandbox".format(settings.BACKUPS_DIRECTORY))
+    print("done")
+
+def prune_previous_backups(destination):
+    print("removing previous backups...")
+    prune_snapshots(
+        settings.BACKUPS_DIRECTORY,
+        'Backup_Sandbox',
+        settings.RETENTION,
+        keep=destination,
+    )
     print("done")
 
 def run():
+    dir_name = None
+    report = RunReport("sandbox", settings.SANDBOX_HOST)
 
     start_date = datetime.now().strftime("%m/%d/%Y %H:%M:%S")
     print("initializing {} backup to local ({})".format(
@@ -229,10 +328,35 @@ def run():
     ))
 
     try:
-        archive_current_backup()
-        dir_name = create_new_directory()
-        create_new_backup(dir_name)
-        delete_local_archive()
+        if settings.INCREMENTAL_SNAPSHOTS:
+            # keep the previous snapshot in place as the rsync --link-dest base
+            resumed = find_resumable_snapshot(settings.BACKUPS_DIRECTORY, 'Backup_Sandbox', settings.RESUME_WINDOW)
+            previous = find_previous_snapshot(settings.BACKUPS_DIRECTORY, 'Backup_Sandbox', exclude=resumed)
+            dir_name = resumed or create_new_directory()
+            with report.phase("transfer"):
+                create_new_backup(dir_name, previous)
+            with report.phase("manifest"):
+                report.add_files(write_backup_manifest(dir_name, previous))
+            with report.phase("compress"):
+                archive_new_backup(dir_name)
+            with report.phase("prune"):
+                prune_previous_backups(dir_name)
+            with report.phase("store"):
+                store_previous_backups(dir_name)
+        else:
+            # an interrupted run's snapshot stays in place to be resumed
+            resumed = find_resumable_snapshot(settings.BACKUPS_DIRECTORY, 'Backup_Sandbox', settings.RESUME_WINDOW)
+            with report.phase("archive"):
+                archive_current_backup(exclude=resumed)
+            dir_name = resumed or create_new_directory()
+            with report.phase("transfer"):
+                create_new_backup(dir_name)
+            with report.phase("manifest"):
+                report.add_files(write_backup_manifest(dir_name))
+            with report.phase("compress"):
+                archive_new_backup(dir_name)
+            with report.phase("delete_archive"):
+                delete_local_archive()
     except TypeError as error:
         message = "TypeError: {}".format(error)
         ERRORS.append(message)
@@ -257,5 +381,15 @@ def run():
         logger.error(error_message)
 
     print("finis")
-
-run()
\ No newline at end of file
+    report.write(dir_name, list(ERRORS))
+
+    return {
+        "host": settings.SANDBOX_HOST,
+        "directory": dir_name,
+        "errors": list(ERRORS),
+        "phases": report.phases,
+    }
+
+if __name__ == "__main__":
+    run()
+    wait_for_trash()
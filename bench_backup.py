@@ -0,0 +1,331 @@
+#!/usr/local/bin/ python3
+
+import argparse, importlib, json, os, random, resource, shutil, subprocess, sys, tempfile, time
+from datetime import datetime
+
+# End-to-end benchmark of the backup jobs against bench_server.py.
+#
+#   python bench_backup.py --jobs droplet1 diskstation --files 2000 --latency 0.02
+#
+# A synthetic home directory is generated for one user, a fresh stand-in
+# server is started for every run, and each run of a job happens in its own
+# process so peak RSS belongs to that run alone. Runs after the first change
+# --change of the files first, which exercises the incremental paths. Results
+# are appended to --results and compared with the last run that used the same
+# parameters; a wall time more than --threshold slower is reported as a
+# regression and makes the exit status non-zero.
+
+BENCH_USER = "bench"
+
+JOBS = {
+    "droplet1": ("backup_droplet1", "Backup_Droplet1", ".ssh"),
+    "diskstation": ("backup_diskstation", "Backup_Diskstation", "hbk/Wordpress Site.hbk"),
+    "sandbox": ("backup_sandbox", "Backup_Sandbox", "projects"),
+}
+
+def get_home(workdir):
+    return os.path.join(workdir, "remote", BENCH_USER)
+
+# sizes are log-uniform between min_size and max_size, so most files are small
+# and a few are large, like a real home directory
+def make_tree(directory, files, min_size, max_size, seed):
+    generator = random.Random(seed)
+    for index in range(files):
+        size = int(min_size * (max_size / min_size) ** generator.random())
+        path = os.path.join(directory, "d{:03d}".format(index // 50), "f{:05d}.bin".format(index))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(generator.randbytes(size))
+
+def make_home(workdir, arguments):
+    home = get_home(workdir)
+    os.makedirs(home, exist_ok=True)
+    os.makedirs(os.path.join(workdir, "backups"), exist_ok=True)
+    os.makedirs(os.path.join(workdir, "dropbox"), exist_ok=True)
+    for name in (".bashrc", ".bash_profile"):
+        with open(os.path.join(home, name), "w") as f:
+            f.write("# {}\n".format(name))
+
+    config = os.path.join(home, "web/bryanhadro_django_project/website/website/config/local.py")
+    os.makedirs(os.path.dirname(config), exist_ok=True)
+    with open(config, "w") as f:
+        f.write("DEBUG = False\n")
+
+    for job in arguments.jobs:
+        make_tree(os.path.join(home, JOBS[job][2]), arguments.files, arguments.min_size, arguments.max_size, arguments.seed)
+
+# rewrite a fraction of the files: half get a block changed in place, half
+# are replaced outright
+def change_tree(directory, fraction, seed):
+    generator = random.Random(seed)
+    for root, dirs, files in os.walk(directory):
+        for filename in sorted(files):
+            if generator.random() >= fraction:
+                continue
+            path = os.path.join(root, filename)
+            size = os.path.getsize(path)
+            if generator.random() < 0.5 and size > 0:
+                with open(path, "r+b") as f:
+                    f.seek(generator.randrange(size))
+                    f.write(generator.randbytes(min(size, 4096)))
+            else:
+                with open(path, "wb") as f:
+                    f.write(generator.randbytes(size))
+
+def tree_size(directory):
+    return sum(
+        os.path.getsize(os.path.join(root, filename))
+        for root, dirs, files in os.walk(directory)
+        for filename in files
+    )
+
+def bench_settings(workdir, port):
+    key = os.path.join(workdir, "key")
+    home = get_home(workdir)
+    return {
+        "BACKUPS_DIRECTORY": os.path.join(workdir, "backups"),
+        "DROPBOX_BACKUPS_DIRECTORY": os.path.join(workdir, "dropbox"),
+        "BACKUP_RESULT_FILE": os.path.join(workdir, "backup_all_result.json"),
+        "SSH_KEY": key,
+        "DROPLET1_HOST": "127.0.0.1",
+        "DROPLET1_PORT": port,
+        "DROPLET1_USERS": (BENCH_USER,),
+        "DROPLET1_WEBMASTER": "",
+        "DISKSTATION_HOST": "127.0.0.1",
+        "DISKSTATION_PORT": port,
+        "DISKSTATION_USERS": (BENCH_USER,),
+        "DISKSTATION_WEBMASTER": BENCH_USER,
+        "DISKSTATION_WORDPRESS_BACKUP_DIRECTORY": os.path.join(home, "hbk"),
+        "DISKSTATION_WEB_DIRECTORY": os.path.join(home, "web"),
+        "SANDBOX_HOST": "127.0.0.1",
+        "SANDBOX_PORT": port,
+        "SANDBOX_USERS": (BENCH_USER,),
+        "SANDBOX_SSH_COMMAND": "ssh -p {} -i {} -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -o LogLevel=ERROR".format(port, key),
+    }
+
+# runs in the child process: one run of one job, reported as JSON on the last
+# line of stdout
+def run_child(arguments):
+    from simple_settings import settings
+    overrides = bench_settings(arguments.workdir, arguments.port)
+    overrides.update(json.loads(arguments.overrides))
+    settings.configure(**overrides)
+
+    module_name, prefix, tree = JOBS[arguments.child]
+    module = importlib.import_module(module_name)
+    from common import find_previous_snapshot, load_manifest, wait_for_trash
+
+    start = time.monotonic()
+    result = module.run()
+    wall_time = time.monotonic() - start
+    wait_for_trash()
+
+    snapshot = find_previous_snapshot(settings.BACKUPS_DIRECTORY, prefix)
+    records = load_manifest(snapshot).values() if snapshot is not None else []
+    statuses = {}
+    for record in records:
+        statuses[record["status"]] = statuses.get(record["status"], 0) + 1
+
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak_rss //= 1024
+
+    print(json.dumps({
+        "wall_time": round(wall_time, 3),
+        "peak_rss_kb": peak_rss,
+        "fetched_bytes": sum(record["size"] for record in records if record["status"] != "linked"),
+        "files": statuses,
+        "errors": result["errors"],
+    }))
+
+def start_server(workdir, latency, stats):
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_server.py"),
+            os.path.join(workdir, "remote"),
+            "--latency", str(latency),
+            "--stats", stats,
+        ],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    return process, int(process.stdout.readline())
+
+def stop_server(process, stats):
+    process.terminate()
+    process.wait()
+    with open(stats) as f:
+        return json.load(f)
+
+def run_job(job, run, workdir, arguments, overrides):
+    stats = os.path.join(workdir, "stats.json")
+    server, port = start_server(workdir, arguments.latency, stats)
+    try:
+        completed = subprocess.run(
+            [
+                sys.executable,
+                os.path.abspath(__file__),
+                "--child", job,
+                "--workdir", workdir,
+                "--port", str(port),
+                "--overrides", json.dumps(overrides),
+                "--settings={}".format(arguments.settings),
+            ],
+            cwd=workdir,
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+    finally:
+        round_trips = stop_server(server, stats)
+
+    lines = completed.stdout.strip().splitlines()
+    if completed.returncode != 0 or len(lines) == 0:
+        raise RuntimeError("{} run {} failed with status {}".format(job, run, completed.returncode))
+
+    result = json.loads(lines[-1])
+    result.update(round_trips)
+    tree_bytes = tree_size(os.path.join(get_home(workdir), JOBS[job][2]))
+    result["throughput_mb_s"] = round(tree_bytes / result["wall_time"] / 1e6, 2)
+    return result
+
+def get_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+def load_results(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+# the last stored result for the same job, run and parameters
+def find_baseline(results, entry):
+    for previous in reversed(results):
+        if all(previous.get(key) == entry[key] for key in ("job", "run", "parameters")):
+            return previous
+    return None
+
+def parse_overrides(values):
+    overrides = {}
+    for value in values:
+        name, _, raw = value.partition("=")
+        try:
+            overrides[name] = json.loads(raw)
+        except ValueError:
+            overrides[name] = raw
+    return overrides
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description="benchmark the backup jobs against a local stand-in server")
+    parser.add_argument("--jobs", nargs="+", choices=sorted(JOBS), default=["droplet1", "diskstation"])
+    parser.add_argument("--files", type=int, default=500, help="files in each job's synthetic tree")
+    parser.add_argument("--min-size", type=int, default=100)
+    parser.add_argument("--max-size", type=int, default=4 * 1024 * 1024)
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds added to every round trip")
+    parser.add_argument("--runs", type=int, default=2, help="runs per job; runs after the first are incremental")
+    parser.add_argument("--change", type=float, default=0.1, help="fraction of files changed between runs")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE", help="override a setting (JSON value)")
+    parser.add_argument("--results", default="bench_results.jsonl")
+    parser.add_argument("--threshold", type=float, default=0.1, help="wall time increase reported as a regression")
+    parser.add_argument("--keep", action="store_true", help="keep the working directory")
+    parser.add_argument("--settings", default="settings_base")
+    # child process options
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--overrides", default="{}", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+def run():
+    arguments = get_arguments()
+    if arguments.child is not None:
+        return run_child(arguments)
+
+    if "sandbox" in arguments.jobs and shutil.which("rsync") is None:
+        print("rsync is not installed, skipping sandbox")
+        arguments.jobs = [job for job in arguments.jobs if job != "sandbox"]
+
+    import paramiko
+    overrides = parse_overrides(arguments.set)
+    parameters = {
+        "files": arguments.files,
+        "min_size": arguments.min_size,
+        "max_size": arguments.max_size,
+        "latency": arguments.latency,
+        "change": arguments.change,
+        "seed": arguments.seed,
+        "settings": arguments.settings,
+        "overrides": overrides,
+    }
+    previous_results = load_results(arguments.results)
+    workdir = tempfile.mkdtemp(prefix="bench-backup-")
+    regressions = []
+
+    try:
+        paramiko.RSAKey.generate(2048).write_private_key_file(os.path.join(workdir, "key"))
+        make_home(workdir, arguments)
+
+        entries = []
+        for run in range(arguments.runs):
+            if run > 0:
+                for job in arguments.jobs:
+                    change_tree(os.path.join(get_home(workdir), JOBS[job][2]), arguments.change, arguments.seed + run)
+
+            for job in arguments.jobs:
+                entry = {
+                    "date": datetime.now().isoformat(),
+                    "commit": get_commit(),
+                    "job": job,
+                    "run": run,
+                    "parameters": parameters,
+                }
+                entry.update(run_job(job, run, workdir, arguments, overrides))
+                entries.append(entry)
+
+                baseline = find_baseline(previous_results, entry)
+                change = ""
+                if baseline is not None:
+                    ratio = entry["wall_time"] / baseline["wall_time"] - 1
+                    change = " ({:+.1%} vs {})".format(ratio, baseline["commit"])
+                    if ratio > arguments.threshold:
+                        regressions.append("{} run {}".format(job, run))
+                        change += " REGRESSION"
+
+                print("{} run {}: {:.3f}s{}, {} MB/s, {} round trips, peak RSS {} KB, {} errors".format(
+                    job,
+                    run,
+                    entry["wall_time"],
+                    change,
+                    entry["throughput_mb_s"],
+                    entry["round_trips"],
+                    entry["peak_rss_kb"],
+                    len(entry["errors"]),
+                ))
+                for error in entry["errors"]:
+                    print("    {}".format(error))
+
+        with open(arguments.results, "a") as f:
+            for entry in entries:
+                f.write(json.dumps(entry, sort_keys=True) + "\n")
+    finally:
+        if arguments.keep:
+            print("working directory kept at {}".format(workdir))
+        else:
+            shutil.rmtree(workdir)
+
+    if len(regressions) > 0:
+        print("regressions: {}".format(", ".join(regressions)))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    run()
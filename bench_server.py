@@ -0,0 +1,265 @@
+#!/usr/local/bin/ python3
+
+import argparse, json, os, signal, socket, subprocess, sys, threading, time
+import paramiko
+from paramiko import (
+    AUTH_SUCCESSFUL,
+    OPEN_SUCCEEDED,
+    SFTP_OK,
+    SFTPAttributes,
+    SFTPHandle,
+    SFTPServer,
+    SFTPServerInterface,
+    ServerInterface,
+)
+
+# Stand-in SSH server for benchmarks. Every user is logged in to <root>/<user>
+# as their home directory. Exec requests (scp, tar, rsync --server, the delta
+# helper, sha256sum) run through the local bash, and SFTP is served from the
+# local filesystem, with relative paths resolved against that home. Each
+# connection, exec and SFTP request waits `latency` seconds first, to stand in
+# for a round trip to a remote host. Any key or password is accepted.
+
+class BenchStats:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {"connections": 0, "execs": 0, "sftp_requests": 0}
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def round_trips(self):
+        with self.lock:
+            return dict(self.counts, round_trips=sum(self.counts.values()))
+
+class BenchServerInterface(ServerInterface):
+
+    def __init__(self, bench):
+        self.bench = bench
+        self.username = None
+
+    def get_allowed_auths(self, username):
+        return "publickey,password"
+
+    def check_auth_publickey(self, username, key):
+        self.username = username
+        return AUTH_SUCCESSFUL
+
+    def check_auth_password(self, username, password):
+        self.username = username
+        return AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        self.bench.stats.count("execs")
+        threading.Thread(
+            target=self.bench.run_exec,
+            args=(channel, self.bench.get_home(self.username), command.decode()),
+            daemon=True,
+        ).start()
+        return True
+
+class BenchHandle(SFTPHandle):
+
+    def stat(self):
+        return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+class BenchSFTPServer(SFTPServerInterface):
+
+    def __init__(self, server, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.bench = server.bench
+        self.home = server.bench.get_home(server.username)
+
+    def request(self):
+        self.bench.stats.count("sftp_requests")
+        time.sleep(self.bench.latency)
+
+    def resolve(self, path):
+        if path in ("", "."):
+            return self.home
+        return os.path.join(self.home, path)
+
+    def canonicalize(self, path):
+        return path
+
+    def list_folder(self, path):
+        self.request()
+        try:
+            entries = []
+            for filename in os.listdir(self.resolve(path)):
+                attr = SFTPAttributes.from_stat(os.stat(os.path.join(self.resolve(path), filename)))
+                attr.filename = filename
+                entries.append(attr)
+            return entries
+        except OSError as error:
+            return SFTPServer.convert_errno(error.errno)
+
+    def stat(self, path):
+        self.request()
+        try:
+            return SFTPAttributes.from_stat(os.stat(self.resolve(path)))
+        except OSError as error:
+            return SFTPServer.convert_errno(error.errno)
+
+    def lstat(self, path):
+        self.request()
+        try:
+            return SFTPAttributes.from_stat(os.lstat(self.resolve(path)))
+        except OSError as error:
+            return SFTPServer.convert_errno(error.errno)
+
+    def open(self, path, flags, attr):
+        self.request()
+        try:
+            fd = os.open(self.resolve(path), flags, 0o644)
+        except OSError as error:
+            return SFTPServer.convert_errno(error.errno)
+
+        if flags & os.O_WRONLY:
+            mode = "ab" if flags & os.O_APPEND else "wb"
+        elif flags & os.O_RDWR:
+            mode = "a+b" if flags & os.O_APPEND else "r+b"
+        else:
+            mode = "rb"
+        f = os.fdopen(fd, mode)
+        handle = BenchHandle(flags)
+        handle.filename = self.resolve(path)
+        handle.readfile = f
+        handle.writefile = f
+        return handle
+
+    def remove(self, path):
+        self.request()
+        os.remove(self.resolve(path))
+        return SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        self.request()
+        os.replace(self.resolve(oldpath), self.resolve(newpath))
+        return SFTP_OK
+
+    def mkdir(self, path, attr):
+        self.request()
+        os.mkdir(self.resolve(path))
+        return SFTP_OK
+
+    def chattr(self, path, attr):
+        self.request()
+        if attr.st_mode is not None:
+            os.chmod(self.resolve(path), attr.st_mode & 0o7777)
+        if attr.st_atime is not None and attr.st_mtime is not None:
+            os.utime(self.resolve(path), (attr.st_atime, attr.st_mtime))
+        return SFTP_OK
+
+class BenchServer:
+
+    def __init__(self, root, latency=0.0):
+        self.root = os.path.abspath(root)
+        self.latency = latency
+        self.stats = BenchStats()
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.sock = None
+
+    def get_home(self, username):
+        home = os.path.join(self.root, username)
+        os.makedirs(home, exist_ok=True)
+        return home
+
+    # pump the channel through a local bash the way sshd would run the command
+    def run_exec(self, channel, home, command):
+        time.sleep(self.latency)
+        process = subprocess.Popen(
+            ["bash", "-c", command],
+            cwd=home,
+            env=dict(os.environ, HOME=home),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+
+        def pump_stdin():
+            try:
+                for data in iter(lambda: channel.recv(1 << 16), b""):
+                    process.stdin.write(data)
+                    process.stdin.flush()
+            except (OSError, EOFError):
+                pass
+            finally:
+                try:
+                    process.stdin.close()
+                except OSError:
+                    pass
+
+        def pump_stderr():
+            for data in iter(lambda: process.stderr.read1(1 << 16), b""):
+                channel.sendall_stderr(data)
+
+        threads = [
+            threading.Thread(target=pump_stdin, daemon=True),
+            threading.Thread(target=pump_stderr, daemon=True),
+        ]
+        for thread in threads:
+            thread.start()
+        for data in iter(lambda: process.stdout.read1(1 << 16), b""):
+            channel.sendall(data)
+        threads[1].join()
+        channel.send_exit_status(process.wait())
+        channel.close()
+
+    def accept(self):
+        while True:
+            try:
+                client, address = self.sock.accept()
+            except OSError:
+                return
+            self.stats.count("connections")
+            time.sleep(self.latency)
+            transport = paramiko.Transport(client)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler("sftp", SFTPServer, BenchSFTPServer)
+            interface = BenchServerInterface(self)
+            transport.start_server(server=interface)
+
+    def start(self, port=0):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", port))
+        self.sock.listen(64)
+        threading.Thread(target=self.accept, daemon=True).start()
+        return self.sock.getsockname()[1]
+
+    def stop(self):
+        self.sock.close()
+
+# python bench_server.py <root> [--port N] [--latency SECONDS] [--stats FILE]
+# prints the port once listening and writes its counters to --stats on SIGTERM
+def main():
+    parser = argparse.ArgumentParser(description="stand-in SSH/SCP/SFTP server for benchmarks")
+    parser.add_argument("root", help="directory holding one home directory per user")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every round trip")
+    parser.add_argument("--stats", help="file to write request counts to on exit")
+    arguments = parser.parse_args()
+
+    server = BenchServer(arguments.root, latency=arguments.latency)
+    print(server.start(arguments.port), flush=True)
+
+    def stop(signum, frame):
+        server.stop()
+        if arguments.stats is not None:
+            with open(arguments.stats, "w") as f:
+                json.dump(server.stats.round_trips(), f)
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    while True:
+        signal.pause()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+import os, sqlite3
+
+# Local SQLite catalog of the files in every Backup_* snapshot, filled from
+# each run's manifest records. Lookups by snapshot path, content hash or
+# original remote path go through the indexes here instead of walking every
+# snapshot directory on disk.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    name TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    created TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    snapshot TEXT NOT NULL REFERENCES snapshots (name) ON DELETE CASCADE,
+    path TEXT NOT NULL,
+    remote TEXT,
+    host TEXT,
+    user TEXT,
+    size INTEGER,
+    mtime INTEGER,
+    mode INTEGER,
+    sha256 TEXT,
+    status TEXT,
+    PRIMARY KEY (snapshot, path)
+);
+CREATE INDEX IF NOT EXISTS files_path ON files (path);
+CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256);
+CREATE INDEX IF NOT EXISTS files_remote ON files (host, remote);
+"""
+
+FILE_COLUMNS = ("path", "remote", "host", "user", "size", "mtime", "mode", "sha256", "status")
+
+# WHERE clauses and values for files matching all of the given columns
+def get_column_clauses(columns):
+    clauses = []
+    values = []
+    for column, value in columns.items():
+        if column not in FILE_COLUMNS:
+            raise ValueError("unknown catalog column {}".format(column))
+        clauses.append("files.{} = ?".format(column))
+        values.append(value)
+    return clauses, values
+
+class Catalog:
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, timeout=30)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self.connection.executescript(SCHEMA)
+        # catalogs written before the status column was added
+        columns = [row["name"] for row in self.connection.execute("PRAGMA table_info(files)")]
+        if "status" not in columns:
+            self.connection.execute("ALTER TABLE files ADD COLUMN status TEXT")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    # replace everything known about a snapshot with its manifest records
+    def add_snapshot(self, directory, records):
+        name = os.path.basename(os.path.normpath(directory))
+        with self.connection:
+            self.connection.execute("DELETE FROM snapshots WHERE name = ?", (name,))
+            self.connection.execute(
+                "INSERT INTO snapshots (name, directory, created) VALUES (?, ?, ?)",
+                (name, os.path.abspath(directory), name.rsplit("_", 1)[1]),
+            )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO files (snapshot, {}) VALUES (?, {})".format(
+                    ", ".join(FILE_COLUMNS),
+                    ", ".join("?" for column in FILE_COLUMNS),
+                ),
+                [(name, *(record.get(column) for column in FILE_COLUMNS)) for record in records],
+            )
+
+    # drop snapshots that were pruned, archived or deleted by hand
+    def forget_missing(self):
+        forgotten = [
+            row["name"]
+            for row in self.connection.execute("SELECT name, directory FROM snapshots")
+            if not os.path.isdir(row["directory"])
+        ]
+        with self.connection:
+            self.connection.executemany("DELETE FROM snapshots WHERE name = ?", [(name,) for name in forgotten])
+        return forgotten
+
+    # files matching all of the given columns, newest snapshot first; created
+    # bounds are snapshot timestamps (YYYYmmddHHMMSS). remote_pattern is a
+    # glob as fnmatch reads it, or a directory whose files all match.
+    def find(self, created_before=None, created_after=None, snapshot=None, remote_pattern=None, **columns):
+        clauses, values = get_column_clauses(columns)
+        if snapshot is not None:
+            clauses.append("files.snapshot = ?")
+            values.append(snapshot)
+        if remote_pattern is not None:
+            # sqlite's GLOB negates a character class with ^ where fnmatch uses !
+            directory = remote_pattern.rstrip("/") + "/"
+            clauses.append("(files.remote GLOB ? OR substr(files.remote, 1, ?) = ?)")
+            values += [remote_pattern.replace("[!", "[^"), len(directory), directory]
+        if created_before is not None:
+            clauses.append("snapshots.created <= ?")
+            values.append(created_before)
+        if created_after is not None:
+            clauses.append("snapshots.created >= ?")
+            values.append(created_after)
+
+        rows = self.connection.execute(
+            "SELECT files.*, snapshots.directory, snapshots.created FROM files"
+            " JOIN snapshots ON snapshots.name = files.snapshot"
+            " {} ORDER BY snapshots.created DESC, files.path".format(
+                "WHERE " + " AND ".join(clauses) if len(clauses) > 0 else "",
+            ),
+            values,
+        )
+        return [dict(row) for row in rows]
+
+    # name of the newest snapshot taken at or before created_before that has
+    # files matching all of the given columns
+    def latest_snapshot(self, created_before=None, **columns):
+        clauses, values = get_column_clauses(columns)
+        query = "SELECT name FROM snapshots WHERE EXISTS (SELECT 1 FROM files WHERE {})".format(
+            " AND ".join(["files.snapshot = snapshots.name", *clauses]),
+        )
+        if created_before is not None:
+            query += " AND snapshots.created <= ?"
+            values.append(created_before)
+
+        row = self.connection.execute(query + " ORDER BY snapshots.created DESC LIMIT 1", values).fetchone()
+        return row["name"] if row is not None else None
+
+    def snapshots(self):
+        rows = self.connection.execute("SELECT * FROM snapshots ORDER BY created")
+        return [dict(row) for row in rows]
@@ -0,0 +1,381 @@
+import fcntl, hashlib, os, sqlite3, stat, zlib
+from contextlib import contextmanager
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Content-addressed store shared by every host and snapshot. Files are split
+# into content-defined chunks with a gear rolling hash (FastCDC style), so an
+# edit only changes the chunks around it and identical runs of bytes line up
+# again after it. Each unique chunk is compressed once and appended to a pack
+# file. A SQLite index maps chunk digests to their place in the packs, and
+# records every stored file as a recipe: its chunk digests in order.
+#
+#   <store>/index.sqlite3
+#   <store>/packs/00000001.pack
+
+MIN_CHUNK = 16 * 1024
+AVERAGE_CHUNK = 64 * 1024
+MAX_CHUNK = 256 * 1024
+PACK_SIZE = 64 * 1024 * 1024
+DIGEST_SIZE = 32
+
+MASK64 = (1 << 64) - 1
+# normalized chunking: cuts are harder to find before the average size and
+# easier after it, which keeps most chunks close to the average
+MASK_SMALL = ((1 << 18) - 1) << 46
+MASK_LARGE = ((1 << 14) - 1) << 50
+GEAR = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:8], "big") for i in range(256)]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chunks (
+    digest BLOB PRIMARY KEY,
+    pack INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    codec TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS snapshots (
+    name TEXT PRIMARY KEY,
+    directory TEXT,
+    created TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    snapshot TEXT NOT NULL REFERENCES snapshots (name) ON DELETE CASCADE,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    mode INTEGER NOT NULL,
+    sha256 TEXT,
+    link TEXT,
+    recipe BLOB,
+    PRIMARY KEY (snapshot, path)
+);
+CREATE INDEX IF NOT EXISTS chunks_pack ON chunks (pack);
+CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256);
+"""
+
+# end of the first chunk in data[start:end]
+def find_cut(data, start, end):
+    size = end - start
+    if size <= MIN_CHUNK:
+        return end
+    normal = start + min(size, AVERAGE_CHUNK)
+    limit = start + min(size, MAX_CHUNK)
+
+    # the hash only covers the last 64 bytes, so the first MIN_CHUNK are skipped
+    gear = GEAR
+    h = 0
+    i = start + MIN_CHUNK
+    for byte in data[i:normal]:
+        h = ((h << 1) + gear[byte]) & MASK64
+        i += 1
+        if not h & MASK_SMALL:
+            return i
+    for byte in data[i:limit]:
+        h = ((h << 1) + gear[byte]) & MASK64
+        i += 1
+        if not h & MASK_LARGE:
+            return i
+    return limit
+
+# the chunks of a file object, in order
+def split_chunks(f, read_size=4 * 1024 * 1024):
+    buffer = b""
+    eof = False
+    while True:
+        if not eof:
+            data = f.read(read_size)
+            eof = len(data) == 0
+            buffer += data
+
+        position = 0
+        while len(buffer) - position >= MAX_CHUNK or (eof and position < len(buffer)):
+            cut = find_cut(buffer, position, len(buffer))
+            yield buffer[position:cut]
+            position = cut
+        buffer = buffer[position:]
+
+        if eof:
+            return
+
+def compress(data, level=None):
+    if zstandard is not None:
+        return "zstd", zstandard.ZstdCompressor(level=level or 3).compress(data)
+    return "zlib", zlib.compress(data, level or 6)
+
+def decompress(codec, data):
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstandard is not installed, can't read zstd chunks")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+class ChunkStore:
+
+    def __init__(self, path, pack_size=PACK_SIZE, level=None):
+        self.path = path
+        self.pack_size = pack_size
+        self.level = level
+        os.makedirs(os.path.join(path, "packs"), exist_ok=True)
+        self.connection = sqlite3.connect(os.path.join(path, "index.sqlite3"), timeout=30)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self.connection.executescript(SCHEMA)
+        self.pack = None
+        self.pack_number = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.close_pack()
+        self.connection.close()
+
+    def pack_path(self, number):
+        return os.path.join(self.path, "packs", "{:08d}.pack".format(number))
+
+    def pack_numbers(self):
+        return sorted(int(name.split(".")[0]) for name in os.listdir(os.path.join(self.path, "packs")) if name.endswith(".pack"))
+
+    # packs are append-only and shared by every job in the process (and any
+    # other process), so writers take turns on an exclusive lock
+    @contextmanager
+    def writing(self):
+        with open(os.path.join(self.path, "lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with self.connection:
+                    yield
+                    # chunk data is on disk before the index that points at it
+                    if self.pack is not None:
+                        self.pack.flush()
+                        os.fsync(self.pack.fileno())
+            finally:
+                self.close_pack()
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def close_pack(self):
+        if self.pack is not None:
+            self.pack.close()
+            self.pack = None
+
+    # the pack to append `size` bytes to, numbered above `after`
+    def open_pack(self, size, after=0):
+        if self.pack is not None and self.pack.tell() + size > self.pack_size:
+            self.pack.flush()
+            os.fsync(self.pack.fileno())
+            self.close_pack()
+        if self.pack is None:
+            numbers = self.pack_numbers()
+            number = max(numbers[-1] if len(numbers) > 0 else 1, after + 1)
+            if os.path.exists(self.pack_path(number)) and os.path.getsize(self.pack_path(number)) + size > self.pack_size:
+                number += 1
+            self.pack = open(self.pack_path(number), "ab")
+            self.pack_number = number
+        return self.pack
+
+    # store a chunk unless it's already known; returns the bytes written
+    def add_chunk(self, data):
+        digest = hashlib.sha256(data).digest()
+        known = self.connection.execute("SELECT 1 FROM chunks WHERE digest = ?", (digest,)).fetchone()
+        if known is not None:
+            return digest, 0
+
+        codec, compressed = compress(data, self.level)
+        pack = self.open_pack(len(compressed))
+        offset = pack.tell()
+        pack.write(compressed)
+        self.connection.execute(
+            "INSERT INTO chunks (digest, pack, offset, length, size, codec) VALUES (?, ?, ?, ?, ?, ?)",
+            (digest, self.pack_number, offset, len(compressed), len(data), codec),
+        )
+        return digest, len(compressed)
+
+    # the chunks of a file already in the store with this content, or None
+    def find_recipe(self, sha256, size):
+        row = self.connection.execute(
+            "SELECT recipe FROM files WHERE sha256 = ? AND size = ? AND recipe IS NOT NULL LIMIT 1",
+            (sha256, size),
+        ).fetchone()
+        return row["recipe"] if row is not None else None
+
+    # sha256, when the caller already knows the file's digest (from the
+    # snapshot manifest), lets content the store holds be added without
+    # reading and chunking the file again
+    def add_file(self, snapshot, name, path, sha256=None):
+        attr = os.lstat(path)
+        link = None
+        recipe = None
+        written = 0
+        if stat.S_ISLNK(attr.st_mode):
+            link = os.readlink(path)
+            sha256 = None
+        elif sha256 is not None:
+            recipe = self.find_recipe(sha256, attr.st_size)
+
+        if link is None and recipe is None:
+            whole = hashlib.sha256()
+            digests = []
+            with open(path, "rb") as f:
+                for chunk in split_chunks(f):
+                    whole.update(chunk)
+                    digest, length = self.add_chunk(chunk)
+                    digests.append(digest)
+                    written += length
+            recipe = b"".join(digests)
+            sha256 = whole.hexdigest()
+
+        self.connection.execute(
+            "INSERT OR REPLACE INTO files (snapshot, path, size, mtime, mode, sha256, link, recipe)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (snapshot, name, attr.st_size, int(attr.st_mtime), attr.st_mode, sha256, link, recipe),
+        )
+        return written
+
+    # store every file under root as a snapshot; directory is where the
+    # snapshot lives outside the store, if anywhere. digests maps relative
+    # paths to known sha256s. Returns the number of files and the compressed
+    # bytes of the chunks that were new.
+    def add_snapshot(self, name, root, directory=None, exclude=(), digests=None):
+        files = 0
+        written = 0
+        with self.writing():
+            self.connection.execute("DELETE FROM snapshots WHERE name = ?", (name,))
+            self.connection.execute(
+                "INSERT INTO snapshots (name, directory, created) VALUES (?, ?, ?)",
+                (name, os.path.abspath(directory) if directory is not None else None, name.rsplit("_", 1)[1]),
+            )
+            for parent, dirs, filenames in os.walk(root):
+                dirs.sort()
+                for filename in sorted(filenames):
+                    path = os.path.join(parent, filename)
+                    relative = os.path.relpath(path, root)
+                    if relative in exclude:
+                        continue
+                    written += self.add_file(name, relative, path, (digests or {}).get(relative))
+                    files += 1
+        return files, written
+
+    def snapshots(self):
+        rows = self.connection.execute("SELECT * FROM snapshots ORDER BY created")
+        return [dict(row) for row in rows]
+
+    def files(self, snapshot):
+        rows = self.connection.execute(
+            "SELECT path, size, mtime, mode, sha256, link FROM files WHERE snapshot = ? ORDER BY path",
+            (snapshot,),
+        )
+        return [dict(row) for row in rows]
+
+    def get_file(self, snapshot, path):
+        row = self.connection.execute(
+            "SELECT * FROM files WHERE snapshot = ? AND path = ?",
+            (snapshot, path),
+        ).fetchone()
+        if row is None:
+            raise FileNotFoundError("{} is not in stored snapshot {}".format(path, snapshot))
+        return dict(row)
+
+    # a stored file's contents, one chunk at a time
+    def read_file(self, snapshot, path):
+        recipe = self.get_file(snapshot, path)["recipe"] or b""
+        packs = {}
+        try:
+            for start in range(0, len(recipe), DIGEST_SIZE):
+                chunk = self.connection.execute(
+                    "SELECT * FROM chunks WHERE digest = ?",
+                    (recipe[start:start + DIGEST_SIZE],),
+                ).fetchone()
+                if chunk is None:
+                    raise IOError("chunk store is missing a chunk of {}".format(path))
+                if chunk["pack"] not in packs:
+                    packs[chunk["pack"]] = open(self.pack_path(chunk["pack"]), "rb")
+                pack = packs[chunk["pack"]]
+                pack.seek(chunk["offset"])
+                yield decompress(chunk["codec"], pack.read(chunk["length"]))
+        finally:
+            for pack in packs.values():
+                pack.close()
+
+    # rebuild a stored file at target with its mtime and mode
+    def extract(self, snapshot, path, target):
+        entry = self.get_file(snapshot, path)
+        if entry["link"] is not None:
+            os.symlink(entry["link"], target)
+            return
+        whole = hashlib.sha256()
+        with open(target, "wb") as f:
+            for data in self.read_file(snapshot, path):
+                whole.update(data)
+                f.write(data)
+        if whole.hexdigest() != entry["sha256"]:
+            raise IOError("{} in stored snapshot {} does not match its digest".format(path, snapshot))
+        os.utime(target, (entry["mtime"], entry["mtime"]))
+        os.chmod(target, stat.S_IMODE(entry["mode"]))
+
+    def remove_snapshot(self, name):
+        with self.connection:
+            self.connection.execute("DELETE FROM snapshots WHERE name = ?", (name,))
+
+    # drop snapshots whose directory outside the store was pruned or deleted
+    def forget_missing(self):
+        forgotten = [
+            row["name"]
+            for row in self.connection.execute("SELECT name, directory FROM snapshots")
+            if row["directory"] is not None and not os.path.isdir(row["directory"])
+        ]
+        for name in forgotten:
+            self.remove_snapshot(name)
+        return forgotten
+
+    # drop chunks no recipe refers to any more, and rewrite packs that are at
+    # least `threshold` garbage. Returns the bytes reclaimed.
+    def compact(self, threshold=0.5):
+        removed = []
+        reclaimed = 0
+        with self.writing():
+            live = set()
+            for row in self.connection.execute("SELECT recipe FROM files WHERE recipe IS NOT NULL"):
+                recipe = row["recipe"]
+                live.update(recipe[start:start + DIGEST_SIZE] for start in range(0, len(recipe), DIGEST_SIZE))
+
+            numbers = self.pack_numbers()
+            for number in numbers:
+                path = self.pack_path(number)
+                chunks = self.connection.execute("SELECT * FROM chunks WHERE pack = ? ORDER BY offset", (number,)).fetchall()
+                kept = [chunk for chunk in chunks if chunk["digest"] in live]
+                size = os.path.getsize(path)
+                garbage = size - sum(chunk["length"] for chunk in kept)
+                if size == 0 or garbage / size < threshold:
+                    continue
+
+                self.connection.executemany(
+                    "DELETE FROM chunks WHERE digest = ?",
+                    [(chunk["digest"],) for chunk in chunks if chunk["digest"] not in live],
+                )
+                # live chunks move to packs after every existing one
+                with open(path, "rb") as source:
+                    for chunk in kept:
+                        source.seek(chunk["offset"])
+                        data = source.read(chunk["length"])
+                        pack = self.open_pack(len(data), after=numbers[-1])
+                        self.connection.execute(
+                            "UPDATE chunks SET pack = ?, offset = ? WHERE digest = ?",
+                            (self.pack_number, pack.tell(), chunk["digest"]),
+                        )
+                        pack.write(data)
+                removed.append(path)
+                reclaimed += garbage
+
+        # old packs go once the index no longer points into them
+        for path in removed:
+            os.remove(path)
+        return reclaimed
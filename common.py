@@ -1,31 +1,1845 @@
+import atexit, contextvars, fcntl, filecmp, gzip, hashlib, json, mmap, os, queue, re, shlex, shutil, sqlite3, stat, sys, tarfile, threading, time, uuid
 import logging
-from logging.handlers import RotatingFileHandler
-
-def get_logger(log_file):
-    
-    # legacy
-    # logging.basicConfig(
-    #     filename='backup_droplet1.log',
-    #     level=logging.DEBUG,
-    #     datefmt="%m-%d-%Y %H:%M:%S",
-    #     format='%(asctime)s %(levelname)-8s %(message)s',
-    # )
-
-    # setup logger
-    log_formatter = logging.Formatter('%(asctime)s %(levelname)-8s %(message)s')
-    handler = RotatingFileHandler(
-        log_file,
-        mode='a',
-        maxBytes=5*1024*1024,  # 5MB
-        backupCount=2,
-        encoding=None,
-        delay=0,
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from simple_settings import settings
+import paramiko
+from scp import SCPClient, SCPException
+from catalog import Catalog
+from chunkstore import ChunkStore
+from delta_transfer import DeltaUnavailable, fetch_delta
+from sqlite_transfer import SqliteUnavailable, fetch_sqlite
+from snapshot_archive import SnapshotArchive, find_archive, get_archive_name, hash_member, load_index
+
+# Logging runs through one queue: loggers on the calling threads only put
+# records on it, and a single QueueListener thread formats and writes them, so
+# a transfer thread never waits on disk for a log line. Handlers are set up
+# once per process. Each record carries the run/job/host/phase context of the
+# thread that logged it, which also decides the file it goes to: a script's
+# own lines go to its log file, and lines from this module go to the file of
+# the job they were logged for.
+logger = logging.getLogger('backups.common')
+
+_log_context = contextvars.ContextVar("log_context", default={})
+_log_queue = queue.SimpleQueue()
+_log_listener = None
+_log_files = {}
+_log_jobs = set()
+_log_has_jobless_file = False
+_logging_lock = threading.Lock()
+
+def set_log_context(**fields):
+    _log_context.set({**_log_context.get(), **fields})
+
+@contextmanager
+def log_context(**fields):
+    token = _log_context.set({**_log_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _log_context.reset(token)
+
+# run fn on an executor thread with the caller's log context
+def submit_in_context(executor, fn, *args):
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+LOG_CONTEXT_FIELDS = ("run", "job", "host", "phase")
+
+# copies the logging thread's context onto the record before it is queued
+class ContextFilter(logging.Filter):
+
+    def filter(self, record):
+        context = _log_context.get()
+        for field in LOG_CONTEXT_FIELDS:
+            setattr(record, field, context.get(field))
+        return True
+
+# one JSON object per line: time, level, logger, message, the context fields
+# and any `extra` fields passed to the logging call
+class JSONFormatter(logging.Formatter):
+
+    STANDARD = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+    def format(self, record):
+        event = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in self.STANDARD and value is not None:
+                event[key] = value
+        if record.exc_info:
+            event["exception"] = self.formatException(record.exc_info)
+        return json.dumps(event, default=str)
+
+# a log file takes its own script's records, and records from shared code
+# logged for its job. A file that belongs to no job (backup_all.log) takes
+# shared records of jobs without a log file of their own. Without such a file,
+# shared records logged outside any job go to every file rather than nowhere.
+class RouteFilter(logging.Filter):
+
+    def __init__(self, name, job):
+        super().__init__()
+        self.logger_name = name
+        self.job = job
+
+    def filter(self, record):
+        if record.name == self.logger_name:
+            return True
+        if record.name in _log_files:
+            return False
+        job = getattr(record, "job", None)
+        if job is None and not _log_has_jobless_file:
+            return True
+        return job == self.job or (self.job is None and job not in _log_jobs)
+
+def get_log_formatter():
+    if settings.LOG_FORMAT == "text":
+        return logging.Formatter('%(asctime)s %(levelname)-8s [%(job)s %(phase)s] %(message)s')
+    return JSONFormatter()
+
+def start_logging():
+    global _log_listener
+    if _log_listener is not None:
+        return
+
+    handler = QueueHandler(_log_queue)
+    handler.addFilter(ContextFilter())
+    root = logging.getLogger('backups')
+    root.setLevel(logging.DEBUG)
+    root.propagate = False
+    root.addHandler(handler)
+
+    _log_listener = QueueListener(_log_queue, respect_handler_level=True)
+    _log_listener.start()
+    atexit.register(_log_listener.stop)
+
+# the logger for a script, writing to log_file. job is the RunReport job name
+# whose lines from shared code should land in the same file. Calling it again
+# for the same file returns the same logger without adding a handler.
+def get_logger(log_file, job=None):
+    global _log_has_jobless_file
+    name = 'backups.' + os.path.splitext(os.path.basename(log_file))[0]
+    with _logging_lock:
+        start_logging()
+        if name not in _log_files:
+            handler = RotatingFileHandler(
+                log_file,
+                mode='a',
+                maxBytes=5*1024*1024,  # 5MB
+                backupCount=2,
+                delay=True,
+            )
+            handler.setFormatter(get_log_formatter())
+            handler.setLevel(logging.DEBUG)
+            handler.addFilter(RouteFilter(name, job))
+            _log_files[name] = handler
+            if job is not None:
+                _log_jobs.add(job)
+            else:
+                _log_has_jobless_file = True
+            _log_listener.handlers = tuple(_log_files.values())
+
+    return logging.getLogger(name)
+
+# per-file debug events, such as one line per fetched or archived path, are
+# rate limited: at most LOG_FILE_EVENT_RATE a second, and the next event that
+# gets through reports how many were skipped. Arguments are only formatted for
+# the events that are logged. LOG_FILE_EVENT_RATE = None logs them all, 0 none.
+class EventSampler:
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate or 0
+        self.last = time.monotonic()
+        self.skipped = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        if self.rate is None:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens < 1:
+                self.skipped += 1
+                return None
+            self.tokens -= 1
+            skipped, self.skipped = self.skipped, 0
+            return skipped
+
+_file_event_sampler = None
+
+def file_event(log, message, *args, **fields):
+    global _file_event_sampler
+    if not log.isEnabledFor(logging.DEBUG):
+        return
+    if _file_event_sampler is None:
+        _file_event_sampler = EventSampler(settings.LOG_FILE_EVENT_RATE)
+    skipped = _file_event_sampler.allow()
+    if skipped is None:
+        return
+    log.debug(message, *args, extra=dict(fields, event="file", skipped=skipped or None))
+
+
+SNAPSHOT_TIMESTAMP_FORMAT = "%Y%m%d%H%M%S"
+
+# list Backup_<Host>_<timestamp> directories in a backups directory, oldest first
+def list_snapshots(directory, prefix):
+    if not os.path.isdir(directory):
+        return []
+
+    pattern = re.compile(r'^{}_(\d{{14}})$'.format(re.escape(prefix)), flags=re.IGNORECASE)
+    names = [d for d in next(os.walk(directory))[1] if pattern.match(d)]
+    return sorted(names, key=lambda d: pattern.match(d).group(1))
+
+# most recent snapshot to use as the hard-link base for the next one
+def find_previous_snapshot(directory, prefix, exclude=None):
+    names = [d for d in list_snapshots(directory, prefix) if d != exclude]
+    if len(names) == 0:
+        return None
+    return os.path.join(directory, names[-1])
+
+# replace files in the current snapshot that are identical to the previous
+# snapshot's copy with hard links, so unchanged files take up no new space
+# (rsync --link-dest semantics)
+def link_unchanged_files(previous, current):
+    linked = 0
+    for root, dirs, files in os.walk(current):
+        relative = os.path.relpath(root, current)
+        for name in files:
+            path = os.path.join(root, name)
+            base = os.path.normpath(os.path.join(previous, relative, name))
+            if os.path.islink(path) or not os.path.isfile(base) or os.path.islink(base):
+                continue
+            if os.path.samefile(path, base):
+                continue
+            if not filecmp.cmp(path, base, shallow=False):
+                continue
+
+            tmp = "{}.link-tmp".format(path)
+            os.link(base, tmp)
+            os.replace(tmp, path)
+            linked += 1
+    return linked
+
+def snapshot_time(name):
+    return datetime.strptime(name.rsplit("_", 1)[1], SNAPSHOT_TIMESTAMP_FORMAT)
+
+# generational retention: keep the newest snapshot in each of the last N
+# hours/days/ISO weeks/months, plus the newest snapshot overall
+RETENTION_PERIODS = (
+    ("hourly", "%Y%m%d%H"),
+    ("daily", "%Y%m%d"),
+    ("weekly", "%G%V"),
+    ("monthly", "%Y%m"),
+)
+
+def select_snapshots_to_keep(names, policy):
+    newest_first = sorted(names, key=snapshot_time, reverse=True)
+    keep = set(newest_first[:1])
+
+    for period, bucket_format in RETENTION_PERIODS:
+        count = policy.get(period, 0)
+        buckets = set()
+        for name in newest_first:
+            if len(buckets) >= count:
+                break
+            bucket = snapshot_time(name).strftime(bucket_format)
+            if bucket not in buckets:
+                buckets.add(bucket)
+                keep.add(name)
+    return keep
+
+# move snapshots outside the retention policy to the trash, where the
+# background worker deletes them
+def prune_snapshots(directory, prefix, policy, keep=None):
+    names = list_snapshots(directory, prefix)
+    kept = select_snapshots_to_keep(names, policy)
+    if keep is not None:
+        kept.add(keep)
+
+    removed = []
+    for name in names:
+        if name not in kept:
+            move_to_trash(os.path.join(directory, name))
+            removed.append(name)
+    return removed
+
+
+# append-only record of the finished work in a snapshot that is still being
+# written. A snapshot with a journal is incomplete, and a rerun within the
+# resume window continues into it instead of starting a new one.
+JOURNAL_NAME = ".journal.jsonl"
+
+class Journal:
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, JOURNAL_NAME)
+        self.entries = {}
+        self.lock = threading.Lock()
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # the last line of an interrupted run may be cut short
+                        continue
+                    self.entries[entry["key"]] = entry
+        self.file = open(self.path, "a")
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def add(self, key, entry):
+        entry = dict(entry, key=key)
+        with self.lock:
+            self.entries[key] = entry
+            self.file.write(json.dumps(entry, sort_keys=True) + "\n")
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def complete(self):
+        self.close()
+        os.remove(self.path)
+
+# the newest snapshot, if it was left incomplete less than `window` seconds ago
+def find_resumable_snapshot(directory, prefix, window):
+    if window is None:
+        return None
+
+    names = list_snapshots(directory, prefix)
+    if len(names) == 0 or not os.path.exists(os.path.join(directory, names[-1], JOURNAL_NAME)):
+        return None
+    if (datetime.now() - snapshot_time(names[-1])).total_seconds() > window:
+        return None
+    return names[-1]
+
+
+TRASH_NAME = ".trash"
+
+# deleting a snapshot is a rename into a .trash directory next to it; the
+# actual unlinking happens on a low-priority background thread, throttled to
+# files_per_second, so it stays off the critical path of the run
+class TrashWorker:
+
+    def __init__(self, files_per_second):
+        self.files_per_second = files_per_second
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    # the caller's log context goes with the trash, so errors deleting it are
+    # logged to the file of the job that threw it away
+    def empty(self, trash):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="trash", daemon=True)
+                self.thread.start()
+        self.queue.put((trash, contextvars.copy_context()))
+
+    def wait(self):
+        self.queue.join()
+
+    def run(self):
+        # on Linux a thread's nice value also sets its best-effort I/O priority
+        if sys.platform.startswith("linux"):
+            try:
+                os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+            except OSError:
+                pass
+
+        while True:
+            trash, context = self.queue.get()
+            try:
+                context.run(self.empty_now, trash)
+            finally:
+                self.queue.task_done()
+
+    def empty_now(self, trash):
+        try:
+            self.delete_contents(trash)
+        except OSError as error:
+            logger.error(f"failed to empty trash {trash}: {error}")
+
+    # each entry of the trash is deleted on its own, so one that can't be
+    # removed is logged and left for the next run instead of stopping the rest
+    def delete_contents(self, trash):
+        self.deleted = 0
+        self.window_start = time.monotonic()
+        for name in os.listdir(trash):
+            path = os.path.join(trash, name)
+            try:
+                self.delete_tree(path)
+            except OSError as error:
+                logger.error(f"failed to delete {path} from the trash: {error}")
+
+    def delete_tree(self, path):
+        if os.path.islink(path) or not os.path.isdir(path):
+            self.unlink(path)
+            return
+
+        for root, dirs, files in os.walk(path, topdown=False):
+            for name in files:
+                self.unlink(os.path.join(root, name))
+            for name in dirs:
+                # a symlink to a directory is listed with the directories
+                if os.path.islink(os.path.join(root, name)):
+                    self.unlink(os.path.join(root, name))
+                else:
+                    os.rmdir(os.path.join(root, name))
+        os.rmdir(path)
+
+    def unlink(self, path):
+        os.unlink(path)
+        self.deleted += 1
+        # None or 0 deletes as fast as the disk allows
+        if self.files_per_second and self.deleted % self.files_per_second == 0:
+            elapsed = time.monotonic() - self.window_start
+            if elapsed < 1:
+                time.sleep(1 - elapsed)
+            self.window_start = time.monotonic()
+
+_trash_worker = None
+_trash_lock = threading.Lock()
+
+def get_trash_worker():
+    global _trash_worker
+    with _trash_lock:
+        if _trash_worker is None:
+            _trash_worker = TrashWorker(settings.TRASH_DELETE_RATE)
+    return _trash_worker
+
+def move_to_trash(path):
+    trash = os.path.join(os.path.dirname(path), TRASH_NAME)
+    os.makedirs(trash, exist_ok=True)
+    os.rename(path, os.path.join(trash, "{}-{}".format(os.path.basename(path), uuid.uuid4().hex[:8])))
+    get_trash_worker().empty(trash)
+
+# block until everything moved to the trash so far has been deleted
+def wait_for_trash():
+    if _trash_worker is not None:
+        _trash_worker.wait()
+
+# Linux FICLONE ioctl: share the source's extents instead of copying bytes
+FICLONE = 0x40049409
+
+# copy a file with a reflink or copy_file_range where the filesystem supports
+# them, falling back to a regular copy
+def copy_file_fast(source, target):
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        copied = False
+        if sys.platform.startswith("linux"):
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                copied = True
+            except OSError:
+                pass
+
+        if not copied and hasattr(os, "copy_file_range"):
+            try:
+                while os.copy_file_range(src.fileno(), dst.fileno(), 1 << 30) > 0:
+                    pass
+                copied = True
+            except OSError:
+                src.seek(0)
+                dst.seek(0)
+                dst.truncate()
+
+        if not copied:
+            shutil.copyfileobj(src, dst, 1 << 20)
+    shutil.copystat(source, target)
+
+def is_same_file(source, target):
+    try:
+        source_stat, target_stat = os.stat(source), os.stat(target)
+    except FileNotFoundError:
+        return False
+    return (
+        source_stat.st_size == target_stat.st_size
+        and int(source_stat.st_mtime) == int(target_stat.st_mtime)
+    )
+
+# hidden directory a tee writes a mirrored snapshot into until the run succeeds
+def get_mirror_staging(mirror_directory, name):
+    return os.path.join(mirror_directory, ".{}.partial".format(name))
+
+# the previous mirrored snapshot, or what a tee staged during the run, is
+# renamed to the new snapshot's name, so only what changed has to be written
+# into it. Staging left by other runs that were killed is dropped.
+def prepare_mirror(mirror_directory, prefix, name):
+    target = os.path.join(mirror_directory, name)
+    staging = get_mirror_staging(mirror_directory, name)
+    if not os.path.exists(target) and os.path.isdir(staging):
+        os.rename(staging, target)
+    for d in os.listdir(mirror_directory) if os.path.isdir(mirror_directory) else ():
+        if d.startswith("." + prefix) and d.endswith(".partial"):
+            shutil.rmtree(os.path.join(mirror_directory, d))
+
+    mirrored = [d for d in list_snapshots(mirror_directory, prefix) if d != name]
+    if not os.path.exists(target) and len(mirrored) > 0:
+        os.rename(os.path.join(mirror_directory, mirrored.pop()), target)
+    for d in mirrored:
+        shutil.rmtree(os.path.join(mirror_directory, d))
+    os.makedirs(target, exist_ok=True)
+    return target
+
+# every backups directory a snapshot is mirrored into: the Dropbox folder and
+# any extra destinations such as an external drive
+def get_mirror_directories():
+    return [settings.DROPBOX_BACKUPS_DIRECTORY, *settings.MIRROR_DIRECTORIES]
+
+# mirror a snapshot into every destination. A destination that fails is
+# reported without stopping the others. Returns (directory, copied, removed)
+# for each destination that succeeded and a list of error strings.
+def mirror_to_destinations(source, prefix):
+    mirrored = []
+    errors = []
+    for mirror_directory in get_mirror_directories():
+        try:
+            copied, removed = mirror_snapshot(source, mirror_directory, prefix)
+        except OSError as error:
+            errors.append("mirror to {} failed: {}".format(mirror_directory, error))
+            continue
+        mirrored.append((mirror_directory, copied, removed))
+    return mirrored, errors
+
+# writes each file of a snapshot into the mirror destinations as soon as it
+# arrives, while it's still in the page cache, so the mirror pass at the end
+# of the run only has to compare sizes and mtimes. scp writes straight to its
+# own path, so the copy is taken from the landed file rather than from the
+# stream. Copies go through a .tee-tmp file and a rename. A destination that
+# fails is dropped for the rest of the run and left to that final pass.
+# Files are written into a hidden staging directory that only gets the
+# snapshot's name in the final pass, so a failed run never leaves a half
+# written snapshot in the mirror under the new name.
+class SnapshotTee:
+
+    def __init__(self, root, prefix, workers=2):
+        self.root = root
+        self.destinations = []
+        self.bases = {}
+        self.failed = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.futures = []
+        for mirror_directory in get_mirror_directories():
+            try:
+                self.destinations.append(self.stage(mirror_directory, prefix, os.path.basename(root)))
+            except OSError as error:
+                self.fail(mirror_directory, error)
+
+    # the newest mirrored snapshot, or the staging of a run that failed after
+    # its transfer, is renamed to the staging directory, so only what changed
+    # is written into it
+    def stage(self, mirror_directory, prefix, name):
+        staging = get_mirror_staging(mirror_directory, name)
+        os.makedirs(mirror_directory, exist_ok=True)
+        if not os.path.exists(staging):
+            candidates = [(d, d) for d in list_snapshots(mirror_directory, prefix)]
+            candidates += [
+                (d[1:-len(".partial")], d)
+                for d in os.listdir(mirror_directory)
+                if d.startswith("." + prefix) and d.endswith(".partial")
+            ]
+            if len(candidates) > 0:
+                snapshot, d = max(candidates)
+                os.rename(os.path.join(mirror_directory, d), staging)
+                self.bases[staging] = os.path.join(mirror_directory, snapshot)
+        os.makedirs(staging, exist_ok=True)
+        return staging
+
+    def fail(self, destination, error):
+        with self.lock:
+            if destination not in self.failed:
+                self.failed[destination] = str(error)
+                logger.error(f"writing to {destination} failed, leaving it to the mirror pass: {error}")
+
+    def copy(self, local):
+        if os.path.isdir(local):
+            paths = [os.path.join(directory, filename) for directory, dirs, files in os.walk(local) for filename in files]
+        else:
+            paths = [local]
+
+        for destination in self.destinations:
+            try:
+                for path in paths:
+                    if destination in self.failed:
+                        break
+                    target = os.path.join(destination, os.path.relpath(path, self.root))
+                    if is_same_file(path, target):
+                        continue
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    tmp = "{}.tee-tmp".format(target)
+                    copy_file_fast(path, tmp)
+                    os.replace(tmp, target)
+            except OSError as error:
+                self.fail(destination, error)
+
+    # queue a file (or fetched directory) that has landed in the snapshot
+    def add(self, local):
+        with self.lock:
+            self.futures.append(submit_in_context(self.executor, self.copy, local))
+
+    # wait for queued copies; returns the destinations that failed
+    def close(self):
+        self.executor.shutdown()
+        for future in self.futures:
+            future.result()
+        return dict(self.failed)
+
+    # the run failed: the previous snapshot goes back under its own name, with
+    # whatever was already teed into it, for the next run's mirror pass to
+    # bring in line; staging that started out empty is removed
+    def abort(self):
+        self.executor.shutdown()
+        for staging in self.destinations:
+            base = self.bases.get(staging)
+            try:
+                if base is not None and not os.path.exists(base):
+                    os.rename(staging, base)
+                elif os.path.isdir(staging):
+                    shutil.rmtree(staging)
+            except OSError as error:
+                logger.error(f"could not roll back {staging}: {error}")
+
+# mirror a snapshot into another backups directory (the Dropbox folder) writing
+# only what changed. The most recent mirrored snapshot is renamed to the new
+# snapshot's name, changed files are written to a temp file and renamed over
+# the old copy, and files no longer in the snapshot are removed, so a sync
+# client sees the smallest possible change set.
+def mirror_snapshot(source, mirror_directory, prefix):
+    target = prepare_mirror(mirror_directory, prefix, os.path.basename(source))
+
+    copied = 0
+    for root, dirs, files in os.walk(source):
+        relative = os.path.relpath(root, source)
+        target_root = os.path.normpath(os.path.join(target, relative))
+        os.makedirs(target_root, exist_ok=True)
+        for filename in files:
+            source_path = os.path.join(root, filename)
+            target_path = os.path.join(target_root, filename)
+            if is_same_file(source_path, target_path):
+                continue
+
+            tmp = os.path.join(target_root, ".{}.mirror-tmp".format(filename))
+            copy_file_fast(source_path, tmp)
+            os.replace(tmp, target_path)
+            copied += 1
+
+    removed = 0
+    for root, dirs, files in os.walk(target, topdown=False):
+        relative = os.path.relpath(root, target)
+        source_root = os.path.normpath(os.path.join(source, relative))
+        for filename in files:
+            if not os.path.isfile(os.path.join(source_root, filename)):
+                os.remove(os.path.join(root, filename))
+                removed += 1
+        for dirname in dirs:
+            if not os.path.isdir(os.path.join(source_root, dirname)):
+                shutil.rmtree(os.path.join(root, dirname))
+                removed += 1
+
+    return copied, removed
+
+# SSH connections keyed by (host, port, user) so every phase of a run, and
+# every script sharing a process, reuses one handshake per account
+class SSHConnectionPool:
+
+    def __init__(self, key_filename=None, connect_timeout=10, keepalive=30, idle_timeout=300):
+        self.key_filename = key_filename
+        self.connect_timeout = connect_timeout
+        self.keepalive = keepalive
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def connect(self, host, port, user):
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        ssh.load_system_host_keys()
+        ssh.connect(
+            host,
+            port=port,
+            username=user,
+            key_filename=self.key_filename or None,
+            look_for_keys=True,
+            timeout=self.connect_timeout,
+            banner_timeout=self.connect_timeout,
+            auth_timeout=self.connect_timeout,
+        )
+        ssh.get_transport().set_keepalive(self.keepalive)
+        return ssh
+
+    # a pooled connection is reused only if its transport is still up and
+    # will take a packet
+    def is_healthy(self, ssh):
+        transport = ssh.get_transport()
+        if transport is None or not transport.is_active() or not transport.is_authenticated():
+            return False
+        try:
+            transport.send_ignore()
+        except (paramiko.SSHException, EOFError, OSError):
+            return False
+        return True
+
+    def evict_idle(self):
+        now = time.monotonic()
+        expired = []
+        with self.lock:
+            for key, entries in self.idle.items():
+                expired += [ssh for ssh, last_used in entries if now - last_used > self.idle_timeout]
+                entries[:] = [(ssh, last_used) for ssh, last_used in entries if now - last_used <= self.idle_timeout]
+        for ssh in expired:
+            ssh.close()
+
+    def acquire(self, host, port, user):
+        self.evict_idle()
+        key = (host, port, user)
+        while True:
+            with self.lock:
+                entries = self.idle.get(key)
+                if not entries:
+                    break
+                ssh, last_used = entries.pop()
+            if self.is_healthy(ssh):
+                return ssh
+            ssh.close()
+        return self.connect(host, port, user)
+
+    def release(self, host, port, user, ssh):
+        if not self.is_healthy(ssh):
+            ssh.close()
+            return
+        with self.lock:
+            self.idle.setdefault((host, port, user), []).append((ssh, time.monotonic()))
+
+    @contextmanager
+    def connection(self, host, port, user):
+        ssh = self.acquire(host, port, user)
+        try:
+            yield ssh
+        finally:
+            self.release(host, port, user, ssh)
+
+    def close_all(self):
+        with self.lock:
+            entries = [ssh for pooled in self.idle.values() for ssh, last_used in pooled]
+            self.idle = {}
+        for ssh in entries:
+            ssh.close()
+
+_ssh_pool = None
+_ssh_pool_lock = threading.Lock()
+
+# process-wide pool configured from settings
+def get_ssh_pool():
+    global _ssh_pool
+    with _ssh_pool_lock:
+        if _ssh_pool is None:
+            _ssh_pool = SSHConnectionPool(
+                key_filename=settings.SSH_KEY,
+                connect_timeout=settings.SSH_CONNECT_TIMEOUT,
+                keepalive=settings.SSH_KEEPALIVE,
+                idle_timeout=settings.SSH_IDLE_TIMEOUT,
+            )
+            atexit.register(_ssh_pool.close_all)
+    return _ssh_pool
+
+# transfer slots for one host. With `adaptive`, the number of slots follows
+# the host's measured throughput: every `interval` seconds one slot is added
+# while throughput keeps improving and the last one is taken back when it gets
+# worse, and a failed transfer halves them (additive increase, multiplicative
+# decrease).
+class HostSlots:
+
+    def __init__(self, maximum, adaptive=False, interval=5.0):
+        self.maximum = maximum
+        self.adaptive = adaptive
+        self.interval = interval
+        self.limit = max(1, maximum // 2) if adaptive else maximum
+        self.active = 0
+        self.condition = threading.Condition()
+        self.window_start = time.monotonic()
+        self.window_bytes = 0
+        self.last_throughput = None
+        self.last_step = 0
+
+    def __enter__(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+
+    def __exit__(self, *args):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    def set_limit(self, limit):
+        self.last_step = limit - self.limit
+        self.limit = limit
+        self.window_start = time.monotonic()
+        self.window_bytes = 0
+        self.condition.notify_all()
+
+    def record(self, size, error=False):
+        if not self.adaptive:
+            return
+
+        with self.condition:
+            if error:
+                self.set_limit(max(1, self.limit // 2))
+                self.last_throughput = None
+                return
+
+            self.window_bytes += size
+            elapsed = time.monotonic() - self.window_start
+            if elapsed < self.interval:
+                return
+
+            throughput = self.window_bytes / elapsed
+            limit = self.limit
+            if self.last_throughput is None or throughput > self.last_throughput * 1.05:
+                limit = min(self.maximum, limit + 1)
+            elif throughput < self.last_throughput * 0.95 and self.last_step > 0:
+                limit = max(1, limit - 1)
+            self.last_throughput = throughput
+            self.set_limit(limit)
+
+# global and per-host caps on concurrent transfers, shared by every job running
+# in the process
+class ConcurrencyLimits:
+
+    def __init__(self, total, per_host, adaptive=False, interval=5.0):
+        self.total = threading.BoundedSemaphore(total)
+        self.per_host = per_host
+        self.adaptive = adaptive
+        self.interval = interval
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def get_host(self, host):
+        with self.lock:
+            return self.hosts.setdefault(host, HostSlots(self.per_host, self.adaptive, self.interval))
+
+    @contextmanager
+    def slot(self, host):
+        # wait for the host's own slot first so a busy host doesn't hold a global one
+        with self.get_host(host):
+            with self.total:
+                yield
+
+    # feed a finished (or failed) transfer back to the host's adaptive limit
+    def record(self, host, size, error=False):
+        self.get_host(host).record(size, error)
+
+# token bucket shared by every transfer in the process. Readers call consume()
+# with the bytes they just received and are held back to `rate` bytes per
+# second, on average, while the limit is in force: always, or only between
+# the `hours` (start, end) of the day when given.
+class BandwidthLimiter:
+
+    def __init__(self, rate=None, hours=None):
+        self.rate = rate
+        self.hours = hours
+        self.tokens = rate or 0
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def current_rate(self):
+        if self.rate is None:
+            return None
+        if self.hours is not None:
+            start, end = self.hours
+            hour = datetime.now().hour
+            if not (start <= hour < end if start <= end else hour >= start or hour < end):
+                return None
+        return self.rate
+
+    def consume(self, size):
+        rate = self.current_rate()
+        if rate is None or size <= 0:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            # at most one second of burst; the balance can go negative, and
+            # the reader then sleeps the debt off
+            self.tokens = min(rate, self.tokens + (now - self.last) * rate) - size
+            self.last = now
+            wait = -self.tokens / rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+    # scp progress callback that charges each chunk to the bucket
+    def scp_progress(self, progress=None):
+        received = {}
+
+        def callback(filename, size, sent, *args):
+            self.consume(sent - received.get(filename, 0))
+            received[filename] = sent
+            if progress is not None:
+                progress(filename, size, sent, *args)
+
+        return callback
+
+_transfer_limits = None
+_bandwidth_limiter = None
+_disk_io_slots = None
+_limits_lock = threading.Lock()
+
+def get_transfer_limits():
+    global _transfer_limits
+    with _limits_lock:
+        if _transfer_limits is None:
+            _transfer_limits = ConcurrencyLimits(
+                settings.MAX_TRANSFERS,
+                settings.MAX_TRANSFERS_PER_HOST,
+                adaptive=settings.ADAPTIVE_CONCURRENCY,
+                interval=settings.ADAPTIVE_CONCURRENCY_INTERVAL,
+            )
+    return _transfer_limits
+
+def get_bandwidth_limiter():
+    global _bandwidth_limiter
+    with _limits_lock:
+        if _bandwidth_limiter is None:
+            _bandwidth_limiter = BandwidthLimiter(
+                settings.BANDWIDTH_LIMIT,
+                hours=settings.BANDWIDTH_LIMIT_HOURS,
+            )
+    return _bandwidth_limiter
+
+# budget for bulk local disk work (Dropbox copies, hard-linking, deletes) so
+# concurrent jobs don't all hit the backups disk at once
+@contextmanager
+def disk_io():
+    global _disk_io_slots
+    with _limits_lock:
+        if _disk_io_slots is None:
+            _disk_io_slots = threading.BoundedSemaphore(settings.DISK_IO_SLOTS)
+    with _disk_io_slots:
+        yield
+
+# a command run on the remote whose output is saved, gzipped, under local
+Dump = namedtuple('Dump', ('command', 'local'))
+
+# a single remote path and the local name it is saved under; sqlite marks a
+# live SQLite database to copy through the online backup API
+Fetch = namedtuple('Fetch', ('remote', 'local', 'recursive', 'sqlite'))
+Fetch.__new__.__defaults__ = (False, False)
+
+# SFTP sessions start in the user's home directory and do not expand "~"
+def sftp_path(remote):
+    if remote == "~":
+        return "."
+    if remote.startswith("~/"):
+        return remote[2:]
+    return remote
+
+# per-snapshot record of every fetched file and the remote metadata it had,
+# sorted by path
+MANIFEST_NAME = ".manifest.jsonl"
+
+def load_manifest(directory):
+    records = {}
+    path = os.path.join(directory, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return records
+
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            records[record["path"]] = record
+    return records
+
+def write_manifest(directory, records):
+    with open(os.path.join(directory, MANIFEST_NAME), "w") as f:
+        for record in sorted(records, key=lambda record: record["path"]):
+            f.write(json.dumps(record, sort_keys=True) + "\n")
+
+# large files are hashed through a read-only mapping in one update() call,
+# which skips the copy into Python buffers and releases the GIL throughout
+MMAP_MIN_SIZE = 64 * 1024 * 1024
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size >= MMAP_MIN_SIZE:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                if hasattr(mapped, "madvise"):
+                    mapped.madvise(mmap.MADV_SEQUENTIAL)
+                digest.update(mapped)
+        else:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+# the (local prefix, remote path, user) source a snapshot path was copied from
+def match_source(path, sources):
+    best = None
+    for prefix, remote, user in sources:
+        if path != prefix and not path.startswith(prefix + "/"):
+            continue
+        if best is None or len(prefix) > len(best[0]):
+            best = (prefix, remote, user)
+    return best
+
+# manifest records for a snapshot tree written by something other than
+# run_transfers, such as rsync. Files still hard-linked to the previous
+# snapshot's copy keep its hash instead of being read again.
+def tree_records(root, sources, host, previous=None):
+    previous_records = load_manifest(previous) if previous is not None else {}
+    records = []
+    for directory, dirs, files in os.walk(root):
+        for filename in files:
+            local = os.path.join(directory, filename)
+            path = os.path.relpath(local, root)
+            source = match_source(path, sources)
+            if path == MANIFEST_NAME or source is None or os.path.islink(local):
+                continue
+
+            prefix, remote, user = source
+            attr = os.stat(local)
+            record = {
+                "path": path,
+                "remote": remote + path[len(prefix):],
+                "host": host,
+                "user": user,
+                "size": attr.st_size,
+                "mtime": int(attr.st_mtime),
+                "mode": attr.st_mode,
+                "status": "transferred",
+            }
+
+            previous_record = previous_records.get(path)
+            base = os.path.join(previous, path) if previous is not None else None
+            if (
+                previous_record is not None
+                and previous_record.get("sha256") is not None
+                and os.path.isfile(base)
+                and os.path.samefile(local, base)
+            ):
+                record["sha256"] = previous_record["sha256"]
+                record["status"] = "linked"
+            else:
+                record["sha256"] = hash_file(local)
+            records.append(record)
+    return records
+
+# sha256 of remote files keyed by the path as given, from one sha256sum run
+# fed through xargs. Files that can't be read are left out.
+def remote_checksums(transport, paths):
+    if len(paths) == 0:
+        return {}
+
+    channel = transport.open_session()
+    channel.exec_command("xargs -0 sha256sum --")
+    channel.sendall("\0".join(paths).encode())
+    channel.shutdown_write()
+
+    checksums = {}
+    try:
+        for line in channel.makefile("rb"):
+            digest, separator, path = line.decode(errors="replace").rstrip("\n").partition("  ")
+            if separator:
+                checksums[path] = digest
+    finally:
+        channel.close()
+    return checksums
+
+# compare a snapshot against the remote. Local copies are hashed on a thread
+# pool while the remote hashes its files, and each record is checked against
+# both. Returns (path, problem) for every file that doesn't match.
+LIVE_COPY_STATUSES = ("sqlite", "dumped")
+
+def verify_snapshot(transport, root, records, workers=4):
+    archive = find_archive(root)
+    members = load_index(archive) if archive is not None else {}
+
+    def hash_local(record):
+        if record["path"] in members:
+            return hash_member(archive, members[record["path"]])
+        path = os.path.join(root, record["path"])
+        if not os.path.isfile(path):
+            return None
+        return hash_file(path)
+
+    # database copies and dumps are consistent snapshots of live data, not
+    # byte copies of a remote file, so they are only checked against their
+    # own manifest digest
+    compared = [record for record in records if record.get("status") not in LIVE_COPY_STATUSES]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        local = executor.map(hash_local, records)
+        remote = remote_checksums(transport, [sftp_path(record["remote"]) for record in compared])
+        local = list(local)
+
+    mismatches = []
+    for record, local_digest in zip(records, local):
+        remote_digest = remote.get(sftp_path(record["remote"]))
+        if local_digest is None:
+            problem = "missing from the snapshot"
+        elif record.get("sha256") is not None and local_digest != record["sha256"]:
+            problem = "snapshot copy changed since it was written"
+        elif record.get("status") in LIVE_COPY_STATUSES:
+            continue
+        elif remote_digest is None:
+            problem = "could not be read on the remote"
+        elif remote_digest != local_digest:
+            problem = "differs from the remote file"
+        else:
+            continue
+        mismatches.append((record["path"], problem))
+    return mismatches
+
+def open_catalog():
+    return Catalog(settings.CATALOG_PATH or os.path.join(settings.BACKUPS_DIRECTORY, "catalog.sqlite3"))
+
+# add a finished snapshot to the catalog. The catalog is only an index over
+# the snapshots, so failing to update it is logged rather than failing the run.
+def catalog_snapshot(directory, records):
+    try:
+        with open_catalog() as catalog:
+            catalog.forget_missing()
+            catalog.add_snapshot(directory, records)
+    except sqlite3.Error as error:
+        logger.error(f"could not add {directory} to the catalog: {error}")
+
+# a snapshot moved into the chunk store keeps its manifest and this marker,
+# which holds the path of the store with its files
+CHUNKED_NAME = ".chunked"
+
+def open_chunk_store():
+    return ChunkStore(settings.CHUNK_STORE_DIRECTORY)
+
+# the chunk store holding a snapshot's files, if it was moved into one
+def find_chunk_store(directory):
+    path = os.path.join(directory, CHUNKED_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return f.read().strip()
+
+# move every finished directory snapshot except `keep` into the chunk store,
+# leaving its manifest and marker behind. The newest snapshot stays a tree as
+# the next run's hard-link, delta and rsync --link-dest base. Returns the
+# names moved.
+def store_snapshots(directory, prefix, keep=None):
+    if settings.CHUNK_STORE_DIRECTORY is None:
+        return []
+
+    stored = []
+    with open_chunk_store() as store:
+        store.forget_missing()
+        for name in list_snapshots(directory, prefix):
+            root = os.path.join(directory, name)
+            if (
+                name == keep
+                or find_chunk_store(root) is not None
+                or find_archive(root) is not None
+                or os.path.exists(os.path.join(root, JOURNAL_NAME))
+            ):
+                continue
+
+            # files the manifest has a digest for that the store already
+            # holds, such as hard links to older snapshots, aren't chunked again
+            digests = {path: record.get("sha256") for path, record in load_manifest(root).items()}
+            files, written = store.add_snapshot(name, root, directory=root, exclude=(MANIFEST_NAME,), digests=digests)
+            with open(os.path.join(root, CHUNKED_NAME + ".tmp"), "w") as f:
+                f.write(os.path.abspath(settings.CHUNK_STORE_DIRECTORY))
+            os.replace(os.path.join(root, CHUNKED_NAME + ".tmp"), os.path.join(root, CHUNKED_NAME))
+            for entry in os.listdir(root):
+                path = os.path.join(root, entry)
+                if entry in (MANIFEST_NAME, CHUNKED_NAME):
+                    continue
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            logger.debug(f"moved {name} into the chunk store, {files} files, {written} bytes of new chunks")
+            stored.append(name)
+        store.compact()
+    return stored
+
+# add a directory that is rewritten in place every run (the codespace files)
+# to the chunk store as snapshot <prefix>_<timestamp>, and drop its stored
+# snapshots outside the retention policy. Returns the new snapshot's name.
+def store_directory(root, prefix, policy):
+    if settings.CHUNK_STORE_DIRECTORY is None:
+        return None
+
+    name = "{}_{}".format(prefix, datetime.now().strftime(SNAPSHOT_TIMESTAMP_FORMAT))
+    with open_chunk_store() as store:
+        files, written = store.add_snapshot(name, root)
+        names = [
+            snapshot["name"]
+            for snapshot in store.snapshots()
+            if snapshot["name"].startswith(prefix + "_") and snapshot["directory"] is None
+        ]
+        for old in set(names) - select_snapshots_to_keep(names, policy):
+            store.remove_snapshot(old)
+        store.compact()
+    logger.debug(f"stored {root} as {name}, {files} files, {written} bytes of new chunks")
+    return name
+
+def walk_remote(sftp, remote, local):
+    entries = []
+    os.makedirs(local, exist_ok=True)
+    for child in sftp.listdir_attr(sftp_path(remote)):
+        child_remote = "{}/{}".format(remote, child.filename)
+        child_local = os.path.join(local, child.filename)
+        if stat.S_ISDIR(child.st_mode):
+            entries += walk_remote(sftp, child_remote, child_local)
+        else:
+            entries.append((Fetch(child_remote, child_local), child))
+    return entries
+
+# pre-flight pass: expand fetches into one entry per remote file along with its
+# size, mtime and mode, all through one SFTP session
+def stat_fetches(sftp, fetches):
+    planned = []
+    for fetch in fetches:
+        try:
+            attr = sftp.stat(sftp_path(fetch.remote))
+        except IOError:
+            # leave it to scp to report the missing file the way it always has
+            planned.append((fetch, None))
+            continue
+
+        if stat.S_ISDIR(attr.st_mode) and fetch.recursive:
+            planned += walk_remote(sftp, fetch.remote, fetch.local)
+        elif stat.S_ISDIR(attr.st_mode):
+            planned.append((fetch, None))
+        else:
+            planned.append((Fetch(fetch.remote, fetch.local, sqlite=fetch.sqlite), attr))
+    return planned
+
+def is_unchanged(record, previous_record):
+    if previous_record is None:
+        return False
+    return all(record[key] == previous_record.get(key) for key in ("remote", "size", "mtime", "mode"))
+
+# fetch over SFTP into a .part file named after the remote size and mtime, so
+# a transfer that is cut off continues from the same byte offset on the next
+# attempt. Returns the offset it resumed from.
+def fetch_resumable(transport, remote, local, size, mtime):
+    part = "{}.{}-{}.part".format(local, size, mtime)
+    directory, name = os.path.split(local)
+    for filename in os.listdir(directory):
+        # a part of an older version of the file can't be resumed
+        path = os.path.join(directory, filename)
+        if filename.startswith(name + ".") and filename.endswith(".part") and path != part:
+            os.remove(path)
+
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    if offset > size:
+        offset = 0
+
+    with paramiko.SFTPClient.from_transport(transport) as sftp:
+        with sftp.open(sftp_path(remote), "rb") as source, open(part, "ab") as target:
+            target.truncate(offset)
+            source.seek(offset)
+            source.prefetch(size)
+            for block in iter(lambda: source.read(1 << 20), b""):
+                get_bandwidth_limiter().consume(len(block))
+                target.write(block)
+
+    if os.path.getsize(part) != size:
+        raise IOError("{} changed size while being fetched".format(remote))
+    os.replace(part, local)
+    return offset
+
+def link_or_copy(source, target):
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+# a file an interrupted run left behind may be a hard link into the previous
+# snapshot, so it is removed rather than written through
+def discard_stale(path):
+    if os.path.lexists(path) and not os.path.isdir(path):
+        os.remove(path)
+
+def open_snapshot_archive(root):
+    return SnapshotArchive(
+        os.path.join(root, get_archive_name()),
+        threads=settings.ARCHIVE_THREADS,
     )
-    handler.setFormatter(log_formatter)
-    handler.setLevel(logging.DEBUG)
 
-    logger = logging.getLogger('root')
-    logger.setLevel(logging.DEBUG)
-    logger.addHandler(handler)
+def remove_empty_directories(root):
+    for directory, dirs, files in os.walk(root, topdown=False):
+        if directory != root and len(os.listdir(directory)) == 0:
+            os.rmdir(directory)
+
+# pack an already written snapshot tree (rsync output) into an archive
+def archive_snapshot_tree(root):
+    archive = open_snapshot_archive(root)
+    for name in sorted(os.listdir(root)):
+        path = os.path.join(root, name)
+        if name == MANIFEST_NAME or path.startswith(archive.path):
+            continue
+        add_to_archive(archive, path, root)
+    archive.close()
+
+# in archive format a fetched file only passes through the snapshot directory
+# on its way into the archive
+def add_to_archive(archive, local, root, record=None):
+    name = os.path.relpath(local, root)
+    if os.path.isdir(local):
+        archive.add_tree(local, prefix=name)
+        shutil.rmtree(local)
+    else:
+        archive.add_file(
+            name,
+            local,
+            mtime=record["mtime"] if record is not None else None,
+            mode=record["mode"] if record is not None else None,
+        )
+        os.remove(local)
+
+# fetch many small files with one remote tar instead of one scp process and
+# round trip per file. Returns the fetches that were not in the stream, which
+# the caller retries with scp so a missing file is reported the usual way. The
+# paths go to tar NUL-separated on stdin, from their own thread so a long list
+# can't stall against tar's output, rather than on a command line that a large
+# batch would overflow.
+def fetch_batch(transport, fetches, compress=False):
+    by_member = {
+        os.path.normpath(sftp_path(fetch.remote)).lstrip("/"): fetch
+        for fetch in fetches
+    }
+
+    channel = transport.open_session()
+    channel.exec_command("tar --null -T - -ch{}f -".format("z" if compress else ""))
+
+    def send_paths():
+        try:
+            for fetch in fetches:
+                channel.sendall(os.fsencode(sftp_path(fetch.remote)) + b"\0")
+            channel.shutdown_write()
+        except (OSError, paramiko.SSHException) as error:
+            logger.debug(f"sending the batch file list failed: {error}")
+
+    sender = threading.Thread(target=send_paths, daemon=True)
+    sender.start()
+
+    received = set()
+    try:
+        with tarfile.open(fileobj=channel.makefile("rb"), mode="r|gz" if compress else "r|") as tar:
+            for member in tar:
+                fetch = by_member.get(os.path.normpath(member.name))
+                if fetch is None or not member.isfile():
+                    continue
+
+                tmp = "{}.batch-tmp".format(fetch.local)
+                try:
+                    with tar.extractfile(member) as source, open(tmp, "wb") as target:
+                        for block in iter(lambda: source.read(1 << 20), b""):
+                            get_bandwidth_limiter().consume(len(block))
+                            target.write(block)
+                    os.replace(tmp, fetch.local)
+                finally:
+                    if os.path.exists(tmp):
+                        os.remove(tmp)
+                received.add(fetch)
+        sender.join()
+
+        # 2 means some files couldn't be read, and those are already missing
+        # from the stream; 1 means a file changed while tar read it, so none of
+        # the batch can be trusted
+        status = channel.recv_exit_status()
+        if status != 0:
+            logger.debug("batched tar exited with status {}: {}".format(
+                status,
+                channel.makefile_stderr("rb").read().decode(errors="replace").strip(),
+            ))
+        if status == 1:
+            received.clear()
+    except tarfile.ReadError as error:
+        logger.debug(f"batched fetch failed: {error}")
+    finally:
+        channel.close()
+
+    return [fetch for fetch in fetches if fetch not in received]
+
+class DumpFailed(Exception):
+    pass
+
+# run a dump command (mysqldump, sqlite3 .dump) on the remote and stream its
+# output through gzip into local, with no temp file on the remote. The channel
+# is read on one thread and compressed on this one, joined by a queue of at
+# most `depth` blocks, so the dump keeps streaming while a block is compressed
+# and memory stays bounded. Returns the uncompressed bytes dumped.
+def stream_dump(transport, command, local, level=6, depth=16):
+    channel = transport.open_session()
+    channel.exec_command(command)
+    blocks = queue.Queue(maxsize=depth)
+
+    def read():
+        try:
+            for block in iter(lambda: channel.recv(1 << 20), b""):
+                get_bandwidth_limiter().consume(len(block))
+                blocks.put(block)
+        finally:
+            blocks.put(None)
+
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+
+    tmp = "{}.dump-tmp".format(local)
+    size = 0
+    try:
+        with open(tmp, "wb") as f:
+            with gzip.GzipFile(fileobj=f, mode="wb", compresslevel=level, mtime=0) as target:
+                for block in iter(blocks.get, None):
+                    target.write(block)
+                    size += len(block)
+        reader.join()
+
+        status = channel.recv_exit_status()
+        if status != 0:
+            raise DumpFailed("{} exited with status {}: {}".format(
+                command,
+                status,
+                channel.makefile_stderr("rb").read().decode(errors="replace").strip(),
+            ))
+        os.replace(tmp, local)
+    finally:
+        channel.close()
+        # let the reader finish if compressing failed half way
+        while reader.is_alive():
+            try:
+                blocks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+    return size
+
+# run the dumps for one user, recording each in the manifest with the command
+# as its remote. Dumps are always taken fresh, so a resumed run repeats them.
+# host is the name records are stored under, the peer address by default.
+def run_dumps(transport, dumps, root, archive=None, journal=None, tee=None, host=None):
+    host = host or transport.getpeername()[0]
+    user = transport.get_username()
+    records = []
+    for dump in dumps:
+        with get_transfer_limits().slot(host):
+            start = time.monotonic()
+            size = stream_dump(transport, dump.command, dump.local)
+            duration = time.monotonic() - start
+        get_transfer_limits().record(host, size)
+        logger.debug(f"dumped {size} bytes from {dump.command} in {duration:.1f}s")
+
+        attr = os.stat(dump.local)
+        record = {
+            "path": os.path.relpath(dump.local, root),
+            "remote": dump.command,
+            "host": host,
+            "user": user,
+            "size": attr.st_size,
+            "mtime": int(attr.st_mtime),
+            "mode": attr.st_mode,
+            "status": "dumped",
+            "duration": round(duration, 6),
+            "retries": 0,
+            "sha256": hash_file(dump.local),
+        }
+        records.append(record)
+        if journal is not None:
+            journal.add(record["path"], record)
+        if archive is not None:
+            add_to_archive(archive, dump.local, root, record)
+        elif tee is not None:
+            tee.add(dump.local)
+    return records
+
+# fetch files concurrently, each worker on its own SCP channel over the one
+# transport. Files whose remote size, mtime and mode match the previous
+# snapshot's manifest are linked from it instead of fetched. Work is started
+# largest first so one big file doesn't leave the run waiting at the end.
+# Changed files of at least delta_min_size bytes use the rolling-checksum delta
+# transfer against the previous snapshot's copy, falling back to scp, and files
+# of at most batch_max_size bytes are fetched together through one remote tar.
+# A failed scp of a file that stat() found is retried up to `retries` times.
+# Fetches marked sqlite are copied through the SQLite backup API on the remote,
+# sending only the pages that differ from the previous snapshot's copy.
+# Files of at least resume_min_size bytes go over SFTP through a .part file
+# that later attempts resume from. With a journal, every finished file is
+# recorded as it completes, and files an interrupted run already fetched are
+# kept. With a tee, every file is copied to the mirror destinations as it
+# lands.
+# Each record carries the seconds spent on it and the retries it took. With an
+# archive, files are streamed into it as they arrive and unchanged files are
+# copied compressed from the previous snapshot's archive. Records are stored
+# under `host`, the configured host name the catalog is searched by; it
+# defaults to the peer address.
+def run_transfers(
+    transport,
+    fetches,
+    root,
+    previous=None,
+    workers=4,
+    progress=None,
+    delta_min_size=None,
+    batch_max_size=None,
+    batch_compress=False,
+    archive=None,
+    retries=0,
+    journal=None,
+    resume_min_size=None,
+    tee=None,
+    host=None,
+):
+    host = host or transport.getpeername()[0]
+    user = transport.get_username()
+    previous_records = load_manifest(previous) if previous is not None else {}
+    previous_archive = find_archive(previous) if previous is not None and archive is not None else None
+    previous_members = load_index(previous_archive) if previous_archive is not None else {}
+
+    try:
+        sftp = paramiko.SFTPClient.from_transport(transport)
+    except (paramiko.SSHException, EOFError):
+        sftp = None
+
+    if sftp is None:
+        planned = [(fetch, None) for fetch in fetches]
+    else:
+        with sftp:
+            planned = stat_fetches(sftp, fetches)
+    planned.sort(key=lambda entry: entry[1].st_size if entry[1] is not None else 0, reverse=True)
+
+    records = []
+
+    def reuse_previous(record):
+        if previous is None or not is_unchanged(record, previous_records.get(record["path"])):
+            return False
+
+        if archive is not None:
+            member = previous_members.get(record["path"])
+            return (
+                member is not None
+                and member["size"] == record["size"]
+                and archive.copy_member(previous_archive, member)
+            )
+
+        base = os.path.join(previous, record["path"])
+        if os.path.isfile(base) and os.path.getsize(base) == record["size"]:
+            link_or_copy(base, os.path.join(root, record["path"]))
+            return True
+        return False
+
+    def finish(fetch, record, status, duration):
+        if record is not None:
+            record["status"] = status
+            record["duration"] = round(duration, 6)
+            record.setdefault("retries", 0)
+            record["sha256"] = hash_file(fetch.local)
+            records.append(record)
+            if journal is not None:
+                journal.add(record["path"], record)
+        if archive is not None:
+            add_to_archive(archive, fetch.local, root, record)
+        elif tee is not None:
+            tee.add(fetch.local)
+
+    def fetch_one(fetch, record):
+        base = os.path.join(previous, record["path"]) if previous is not None and record is not None else None
+
+        # databases are copied consistently and only their changed pages sent
+        if fetch.sqlite and record is not None:
+            try:
+                with get_transfer_limits().slot(host):
+                    start = time.monotonic()
+                    sent = fetch_sqlite(
+                        transport,
+                        fetch.remote,
+                        fetch.local,
+                        base if base is not None and os.path.isfile(base) else None,
+                        throttle=get_bandwidth_limiter().consume,
+                    )
+                get_transfer_limits().record(host, sent)
+            except SqliteUnavailable as error:
+                logger.warning(f"sqlite backup of {fetch.remote} unavailable, copying the file: {error}")
+            else:
+                file_event(logger, "sqlite backup of %s sent %d bytes of changed pages", fetch.remote, sent)
+                finish(fetch, record, "sqlite", time.monotonic() - start)
+                return
+
+        # large files with a previous copy only send the blocks that changed
+        if (
+            delta_min_size is not None
+            and base is not None
+            and record["size"] >= delta_min_size
+            and os.path.isfile(base)
+        ):
+            try:
+                with get_transfer_limits().slot(host):
+                    start = time.monotonic()
+                    literal = fetch_delta(
+                        transport,
+                        fetch.remote,
+                        fetch.local,
+                        base,
+                        throttle=get_bandwidth_limiter().consume,
+                    )
+                get_transfer_limits().record(host, literal)
+            except DeltaUnavailable as error:
+                file_event(logger, "delta transfer of %s unavailable, copying in full: %s", fetch.remote, error)
+            else:
+                finish(fetch, record, "delta", time.monotonic() - start)
+                return
+
+        # a file stat() couldn't find isn't retried, scp reports it as missing
+        attempts = retries + 1 if record is not None else 1
+        resumable = resume_min_size is not None and record is not None and record["size"] >= resume_min_size
+        for attempt in range(attempts):
+            try:
+                with get_transfer_limits().slot(host):
+                    start = time.monotonic()
+                    if resumable:
+                        offset = fetch_resumable(transport, fetch.remote, fetch.local, record["size"], record["mtime"])
+                        if offset > 0:
+                            file_event(logger, "resumed %s at byte %d", fetch.remote, offset)
+                    elif record is not None:
+                        # scp writes in place, so it goes to a new file that replaces the old one
+                        tmp = "{}.scp-tmp".format(fetch.local)
+                        try:
+                            with SCPClient(transport, progress=get_bandwidth_limiter().scp_progress(progress)) as scp:
+                                scp.get(fetch.remote, tmp)
+                            os.replace(tmp, fetch.local)
+                        finally:
+                            if os.path.exists(tmp):
+                                os.remove(tmp)
+                    else:
+                        discard_stale(fetch.local)
+                        with SCPClient(transport, progress=get_bandwidth_limiter().scp_progress(progress)) as scp:
+                            scp.get(fetch.remote, fetch.local, recursive=fetch.recursive)
+                get_transfer_limits().record(host, record["size"] if record is not None else 0)
+                break
+            except (SCPException, paramiko.SSHException, OSError) as error:
+                get_transfer_limits().record(host, 0, error=True)
+                if attempt + 1 == attempts:
+                    raise
+                record["retries"] = attempt + 1
+                logger.warning(f"retrying {fetch.remote} after error: {error}")
+                time.sleep(2 ** attempt)
+        finish(fetch, record, "transferred", time.monotonic() - start)
+
+    pending = []
+    batch = []
+    for fetch, attr in planned:
+        record = None
+        if attr is not None:
+            record = {
+                "path": os.path.relpath(fetch.local, root),
+                "remote": fetch.remote,
+                "host": host,
+                "user": user,
+                "size": attr.st_size,
+                "mtime": int(attr.st_mtime),
+                "mode": attr.st_mode,
+            }
+            # already fetched by the interrupted run this one resumes
+            journaled = journal.get(record["path"]) if journal is not None else None
+            if (
+                is_unchanged(record, journaled)
+                and os.path.isfile(fetch.local)
+                and os.path.getsize(fetch.local) == record["size"]
+            ):
+                for key in ("status", "sha256", "duration", "retries"):
+                    record[key] = journaled.get(key)
+                records.append(record)
+                continue
+            discard_stale(fetch.local)
+
+            start = time.monotonic()
+            # a database's main file can be unchanged while its WAL is not
+            if not fetch.sqlite and reuse_previous(record):
+                record["status"] = "linked"
+                record["duration"] = round(time.monotonic() - start, 6)
+                record["retries"] = 0
+                record["sha256"] = previous_records[record["path"]].get("sha256")
+                if record["sha256"] is None and archive is None:
+                    record["sha256"] = hash_file(fetch.local)
+                records.append(record)
+                if journal is not None:
+                    journal.add(record["path"], record)
+                if tee is not None and archive is None:
+                    tee.add(fetch.local)
+                continue
+
+            if batch_max_size is not None and record["size"] <= batch_max_size and not fetch.sqlite:
+                batch.append((fetch, record))
+                continue
+
+        pending.append((fetch, record))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [submit_in_context(executor, fetch_one, fetch, record) for fetch, record in pending]
+
+        # the batch streams on this thread while the workers take the large files
+        if len(batch) > 0:
+            with get_transfer_limits().slot(host):
+                start = time.monotonic()
+                missing = fetch_batch(transport, [fetch for fetch, record in batch], compress=batch_compress)
+                duration = time.monotonic() - start
+            get_transfer_limits().record(host, sum(
+                record["size"] for fetch, record in batch if fetch not in missing
+            ))
+
+            # the batch's time is shared out by size
+            total = sum(record["size"] for fetch, record in batch) or 1
+            for fetch, record in batch:
+                if fetch in missing:
+                    futures.append(submit_in_context(executor, fetch_one, fetch, record))
+                else:
+                    finish(fetch, record, "batched", duration * record["size"] / total)
+
+    # surface the first failure the same way a sequential scp.get() would
+    for future in futures:
+        future.result()
+
+    return records
+
+
+# per-run report of phase timings and per-file transfer records, written as
+# JSON and, when a textfile directory is set, as metrics for the Prometheus
+# node_exporter textfile collector
+class RunReport:
+
+    def __init__(self, job, host):
+        self.job = job
+        self.host = host
+        self.started = datetime.now()
+        self.start = time.monotonic()
+        self.phases = {}
+        self.files = []
+        self.run = "{}-{}".format(job, self.started.strftime(SNAPSHOT_TIMESTAMP_FORMAT))
+        # every log line of the run on this thread carries its context
+        set_log_context(run=self.run, job=job, host=host, phase=None)
+
+    @contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        try:
+            with log_context(phase=name):
+                yield
+        finally:
+            self.phases[name] = round(self.phases.get(name, 0) + time.monotonic() - start, 3)
+
+    def add_files(self, records):
+        self.files += records
+
+    def to_dict(self, directory, errors):
+        totals = {}
+        files = []
+        for record in self.files:
+            total = totals.setdefault(record["status"], {"files": 0, "bytes": 0})
+            total["files"] += 1
+            total["bytes"] += record["size"]
+
+            duration = record.get("duration")
+            files.append({
+                "path": record["path"],
+                "remote": record["remote"],
+                "user": record["user"],
+                "status": record["status"],
+                "size": record["size"],
+                "duration": duration,
+                "bytes_per_second": round(record["size"] / duration) if duration else None,
+                "retries": record.get("retries", 0),
+            })
+
+        return {
+            "run": self.run,
+            "job": self.job,
+            "host": self.host,
+            "directory": directory,
+            "started": self.started.isoformat(),
+            "duration": round(time.monotonic() - self.start, 3),
+            "success": len(errors) == 0,
+            "errors": errors,
+            "phases": self.phases,
+            "totals": totals,
+            "retries": sum(file["retries"] for file in files),
+            "files": sorted(files, key=lambda file: file["duration"] or 0, reverse=True),
+        }
+
+    def to_prometheus(self, report, slowest=10):
+        def labels(**extra):
+            values = dict(job=self.job, host=self.host, **extra)
+            return ",".join(
+                '{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                for key, value in values.items()
+            )
+
+        metrics = [
+            ("backup_last_run_timestamp_seconds", "Start of the last backup run.", [
+                (labels(), self.started.timestamp()),
+            ]),
+            ("backup_last_run_success", "1 if the last backup run had no errors.", [
+                (labels(), int(report["success"])),
+            ]),
+            ("backup_run_duration_seconds", "Wall time of the last backup run.", [
+                (labels(), report["duration"]),
+            ]),
+            ("backup_phase_duration_seconds", "Wall time of each phase of the last backup run.", [
+                (labels(phase=phase), duration) for phase, duration in report["phases"].items()
+            ]),
+            ("backup_files", "Files in the last snapshot by how they were fetched.", [
+                (labels(status=status), total["files"]) for status, total in report["totals"].items()
+            ]),
+            ("backup_bytes", "Bytes in the last snapshot by how they were fetched.", [
+                (labels(status=status), total["bytes"]) for status, total in report["totals"].items()
+            ]),
+            ("backup_transfer_retries", "Transfer retries in the last backup run.", [
+                (labels(), report["retries"]),
+            ]),
+            ("backup_file_duration_seconds", "Slowest files of the last backup run.", [
+                (labels(path=file["path"]), file["duration"])
+                for file in report["files"][:slowest]
+                if file["duration"] is not None
+            ]),
+        ]
+
+        lines = []
+        for name, description, samples in metrics:
+            lines.append("# HELP {} {}".format(name, description))
+            lines.append("# TYPE {} gauge".format(name))
+            for sample_labels, value in samples:
+                lines.append("{}{{{}}} {}".format(name, sample_labels, value))
+        return "\n".join(lines) + "\n"
+
+    # reporting is best effort and never fails the run
+    def write(self, directory, errors):
+        report = self.to_dict(directory, errors)
+        try:
+            if settings.RUN_REPORT_DIRECTORY:
+                path = os.path.join(settings.RUN_REPORT_DIRECTORY, "backup_{}_report.json".format(self.job))
+                with open(path + ".tmp", "w") as f:
+                    json.dump(report, f, indent=2)
+                os.replace(path + ".tmp", path)
 
-    return logger
\ No newline at end of file
+            # the collector may read at any time, so the file is swapped in whole
+            if settings.METRICS_TEXTFILE_DIRECTORY:
+                path = os.path.join(settings.METRICS_TEXTFILE_DIRECTORY, "backup_{}.prom".format(self.job))
+                with open(path + ".tmp", "w") as f:
+                    f.write(self.to_prometheus(report))
+                os.replace(path + ".tmp", path)
+        except OSError as error:
+            logger.error(f"could not write the {self.job} run report: {error}")
+        return report
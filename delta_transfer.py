@@ -0,0 +1,170 @@
+import hashlib, json, math, os, shlex, struct, zlib
+import paramiko
+
+# Rolling-checksum delta transfer over an SSH exec channel.
+#
+# The local side sends block signatures (adler32 + md5) of its previous copy to
+# a small Python helper on the remote. The helper slides a rolling adler32 over
+# the remote file and answers with a stream of frames:
+#
+#   b"C" + >I block index      copy a block from the previous local copy
+#   b"D" + >I length + data    literal bytes
+#   b"E" + md5 hex digest      end of file, digest of the whole remote file
+
+REMOTE_HELPER = r'''
+import hashlib, json, os, struct, sys, zlib
+MOD = 65521
+path = os.path.expanduser(sys.argv[1])
+header = json.loads(sys.stdin.readline())
+size = header["block_size"]
+table = {}
+for index, (weak, strong) in enumerate(header["blocks"]):
+    table.setdefault(weak, []).append((strong, index))
+out = sys.stdout.buffer
+whole = hashlib.md5()
+literal = bytearray()
+def flush():
+    if literal:
+        out.write(b"D" + struct.pack(">I", len(literal)) + literal)
+        del literal[:]
+f = open(path, "rb")
+buf = bytearray()
+start = 0
+eof = False
+a = b = None
+while True:
+    if len(buf) - start <= size and not eof:
+        chunk = f.read(1 << 20)
+        if not chunk:
+            eof = True
+        whole.update(chunk)
+        del buf[:start]
+        start = 0
+        buf += chunk
+    if len(buf) - start < size:
+        break
+    if a is None:
+        weak = zlib.adler32(bytes(buf[start:start + size]))
+        a, b = weak & 0xffff, weak >> 16
+    match = None
+    for strong, index in table.get((b << 16) | a, ()):
+        if hashlib.md5(buf[start:start + size]).hexdigest() == strong:
+            match = index
+            break
+    if match is not None:
+        flush()
+        out.write(b"C" + struct.pack(">I", match))
+        start += size
+        a = None
+        continue
+    # roll byte by byte until the next weak match or the end of the buffer
+    position = start
+    limit = len(buf) - size
+    while position < limit:
+        old = buf[position]
+        a = (a - old + buf[position + size]) % MOD
+        b = (b - size * old + a - 1) % MOD
+        position += 1
+        if (b << 16) | a in table:
+            break
+    if position == start:
+        # no next byte buffered to roll in; emit one literal and start over
+        position += 1
+        a = None
+    literal += buf[start:position]
+    start = position
+    if len(literal) >= 1 << 16:
+        flush()
+literal += buf[start:]
+flush()
+out.write(b"E" + whole.hexdigest().encode())
+out.flush()
+'''
+
+class DeltaUnavailable(Exception):
+    pass
+
+# roughly sqrt(size), like rsync, kept between 2KB and 128KB
+def get_block_size(size):
+    return max(2048, min(1 << 17, int(math.sqrt(size)) // 8 * 8))
+
+def block_signatures(path, block_size):
+    blocks = []
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            blocks.append([zlib.adler32(block), hashlib.md5(block).hexdigest()])
+    return blocks
+
+def read_exactly(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise DeltaUnavailable("delta stream ended early")
+    return data
+
+def get_helper_error(channel):
+    return "remote delta helper exited with status {}: {}".format(
+        channel.recv_exit_status(),
+        channel.makefile_stderr("rb").read().decode(errors="replace").strip(),
+    )
+
+# rebuild the remote file at local_path from basis_path plus the changed blocks
+# and return the number of literal bytes sent. Raises DeltaUnavailable if the
+# remote helper can't run, so the caller can fall back to a full copy. A
+# throttle callable, when given, is called with the size of every literal run.
+def fetch_delta(transport, remote_path, local_path, basis_path, throttle=None):
+    block_size = get_block_size(os.path.getsize(basis_path))
+    header = {
+        "block_size": block_size,
+        "blocks": block_signatures(basis_path, block_size),
+    }
+
+    channel = transport.open_session()
+    channel.exec_command("python3 -c {} {}".format(
+        shlex.quote(REMOTE_HELPER),
+        shlex.quote(remote_path),
+    ))
+
+    tmp = "{}.delta-tmp".format(local_path)
+    whole = hashlib.md5()
+    literal = 0
+    stream = channel.makefile("rb")
+    try:
+        # a helper that never started closes the channel under a large header
+        channel.sendall(json.dumps(header).encode() + b"\n")
+        channel.shutdown_write()
+
+        with open(basis_path, "rb") as basis, open(tmp, "wb") as target:
+            while True:
+                op = stream.read(1)
+                if op == b"C":
+                    index, = struct.unpack(">I", read_exactly(stream, 4))
+                    basis.seek(index * block_size)
+                    data = basis.read(block_size)
+                elif op == b"D":
+                    length, = struct.unpack(">I", read_exactly(stream, 4))
+                    data = read_exactly(stream, length)
+                    literal += length
+                    if throttle is not None:
+                        throttle(length)
+                elif op == b"E":
+                    digest = read_exactly(stream, 32).decode()
+                    break
+                else:
+                    raise DeltaUnavailable(get_helper_error(channel))
+                whole.update(data)
+                target.write(data)
+
+        # the result only counts if the helper also finished cleanly
+        if channel.recv_exit_status() != 0:
+            raise DeltaUnavailable(get_helper_error(channel))
+        if whole.hexdigest() != digest:
+            raise DeltaUnavailable("delta result does not match the remote file")
+        os.replace(tmp, local_path)
+    except (OSError, paramiko.SSHException) as error:
+        raise DeltaUnavailable("delta stream failed: {}".format(error)) from error
+    finally:
+        channel.close()
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+    return literal
@@ -0,0 +1,211 @@
+#!/usr/local/bin/ python3
+
+import argparse, fnmatch, heapq, json, os, sys, tempfile
+from simple_settings import settings
+from common import (
+    find_archive,
+    find_chunk_store,
+    hash_file,
+    list_snapshots,
+    MANIFEST_NAME,
+)
+
+# diff_backups.py <old> [<new>] [--by path|remote] [--match PATTERN] [--json]
+#
+# Snapshots are given as a directory, a Backup_* name in BACKUPS_DIRECTORY, or
+# a job name (droplet1, diskstation, sandbox) for its newest snapshot, with
+# @YYYYmmddHHMMSS for the newest at or before that time. A job name alone
+# diffs its two newest snapshots.
+#
+# Both manifests are read as sorted streams and merged in one pass, so memory
+# stays bounded however many files the snapshots hold. Files whose size, mtime
+# and mode match are unchanged; content hashes are only compared when they
+# don't. --by remote keys files by the remote path they were copied from,
+# which lines up snapshots of different hosts, e.g.
+#
+#   diff_backups.py sandbox droplet1 --by remote --match '/etc/apache2/*'
+
+PREFIXES = {
+    "droplet1": "Backup_Droplet1",
+    "diskstation": "Backup_Diskstation",
+    "sandbox": "Backup_Sandbox",
+}
+
+# records are sorted in runs of this many and spilled to temp files between runs
+SORT_RUN_SIZE = 100000
+
+def resolve_snapshot(name, offset=0):
+    if os.path.isdir(name):
+        return os.path.normpath(name)
+    if os.path.isdir(os.path.join(settings.BACKUPS_DIRECTORY, name)):
+        return os.path.join(settings.BACKUPS_DIRECTORY, name)
+
+    job, _, created = name.partition("@")
+    if job not in PREFIXES:
+        raise SystemExit("no snapshot or job named {}".format(name))
+    names = [
+        snapshot
+        for snapshot in list_snapshots(settings.BACKUPS_DIRECTORY, PREFIXES[job])
+        if created == "" or snapshot.rsplit("_", 1)[1] <= created.ljust(14, "0")
+    ]
+    if len(names) <= offset:
+        raise SystemExit("not enough {} snapshots to diff".format(job))
+    return os.path.join(settings.BACKUPS_DIRECTORY, names[-1 - offset])
+
+# home-relative remote paths only mean the same file for the same user
+def get_key(record, by):
+    if by == "path":
+        return record["path"]
+    if record["remote"].startswith("~"):
+        return "{}:{}".format(record["user"], record["remote"])
+    return record["remote"]
+
+def matches(key, pattern):
+    return pattern is None or fnmatch.fnmatchcase(key, pattern) or key.startswith(pattern.rstrip("/") + "/")
+
+def read_manifest(directory):
+    path = os.path.join(directory, MANIFEST_NAME)
+    if not os.path.exists(path):
+        raise SystemExit("{} has no manifest".format(directory))
+    with open(path) as f:
+        for line in f:
+            yield json.loads(line)
+
+def spill(run, directory):
+    f = tempfile.TemporaryFile("w+", dir=directory)
+    for key, record in run:
+        f.write(json.dumps([key, record]) + "\n")
+    f.seek(0)
+    return f
+
+def read_spilled(f):
+    for line in f:
+        key, record = json.loads(line)
+        yield key, record
+
+# (key, record) pairs of a manifest in key order. Manifests are written in
+# path order, so --by path is a single sorted run; other keys are sorted in
+# bounded runs that are spilled to disk and merged back.
+def sorted_records(directory, by, pattern, spill_directory):
+    runs = []
+    run = []
+    for record in read_manifest(directory):
+        key = get_key(record, by)
+        if not matches(key, pattern):
+            continue
+        run.append((key, record))
+        if len(run) >= SORT_RUN_SIZE:
+            run.sort(key=lambda entry: entry[0])
+            runs.append(spill(run, spill_directory))
+            run = []
+    run.sort(key=lambda entry: entry[0])
+
+    if len(runs) == 0:
+        yield from run
+        return
+    try:
+        yield from heapq.merge(*(read_spilled(f) for f in runs), iter(run), key=lambda entry: entry[0])
+    finally:
+        for f in runs:
+            f.close()
+
+# a record's sha256, hashing the snapshot's copy when the manifest has none
+def get_digest(directory, record):
+    if record.get("sha256") is not None:
+        return record["sha256"]
+    path = os.path.join(directory, record["path"])
+    if find_archive(directory) is None and find_chunk_store(directory) is None and os.path.isfile(path):
+        return hash_file(path)
+    return None
+
+# one merge pass over both sorted streams, yielding (change, key, old, new)
+# with change one of added, removed, modified or touched (metadata only)
+def diff_snapshots(old, new, by="path", pattern=None):
+    with tempfile.TemporaryDirectory() as spill_directory:
+        old_records = sorted_records(old, by, pattern, spill_directory)
+        new_records = sorted_records(new, by, pattern, spill_directory)
+        old_entry = next(old_records, None)
+        new_entry = next(new_records, None)
+
+        while old_entry is not None or new_entry is not None:
+            if new_entry is None or (old_entry is not None and old_entry[0] < new_entry[0]):
+                yield "removed", old_entry[0], old_entry[1], None
+                old_entry = next(old_records, None)
+                continue
+            if old_entry is None or new_entry[0] < old_entry[0]:
+                yield "added", new_entry[0], None, new_entry[1]
+                new_entry = next(new_records, None)
+                continue
+
+            key, old_record = old_entry
+            new_record = new_entry[1]
+            if any(old_record.get(field) != new_record.get(field) for field in ("size", "mtime", "mode")):
+                old_digest = get_digest(old, old_record)
+                new_digest = get_digest(new, new_record)
+                if old_record["size"] != new_record["size"] or old_digest is None or old_digest != new_digest:
+                    yield "modified", key, old_record, new_record
+                else:
+                    yield "touched", key, old_record, new_record
+            old_entry = next(old_records, None)
+            new_entry = next(new_records, None)
+
+def format_change(change, key, old, new):
+    if change == "added":
+        return "A {} ({} bytes)".format(key, new["size"])
+    if change == "removed":
+        return "D {} ({} bytes)".format(key, old["size"])
+    if change == "modified":
+        return "M {} ({} -> {} bytes, {:+d})".format(key, old["size"], new["size"], new["size"] - old["size"])
+    return "T {} (same content, metadata changed)".format(key)
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description="diff two backup snapshots by their manifests")
+    parser.add_argument("old", help="snapshot directory, Backup_* name, or job[@YYYYmmddHHMMSS]")
+    parser.add_argument("new", nargs="?", help="as old; defaults to the newest snapshot of old's job")
+    parser.add_argument("--by", choices=("path", "remote"), default="path", help="match files by snapshot path or remote path")
+    parser.add_argument("--match", help="only diff keys matching this glob or directory")
+    parser.add_argument("--touched", action="store_true", help="also list files whose metadata changed but content didn't")
+    parser.add_argument("--json", action="store_true", help="print one JSON object per change")
+    # simple_settings reads --settings itself
+    arguments, unknown = parser.parse_known_args()
+    return arguments
+
+def run():
+    arguments = get_arguments()
+    if arguments.new is None:
+        old = resolve_snapshot(arguments.old, offset=1)
+        new = resolve_snapshot(arguments.old)
+    else:
+        old = resolve_snapshot(arguments.old)
+        new = resolve_snapshot(arguments.new)
+
+    counts = {"added": 0, "removed": 0, "modified": 0, "touched": 0}
+    size_delta = 0
+    for change, key, old_record, new_record in diff_snapshots(old, new, arguments.by, arguments.match):
+        counts[change] += 1
+        size_delta += (new_record["size"] if new_record else 0) - (old_record["size"] if old_record else 0)
+        if change == "touched" and not arguments.touched:
+            continue
+        if arguments.json:
+            print(json.dumps({
+                "change": change,
+                "key": key,
+                "old_size": old_record["size"] if old_record else None,
+                "new_size": new_record["size"] if new_record else None,
+            }))
+        else:
+            print(format_change(change, key, old_record, new_record))
+
+    print("{} -> {}: {} added, {} removed, {} modified, {} touched, {:+d} bytes".format(
+        os.path.basename(old),
+        os.path.basename(new),
+        counts["added"],
+        counts["removed"],
+        counts["modified"],
+        counts["touched"],
+        size_delta,
+    ), file=sys.stderr if arguments.json else sys.stdout)
+    return counts
+
+if __name__ == "__main__":
+    run()
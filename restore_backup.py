@@ -0,0 +1,186 @@
+#!/usr/local/bin/ python3
+
+import argparse, os, posixpath, tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from simple_settings import settings
+import paramiko
+from chunkstore import ChunkStore
+from common import (
+    get_logger,
+    find_chunk_store,
+    get_ssh_pool,
+    get_transfer_limits,
+    open_catalog,
+    copy_file_fast,
+    sftp_path,
+    SNAPSHOT_TIMESTAMP_FORMAT,
+)
+from snapshot_archive import extract_member, find_archive
+
+logger = get_logger('restore_backup.log')
+
+# restore_backup.py <host> <remote path or glob> [--at TIME] [--to DIRECTORY | --remote]
+#
+# Files are looked up in the snapshot catalog by the remote path they were
+# fetched from, so renamed copies such as dotbashrc are found as ~/.bashrc.
+
+def get_hosts():
+    return {
+        "droplet1": (settings.DROPLET1_HOST, settings.DROPLET1_PORT),
+        "diskstation": (settings.DISKSTATION_HOST, settings.DISKSTATION_PORT),
+        "sandbox": (settings.SANDBOX_HOST, settings.SANDBOX_PORT),
+    }
+
+# a job name or host name, and the SSH port to restore through
+def resolve_host(name):
+    hosts = get_hosts()
+    if name in hosts:
+        return hosts[name]
+    for host, port in hosts.values():
+        if host == name:
+            return host, port
+    return name, 22
+
+# snapshot timestamp for a point in time given as YYYYmmddHHMMSS or ISO 8601
+def parse_point_in_time(value):
+    if value is None:
+        return datetime.now().strftime(SNAPSHOT_TIMESTAMP_FORMAT)
+    if value.isdigit():
+        return value.ljust(14, "0")
+    return datetime.fromisoformat(value).strftime(SNAPSHOT_TIMESTAMP_FORMAT)
+
+# the matching files in the newest snapshot of the host taken at or before
+# created; a pattern matches a remote file by glob, or a directory by prefix
+def find_files(host, pattern, created, user=None):
+    columns = {"host": host}
+    if user is not None:
+        columns["user"] = user
+
+    with open_catalog() as catalog:
+        snapshot = catalog.latest_snapshot(created_before=created, **columns)
+        if snapshot is None:
+            return []
+        return catalog.find(snapshot=snapshot, remote_pattern=pattern, **columns)
+
+# copy a file out of its snapshot, from the tree, the snapshot archive or the
+# chunk store
+def extract_file(row, target):
+    path = os.path.join(row["directory"], row["path"])
+    archive = find_archive(row["directory"])
+    store = find_chunk_store(row["directory"])
+    if os.path.isfile(path):
+        copy_file_fast(path, target)
+    elif archive is not None:
+        extract_member(archive, row["path"], target)
+    elif store is not None:
+        with ChunkStore(store) as chunks:
+            chunks.extract(row["snapshot"], row["path"], target)
+    else:
+        raise FileNotFoundError("{} is not in {}".format(row["path"], row["directory"]))
+    os.utime(target, (row["mtime"], row["mtime"]))
+    os.chmod(target, row["mode"] & 0o7777)
+
+# a dump's remote is the command that wrote it, so it keeps its snapshot name
+def restore_local(row, directory):
+    if row.get("status") == "dumped":
+        target = os.path.join(directory, row["user"], row["path"])
+    else:
+        target = os.path.join(directory, row["user"], sftp_path(row["remote"]).lstrip("/"))
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    extract_file(row, target)
+    return target
+
+# create a remote directory and any missing parents, like os.makedirs
+def make_remote_directories(sftp, directory):
+    if directory in ("", "/"):
+        return
+    try:
+        sftp.stat(directory)
+    except IOError:
+        make_remote_directories(sftp, posixpath.dirname(directory))
+        try:
+            sftp.mkdir(directory)
+        except IOError:
+            # another restore thread may have just made it
+            sftp.stat(directory)
+
+def restore_remote(row, host, port):
+    fd, staged = tempfile.mkstemp(prefix=".restore-")
+    os.close(fd)
+    try:
+        extract_file(row, staged)
+        with get_ssh_pool().connection(host, port, row["user"]) as ssh:
+            with get_transfer_limits().slot(host):
+                with paramiko.SFTPClient.from_transport(ssh.get_transport()) as sftp:
+                    remote = sftp_path(row["remote"])
+                    make_remote_directories(sftp, posixpath.dirname(remote))
+                    sftp.put(staged, remote)
+                    sftp.utime(remote, (row["mtime"], row["mtime"]))
+                    sftp.chmod(remote, row["mode"] & 0o7777)
+    finally:
+        os.remove(staged)
+    return "{}@{}:{}".format(row["user"], host, row["remote"])
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description="restore files from a backup snapshot")
+    parser.add_argument("host", help="job name (droplet1, diskstation, sandbox) or host")
+    parser.add_argument("pattern", help="remote path, directory or glob, e.g. '~/.ssh' or '/etc/apache2/*.conf'")
+    parser.add_argument("--at", help="point in time, YYYYmmddHHMMSS or ISO 8601 (default: latest)")
+    parser.add_argument("--user", help="only restore files fetched as this user")
+    parser.add_argument("--to", help="local directory to restore into, one subdirectory per user")
+    parser.add_argument("--remote", action="store_true", help="write the files back to the host")
+    parser.add_argument("--list", action="store_true", help="only list the matching files")
+    # simple_settings reads --settings itself
+    arguments, unknown = parser.parse_known_args()
+    return arguments
+
+def run():
+    arguments = get_arguments()
+    host, port = resolve_host(arguments.host)
+    created = parse_point_in_time(arguments.at)
+    rows = find_files(host, arguments.pattern, created, arguments.user)
+
+    if len(rows) == 0:
+        print("no files matching {} in {} backups up to {}".format(arguments.pattern, host, created))
+        return []
+
+    print("{} files in {}".format(len(rows), rows[0]["snapshot"]))
+    if arguments.list or (arguments.to is None and not arguments.remote):
+        for row in rows:
+            print("{}@{}:{} ({} bytes)".format(row["user"], host, row["remote"], row["size"]))
+        return rows
+
+    if arguments.remote:
+        # a dump has no file on the host to write back to; restore it with --to
+        for row in rows:
+            if row.get("status") == "dumped":
+                print("skipping {} (dumped by {}), restore it with --to".format(row["path"], row["remote"]))
+        rows = [row for row in rows if row.get("status") != "dumped"]
+
+    with ThreadPoolExecutor(max_workers=settings.TRANSFER_WORKERS) as executor:
+        if arguments.remote:
+            futures = [executor.submit(restore_remote, row, host, port) for row in rows]
+        else:
+            futures = [executor.submit(restore_local, row, arguments.to) for row in rows]
+
+    errors = []
+    for row, future in zip(rows, futures):
+        try:
+            print("restored {}".format(future.result()))
+        except Exception as error:
+            errors.append("{}: {}".format(row["remote"], error))
+
+    if len(errors) == 0:
+        logger.info("restored {} files from {}".format(len(rows), rows[0]["snapshot"]))
+    else:
+        logger.error("restore from {} encountered the following errors: {}".format(
+            rows[0]["snapshot"],
+            ", ".join(errors),
+        ))
+        print("\n".join(errors))
+
+    return rows
+
+if __name__ == "__main__":
+    run()
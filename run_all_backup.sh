@@ -0,0 +1,5 @@
+#!/bin/sh
+
+MAILTO=""
+
+venv/bin/python3 backup_all.py --settings=settings_local
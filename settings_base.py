@@ -10,12 +10,138 @@ DISKSTATION_WEB_DIRECTORY = ""
 SANDBOX_HOST = ""
 SANDBOX_USERS = ()
 SANDBOX_PORT = 22
+# remote shell rsync uses to reach the sandbox
+SANDBOX_SSH_COMMAND = "ssh"
+# rsync calls run at the same time, over one multiplexed connection per user
+SANDBOX_RSYNC_WORKERS = 3
 
 BACKUPS_DIRECTORY = ""
 DROPBOX_BACKUPS_DIRECTORY = ""
+# more backups directories (e.g. an external drive) that droplet1 and
+# diskstation snapshots are mirrored into next to Dropbox
+MIRROR_DIRECTORIES = ()
+# copy each fetched file into the mirrors as it arrives instead of reading the
+# whole snapshot back afterwards (directory snapshots only)
+TEE_ON_ARRIVAL = False
 SSH_KEY = ""
 
+# log lines are plain text with the job and phase added ("text"), or JSON
+# objects with run/job/host/phase context ("json")
+LOG_FORMAT = "text"
+# per-file debug lines logged a second at most, with a count of the skipped
+# ones; None logs every one, 0 none
+LOG_FILE_EVENT_RATE = 10
+
+# "directory" keeps each snapshot as a plain tree, "archive" writes it as one
+# compressed tar stream (snapshot.tar.zst with zstandard installed, otherwise
+# snapshot.tar.gz) plus a seekable index
+SNAPSHOT_FORMAT = "directory"
+ARCHIVE_THREADS = 4
+
+# after each run, compare every file in the new snapshot against a sha256sum
+# taken on the remote (needs sha256sum and xargs on the remote)
+VERIFY_BACKUPS = False
+
+# SQLite catalog of every snapshot's files; None keeps it at
+# BACKUPS_DIRECTORY/catalog.sqlite3
+CATALOG_PATH = None
+
+# content-addressed chunk store shared by every job; when set, incremental
+# snapshots older than the newest are moved into it, keeping only their
+# manifests on disk, and the codespace files are added after every run
+CHUNK_STORE_DIRECTORY = None
+
+# pooled SSH connections (seconds)
+SSH_CONNECT_TIMEOUT = 10
+SSH_KEEPALIVE = 30
+SSH_IDLE_TIMEOUT = 300
+
+# hard-link unchanged files against the previous Backup_* snapshot instead of
+# archiving and deleting it on every run
+INCREMENTAL_SNAPSHOTS = False
+
+# snapshots kept per host in incremental mode: the newest snapshot of each of
+# the last N hours/days/weeks/months (the newest snapshot is always kept)
+RETENTION = {
+    "hourly": 0,
+    "daily": 1,
+    "weekly": 0,
+    "monthly": 0,
+}
+
+# pruned snapshots are deleted in the background at most this many files per
+# second; None deletes them unthrottled
+TRASH_DELETE_RATE = 500
+
+# number of concurrent SCP channels per host connection
+TRANSFER_WORKERS = 4
+
+# times a failed scp of a file is retried, with exponential backoff
+TRANSFER_RETRIES = 2
+
+# a run within this many seconds of an interrupted one continues into its
+# snapshot, skipping the files it finished (directory snapshots only; None
+# always starts over), e.g. 6 * 60 * 60
+RESUME_WINDOW = None
+
+# files at least this many bytes are fetched over SFTP through a .part file, so
+# an interrupted transfer resumes from its byte offset; None always uses scp,
+# e.g. 64 * 1024 * 1024
+RESUME_MIN_SIZE = None
+
+# changed files at least this many bytes are fetched with the rolling-checksum
+# delta transfer (needs python3 on the remote); None always copies in full
+DELTA_TRANSFER_MIN_SIZE = None
+
+# database dumps taken on Droplet1 as DROPLET1_WEBMASTER during each run, as
+# (file name in the snapshot, remote command writing the dump to stdout); the
+# output is gzipped locally as it streams in. mysqldump reads its credentials
+# from the remote ~/.my.cnf; "sqlite3 <path> .dump" works the same way, e.g.
+# (("bevendo-dump.sql.gz", "mysqldump --single-transaction --quick bevendo"),).
+# Until bevendo-dump.sql.gz is listed here, the copy a remote cron job leaves
+# in backups/ is fetched instead
+DROPLET1_DUMPS = ()
+
+# live SQLite databases are copied through the SQLite backup API on the remote
+# (needs python3 there), sending only the pages changed since the previous
+# snapshot; False copies the database file as is
+SQLITE_PAGE_BACKUP = False
+
+# files up to this many bytes are fetched together through one remote tar
+# (gzipped if BATCH_FETCH_COMPRESS; needs GNU tar on the remote) instead of
+# one scp per file, e.g. 1024 * 1024; None disables
+BATCH_FETCH_MAX_SIZE = None
+BATCH_FETCH_COMPRESS = True
+
+# each job writes backup_<job>_report.json here (None disables), and
+# backup_<job>.prom for the node_exporter textfile collector if set
+RUN_REPORT_DIRECTORY = "."
+METRICS_TEXTFILE_DIRECTORY = None
+
+# limits shared by all jobs running in one process (see backup_all.py)
+BACKUP_JOBS = ("droplet1", "diskstation", "sandbox", "codespace")
+MAX_CONCURRENT_JOBS = 4
+MAX_TRANSFERS = 12
+MAX_TRANSFERS_PER_HOST = 4
+DISK_IO_SLOTS = 2
+
+# with ADAPTIVE_CONCURRENCY, each host starts at half of MAX_TRANSFERS_PER_HOST
+# transfers and gains or loses one every ADAPTIVE_CONCURRENCY_INTERVAL seconds
+# as its throughput rises or falls; a failed transfer halves them
+ADAPTIVE_CONCURRENCY = False
+ADAPTIVE_CONCURRENCY_INTERVAL = 5
+
+# bytes per second shared by all transfers (None is unlimited), enforced only
+# between BANDWIDTH_LIMIT_HOURS = (start hour, end hour) when set, e.g. (8, 23)
+BANDWIDTH_LIMIT = None
+BANDWIDTH_LIMIT_HOURS = None
+BACKUP_RESULT_FILE = "backup_all_result.json"
+
 # codespaces
+GH_EXECUTABLE = "gh"
+CODESPACE_BACKUP_DIRECTORY = "/Users/bryanhadromerchbar/Documents/Backups/Codespaces"
+CODESPACE_MAX_CONCURRENT = 2
+CODESPACE_RETRIES = 2
 CODESPACE_COPTHIS = {
     "NAME": "",
     "PATH": "",
@@ -0,0 +1,187 @@
+import gzip, hashlib, json, os, shutil, stat, tarfile, threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# A snapshot written as a single compressed tar stream instead of a directory
+# tree. The tar stream is cut into chunks that are compressed on a thread pool
+# as independent zstd frames (or gzip members when zstandard isn't installed),
+# and every tar member starts on a new frame. The index next to the archive
+# records where each member's frames start, so one file can be pulled out, or
+# copied compressed into the next snapshot, without decompressing the rest.
+
+CHUNK_SIZE = 4 * 1024 * 1024
+INDEX_SUFFIX = ".index.json"
+
+def get_archive_name():
+    if zstandard is not None:
+        return "snapshot.tar.zst"
+    return "snapshot.tar.gz"
+
+# the archive inside a snapshot directory, if it was written in archive format
+def find_archive(directory):
+    for name in ("snapshot.tar.zst", "snapshot.tar.gz"):
+        path = os.path.join(directory, name)
+        if os.path.exists(path) and os.path.exists(path + INDEX_SUFFIX):
+            return path
+    return None
+
+def get_format(path):
+    return "zstd" if path.endswith(".zst") else "gzip"
+
+def load_index(path):
+    with open(path + INDEX_SUFFIX) as f:
+        index = json.load(f)
+    return {member["name"]: member for member in index["members"]}
+
+def write_json(path, data):
+    with open(path + ".tmp", "w") as f:
+        json.dump(data, f)
+    os.replace(path + ".tmp", path)
+
+class SnapshotArchive:
+
+    def __init__(self, path, threads=4, level=None):
+        self.path = path
+        self.format = get_format(path)
+        if self.format == "zstd" and zstandard is None:
+            raise RuntimeError("zstandard is not installed, use a .tar.gz archive")
+        self.level = level
+        self.file = open(path + ".tmp", "wb")
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.pending = deque()
+        self.max_pending = threads * 2
+        self.members = []
+        self.lock = threading.Lock()
+
+    def compress(self, data):
+        if self.format == "zstd":
+            return zstandard.ZstdCompressor(level=self.level or 3).compress(data)
+        return gzip.compress(data, compresslevel=self.level or 6, mtime=0)
+
+    # queue a chunk for compression; entry marks the first chunk of a member,
+    # whose offset is filled in once the chunk is written
+    def submit(self, data, entry=None):
+        self.pending.append((self.executor.submit(self.compress, bytes(data)), entry))
+        while len(self.pending) > self.max_pending:
+            self.write_next()
+
+    def write_next(self):
+        future, entry = self.pending.popleft()
+        if entry is not None:
+            entry["offset"] = self.file.tell()
+        self.file.write(future.result())
+
+    def flush(self):
+        while len(self.pending) > 0:
+            self.write_next()
+
+    def add_file(self, name, path, mtime=None, mode=None):
+        with self.lock:
+            size = os.path.getsize(path)
+            info = tarfile.TarInfo(name)
+            info.size = size
+            info.mtime = int(mtime if mtime is not None else os.path.getmtime(path))
+            info.mode = stat.S_IMODE(mode if mode is not None else os.stat(path).st_mode)
+            entry = {"name": name, "size": size, "mtime": info.mtime, "mode": info.mode}
+            self.members.append(entry)
+
+            buffer = bytearray(info.tobuf(format=tarfile.PAX_FORMAT))
+            remaining = size
+            with open(path, "rb") as f:
+                while remaining > 0:
+                    data = f.read(min(remaining, CHUNK_SIZE - len(buffer)))
+                    if not data:
+                        raise IOError("{} changed size while being archived".format(path))
+                    remaining -= len(data)
+                    buffer += data
+                    if len(buffer) >= CHUNK_SIZE:
+                        self.submit(buffer, entry)
+                        entry = None
+                        buffer = bytearray()
+
+            buffer += tarfile.NUL * ((tarfile.BLOCKSIZE - size % tarfile.BLOCKSIZE) % tarfile.BLOCKSIZE)
+            if len(buffer) > 0:
+                self.submit(buffer, entry)
+
+    def add_tree(self, root, prefix=""):
+        for directory, dirs, files in os.walk(root):
+            dirs.sort()
+            for filename in sorted(files):
+                path = os.path.join(directory, filename)
+                self.add_file(os.path.normpath(os.path.join(prefix, os.path.relpath(path, root))), path)
+
+    # copy a member's compressed frames from an earlier archive as-is; returns
+    # False if the two archives don't use the same compression
+    def copy_member(self, source_path, source_entry):
+        if get_format(source_path) != self.format:
+            return False
+
+        with self.lock:
+            self.flush()
+            entry = dict(source_entry)
+            entry["offset"] = self.file.tell()
+            self.members.append(entry)
+            with open(source_path, "rb") as source:
+                source.seek(source_entry["offset"])
+                remaining = source_entry["length"]
+                while remaining > 0:
+                    data = source.read(min(remaining, CHUNK_SIZE))
+                    if not data:
+                        raise IOError("{} is truncated".format(source_path))
+                    self.file.write(data)
+                    remaining -= len(data)
+        return True
+
+    def close(self):
+        with self.lock:
+            end = {}
+            self.submit(tarfile.NUL * (tarfile.BLOCKSIZE * 2), end)
+            self.flush()
+            self.executor.shutdown()
+            self.file.close()
+
+            # each member's frames run up to the start of the next one
+            offsets = sorted(member["offset"] for member in self.members) + [end["offset"]]
+            following = dict(zip(offsets, offsets[1:]))
+            for member in self.members:
+                member["length"] = following[member["offset"]] - member["offset"]
+
+            os.replace(self.path + ".tmp", self.path)
+            write_json(self.path + INDEX_SUFFIX, {
+                "format": self.format,
+                "members": sorted(self.members, key=lambda member: member["name"]),
+            })
+
+def open_stream(f, archive_format):
+    if archive_format == "zstd":
+        return zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True)
+    return gzip.GzipFile(fileobj=f, mode="rb")
+
+# pull one file out of an archive by seeking straight to its frames
+def extract_member(path, name, target):
+    entry = load_index(path)[name]
+    with open(path, "rb") as f:
+        f.seek(entry["offset"])
+        with tarfile.open(fileobj=open_stream(f, get_format(path)), mode="r|") as tar:
+            member = tar.next()
+            source = tar.extractfile(member)
+            with open(target, "wb") as out:
+                shutil.copyfileobj(source, out, 1 << 20)
+    os.utime(target, (entry["mtime"], entry["mtime"]))
+    os.chmod(target, entry["mode"])
+
+# sha256 of one member's contents, read the same way as extract_member
+def hash_member(path, entry):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        f.seek(entry["offset"])
+        with tarfile.open(fileobj=open_stream(f, get_format(path)), mode="r|") as tar:
+            source = tar.extractfile(tar.next())
+            for block in iter(lambda: source.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()
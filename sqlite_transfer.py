@@ -0,0 +1,160 @@
+import hashlib, json, os, shlex, shutil, struct
+import paramiko
+
+# Page-level incremental copy of a live SQLite database over an SSH exec channel.
+#
+# The local side sends the page size and per-page md5s of the previous
+# snapshot's copy to a small Python helper on the remote. The helper takes a
+# consistent copy of the database with the SQLite online backup API, so a
+# write in progress is never caught half way, and answers with only the pages
+# of that copy that differ:
+#
+#   b"P" + >I page index + page    a page that changed or is new
+#   b"E" + >Q size + md5 hex       end of copy, its size and whole-file digest
+#
+# The local side starts from the previous copy, writes the changed pages over
+# it and truncates it to the new size, so what crosses the network follows the
+# database's write rate rather than its size.
+
+REMOTE_HELPER = r'''
+import hashlib, json, os, sqlite3, struct, sys, tempfile
+path = os.path.expanduser(sys.argv[1])
+header = json.loads(sys.stdin.readline())
+if not os.path.isfile(path):
+    sys.exit("no such database: " + path)
+fd, copy = tempfile.mkstemp(prefix=".sqlite-backup-")
+os.close(fd)
+try:
+    source = sqlite3.connect(path)
+    target = sqlite3.connect(copy)
+    with target:
+        source.backup(target)
+    target.close()
+    source.close()
+    with open(copy, "rb") as f:
+        first = f.read(100)
+        size = struct.unpack(">H", first[16:18])[0] if len(first) >= 18 else 4096
+        size = 65536 if size == 1 else size
+        # pages of a different size can't be compared, send them all
+        known = header["pages"] if header["page_size"] == size else []
+        out = sys.stdout.buffer
+        whole = hashlib.md5()
+        f.seek(0)
+        index = 0
+        for page in iter(lambda: f.read(size), b""):
+            whole.update(page)
+            if index >= len(known) or hashlib.md5(page).hexdigest() != known[index]:
+                out.write(b"P" + struct.pack(">I", index) + page)
+            index += 1
+        out.write(b"E" + struct.pack(">Q", f.tell()) + whole.hexdigest().encode())
+        out.flush()
+finally:
+    os.remove(copy)
+'''
+
+class SqliteUnavailable(Exception):
+    pass
+
+# the page size from a database header, 4096 for an empty or missing file
+def get_page_size(path):
+    if not os.path.isfile(path):
+        return 4096
+    with open(path, "rb") as f:
+        header = f.read(100)
+    if len(header) < 18 or not header.startswith(b"SQLite format 3\0"):
+        return 4096
+    size, = struct.unpack(">H", header[16:18])
+    return 65536 if size == 1 else size
+
+def page_signatures(path, page_size):
+    if path is None or not os.path.isfile(path):
+        return []
+    with open(path, "rb") as f:
+        return [hashlib.md5(page).hexdigest() for page in iter(lambda: f.read(page_size), b"")]
+
+def read_exactly(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise SqliteUnavailable("sqlite page stream ended early")
+    return data
+
+def get_helper_error(channel):
+    return "remote sqlite helper exited with status {}: {}".format(
+        channel.recv_exit_status(),
+        channel.makefile_stderr("rb").read().decode(errors="replace").strip(),
+    )
+
+# write a consistent copy of the remote database at local_path, starting from
+# basis_path (the previous snapshot's copy, or None) and fetching only the
+# pages that changed. Returns the number of page bytes sent. Raises
+# SqliteUnavailable if the remote helper can't run, so the caller can fall back
+# to copying the file. A throttle callable, when given, is called with the
+# size of every page received.
+def fetch_sqlite(transport, remote_path, local_path, basis_path=None, throttle=None):
+    page_size = get_page_size(basis_path) if basis_path is not None else 4096
+    header = {
+        "page_size": page_size,
+        "pages": page_signatures(basis_path, page_size),
+    }
+
+    channel = transport.open_session()
+    channel.exec_command("python3 -c {} {}".format(
+        shlex.quote(REMOTE_HELPER),
+        shlex.quote(remote_path),
+    ))
+
+    tmp = "{}.sqlite-tmp".format(local_path)
+    sent = 0
+    stream = channel.makefile("rb")
+    try:
+        # a helper that never started closes the channel under a large header
+        channel.sendall(json.dumps(header).encode() + b"\n")
+        channel.shutdown_write()
+
+        if len(header["pages"]) > 0:
+            shutil.copyfile(basis_path, tmp)
+        with open(tmp, "r+b" if os.path.exists(tmp) else "wb") as target:
+            while True:
+                op = stream.read(1)
+                if op == b"P":
+                    index, = struct.unpack(">I", read_exactly(stream, 4))
+                    # the remote's page size is only known once its first page arrives
+                    if sent == 0 and index == 0:
+                        page = read_exactly(stream, 100)
+                        size, = struct.unpack(">H", page[16:18])
+                        page_size = 65536 if size == 1 else size
+                        page += read_exactly(stream, page_size - 100)
+                    else:
+                        page = read_exactly(stream, page_size)
+                    target.seek(index * page_size)
+                    target.write(page)
+                    sent += len(page)
+                    if throttle is not None:
+                        throttle(len(page))
+                elif op == b"E":
+                    size, = struct.unpack(">Q", read_exactly(stream, 8))
+                    digest = read_exactly(stream, 32).decode()
+                    target.truncate(size)
+                    break
+                else:
+                    raise SqliteUnavailable(get_helper_error(channel))
+
+        # the copy only counts if the helper also finished cleanly
+        if channel.recv_exit_status() != 0:
+            raise SqliteUnavailable(get_helper_error(channel))
+
+        whole = hashlib.md5()
+        with open(tmp, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                whole.update(block)
+        if whole.hexdigest() != digest:
+            raise SqliteUnavailable("rebuilt database does not match the remote copy")
+        os.replace(tmp, local_path)
+    except (OSError, paramiko.SSHException) as error:
+        raise SqliteUnavailable("sqlite page stream failed: {}".format(error)) from error
+    finally:
+        channel.close()
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+    return sent
@@ -0,0 +1,21 @@
+import os, sys
+import paramiko
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("SIMPLE_SETTINGS", "settings_base")
+
+from bench_server import BenchServer
+
+# an SSH transport to a local server whose "bench" home is tmp_path/remote/bench
+
+@pytest.fixture
+def transport(tmp_path):
+    server = BenchServer(str(tmp_path / "remote"))
+    port = server.start()
+    ssh = paramiko.SSHClient()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    ssh.connect("127.0.0.1", port, "bench", password="bench", look_for_keys=False, allow_agent=False)
+    yield ssh.get_transport()
+    ssh.close()
+    server.stop()
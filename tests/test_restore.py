@@ -0,0 +1,36 @@
+from simple_settings import settings
+
+from common import Fetch, catalog_snapshot, run_transfers
+from restore_backup import find_files, resolve_host
+
+# files are cataloged under the configured host name rather than the address
+# the connection ended up at, so a restore finds them by job name
+
+def test_find_files_by_job_name(tmp_path, transport):
+    remote = tmp_path / "remote" / "bench" / "f.txt"
+    remote.parent.mkdir(parents=True, exist_ok=True)
+    remote.write_text("contents\n")
+    snapshot = tmp_path / "backups" / "Backup_Droplet1_20240501120000"
+    snapshot.mkdir(parents=True)
+
+    overrides = {
+        "DROPLET1_HOST": "droplet1.example.com",
+        "DROPLET1_PORT": 22,
+        "DISKSTATION_HOST": "diskstation.example.com",
+        "DISKSTATION_PORT": 22,
+        "SANDBOX_HOST": "sandbox.example.com",
+        "SANDBOX_PORT": 22,
+        "CATALOG_PATH": str(tmp_path / "catalog.sqlite3"),
+    }
+    previous = {name: getattr(settings, name, None) for name in overrides}
+    settings.configure(**overrides)
+    try:
+        host, port = resolve_host("droplet1")
+        records = run_transfers(transport, [Fetch("f.txt", str(snapshot / "f.txt"))], str(snapshot), host=host)
+        catalog_snapshot(str(snapshot), records)
+
+        rows = find_files(host, "f.txt", "20240501120000")
+        assert [row["path"] for row in rows] == ["f.txt"]
+        assert find_files("127.0.0.1", "f.txt", "20240501120000") == []
+    finally:
+        settings.configure(**previous)
@@ -0,0 +1,35 @@
+import os
+
+from common import Fetch, Journal, run_transfers, write_manifest
+
+# a resumed run refetches a file the interrupted run had hard-linked from the
+# previous snapshot, and must not write through the link into that snapshot
+
+def test_resume_over_hard_linked_file(tmp_path, transport):
+    remote = tmp_path / "remote" / "bench" / "f.txt"
+    remote.parent.mkdir(parents=True, exist_ok=True)
+    remote.write_text("old contents\n")
+    previous = tmp_path / "Backup_A"
+    current = tmp_path / "Backup_B"
+    previous.mkdir()
+    current.mkdir()
+
+    records = run_transfers(transport, [Fetch("f.txt", str(previous / "f.txt"))], str(previous))
+    write_manifest(str(previous), records)
+
+    # the interrupted run linked the unchanged file and journaled it
+    journal = Journal(str(current))
+    records = run_transfers(transport, [Fetch("f.txt", str(current / "f.txt"))], str(current), previous=str(previous), journal=journal)
+    journal.close()
+    assert records[0]["status"] == "linked"
+    assert os.path.samefile(previous / "f.txt", current / "f.txt")
+
+    remote.write_text("new and longer contents\n")
+    journal = Journal(str(current))
+    records = run_transfers(transport, [Fetch("f.txt", str(current / "f.txt"))], str(current), previous=str(previous), journal=journal)
+    journal.complete()
+
+    assert records[0]["status"] == "transferred"
+    assert (current / "f.txt").read_text() == "new and longer contents\n"
+    assert (previous / "f.txt").read_text() == "old contents\n"
+    assert not os.path.samefile(previous / "f.txt", current / "f.txt")
@@ -0,0 +1,26 @@
+import os
+
+from common import TrashWorker
+
+# a symlink to a directory is removed from the trash without following it
+# into the directory it points to
+
+def test_trash_with_directory_symlink(tmp_path):
+    target = tmp_path / "target"
+    target.mkdir()
+    (target / "keep.txt").write_text("keep\n")
+
+    trash = tmp_path / ".trash"
+    snapshot = trash / "Backup_A"
+    (snapshot / "sub").mkdir(parents=True)
+    (snapshot / "sub" / "f.txt").write_text("old\n")
+    os.symlink(target, snapshot / "link")
+    os.symlink(target, snapshot / "sub" / "link")
+    os.symlink(target, trash / "link")
+
+    worker = TrashWorker(None)
+    worker.empty(str(trash))
+    worker.wait()
+
+    assert os.listdir(trash) == []
+    assert (target / "keep.txt").read_text() == "keep\n"